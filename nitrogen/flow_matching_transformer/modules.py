@@ -42,13 +42,20 @@ class AdaLayerNorm(nn.Module):
         self.linear = nn.Linear(embedding_dim, output_dim)
         self.norm = nn.LayerNorm(output_dim // 2, norm_eps, norm_elementwise_affine)
 
+    def project_temb(self, temb: torch.Tensor) -> torch.Tensor:
+        """Scale and shift for a timestep embedding, concatenated: (N, 2 * D)."""
+        return self.linear(self.silu(temb))
+
     def forward(
         self,
         x: torch.Tensor,
         temb: Optional[torch.Tensor] = None,
+        temb_proj: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
-        temb = self.linear(self.silu(temb))
-        scale, shift = temb.chunk(2, dim=1)
+        # temb_proj, if given, is project_temb(temb) computed ahead of time
+        if temb_proj is None:
+            temb_proj = self.project_temb(temb)
+        scale, shift = temb_proj.chunk(2, dim=1)
         x = self.norm(x) * (1 + scale[:, None]) + shift[:, None]
         return x
 
@@ -133,6 +140,42 @@ class BasicTransformerBlock(nn.Module):
         else:
             self.final_dropout = None
 
+    def project_encoder_kv(self, encoder_hidden_states: torch.Tensor):
+        """
+        Project the encoder states into this block's cross-attention key and value,
+        split into heads: (B, heads, S, head_dim) each.
+        """
+        attn = self.attn1
+        batch_size = encoder_hidden_states.shape[0]
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+        head_dim = key.shape[-1] // attn.heads
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        return key, value
+
+    def _cross_attention_with_kv(self, hidden_states, encoder_kv, attention_mask=None):
+        # Same math as diffusers' AttnProcessor2_0, with key/value taken from the cache.
+        # attention_mask: (B, 1, S) boolean, True for the keys to attend to
+        attn = self.attn1
+        if attention_mask is not None:
+            attention_mask = attention_mask.unsqueeze(1)  # broadcast over heads
+        key, value = encoder_kv
+        batch_size = hidden_states.shape[0]
+        head_dim = key.shape[-1]
+
+        query = attn.to_q(hidden_states)
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        hidden_states = F.scaled_dot_product_attention(
+            query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+        )
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        hidden_states = attn.to_out[0](hidden_states)  # linear proj
+        hidden_states = attn.to_out[1](hidden_states)  # dropout
+        return hidden_states / attn.rescale_output_factor
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -140,23 +183,39 @@ class BasicTransformerBlock(nn.Module):
         encoder_hidden_states: Optional[torch.Tensor] = None,
         encoder_attention_mask: Optional[torch.Tensor] = None,
         temb: Optional[torch.LongTensor] = None,
+        encoder_kv: Optional[tuple[torch.Tensor, torch.Tensor]] = None,
+        temb_proj: Optional[torch.Tensor] = None,
+        position_offset: int = 0,
     ) -> torch.Tensor:
+        """
+        `attention_mask` (self-attention) and `encoder_attention_mask` (cross-attention) are
+        (B, 1, S) boolean masks, True for the keys to attend to. `position_offset` is the
+        position of the first token, for sequences that were cut from a longer one.
+        """
 
         # 0. Self-Attention
         if self.norm_type == "ada_norm":
-            norm_hidden_states = self.norm1(hidden_states, temb)
+            norm_hidden_states = self.norm1(hidden_states, temb, temb_proj=temb_proj)
         else:
             norm_hidden_states = self.norm1(hidden_states)
 
-        if self.pos_embed is not None:
+        if self.pos_embed is not None and position_offset:
+            seq_len = norm_hidden_states.shape[1]
+            pe = self.pos_embed.pe[:, position_offset : position_offset + seq_len]
+            norm_hidden_states = norm_hidden_states + pe
+        elif self.pos_embed is not None:
             norm_hidden_states = self.pos_embed(norm_hidden_states)
 
-        attn_output = self.attn1(
-            norm_hidden_states,
-            encoder_hidden_states=encoder_hidden_states,
-            attention_mask=attention_mask,
-            # encoder_attention_mask=encoder_attention_mask,
-        )
+        if encoder_kv is not None:
+            attn_output = self._cross_attention_with_kv(
+                norm_hidden_states, encoder_kv, attention_mask=encoder_attention_mask
+            )
+        else:
+            attn_output = self.attn1(
+                norm_hidden_states,
+                encoder_hidden_states=encoder_hidden_states,
+                attention_mask=encoder_attention_mask if encoder_hidden_states is not None else attention_mask,
+            )
         if self.final_dropout:
             attn_output = self.final_dropout(attn_output)
 
@@ -248,46 +307,101 @@ class DiT(ModelMixin):
             sum(p.numel() for p in self.parameters() if p.requires_grad),
         )
 
+    def precompute_encoder_kv(self, encoder_hidden_states: torch.Tensor):
+        """
+        Project the encoder states into the key/value of every cross-attention block.
+
+        The encoder states are fixed for a whole sampling request, so the result can be
+        passed as `encoder_kv_cache` to every denoising step. Self-attention blocks get None.
+        """
+        encoder_hidden_states = encoder_hidden_states.contiguous()
+        encoder_kv_cache = []
+        for idx, block in enumerate(self.transformer_blocks):
+            if idx % 2 == 1 and self.config.interleave_self_attention:
+                encoder_kv_cache.append(None)
+            else:
+                encoder_kv_cache.append(block.project_encoder_kv(encoder_hidden_states))
+        return encoder_kv_cache
+
+    def precompute_timestep_cond(self, timestep: torch.LongTensor):
+        """
+        Compute everything that only depends on the timestep, for a batch of N timesteps:
+        the timestep embedding, the AdaLayerNorm scale/shift of every block (None for other
+        norm types) and the output modulation, with a leading dimension of N each.
+
+        Samplers keep this as a table and pass rows of it as `timestep_cond`, so that the
+        timestep MLPs do not run on every denoising step.
+        """
+        temb = self.timestep_encoder(timestep)
+        blocks = [
+            block.norm1.project_temb(temb) if block.norm_type == "ada_norm" else None
+            for block in self.transformer_blocks
+        ]
+        return {
+            "temb": temb,
+            "blocks": blocks,
+            "out": self.proj_out_1(F.silu(temb)),
+        }
+
     def forward(
         self,
         hidden_states: torch.Tensor,  # Shape: (B, T, D)
-        encoder_hidden_states: torch.Tensor,  # Shape: (B, S, D)
+        encoder_hidden_states: Optional[torch.Tensor],  # Shape: (B, S, D)
         timestep: Optional[torch.LongTensor] = None,
         encoder_attention_mask: Optional[torch.Tensor] = None,
         return_all_hidden_states: bool = False,
+        encoder_kv_cache: Optional[list] = None,  # From precompute_encoder_kv
+        timestep_cond: Optional[dict] = None,  # From precompute_timestep_cond, replaces timestep
     ):
+        # encoder_attention_mask: (B, S) boolean, True for the encoder tokens to attend to
+        if encoder_attention_mask is not None:
+            encoder_attention_mask = encoder_attention_mask.bool().unsqueeze(1)
+
         # Encode timesteps
-        temb = self.timestep_encoder(timestep)
+        if timestep_cond is None:
+            timestep_cond = self.precompute_timestep_cond(timestep)
+        temb = timestep_cond["temb"]
 
         # Process through transformer blocks - single pass through the blocks
         hidden_states = hidden_states.contiguous()
-        encoder_hidden_states = encoder_hidden_states.contiguous()
+        if encoder_hidden_states is not None:
+            encoder_hidden_states = encoder_hidden_states.contiguous()
 
         all_hidden_states = [hidden_states]
 
         # Process through transformer blocks
         for idx, block in enumerate(self.transformer_blocks):
-            if idx % 2 == 1 and self.config.interleave_self_attention:
+            if encoder_kv_cache is not None and encoder_kv_cache[idx] is not None:
+                hidden_states = block(
+                    hidden_states,
+                    attention_mask=None,
+                    encoder_attention_mask=encoder_attention_mask,
+                    temb=temb,
+                    encoder_kv=encoder_kv_cache[idx],
+                    temb_proj=timestep_cond["blocks"][idx],
+                )
+            elif idx % 2 == 1 and self.config.interleave_self_attention:
                 hidden_states = block(
                     hidden_states,
                     attention_mask=None,
                     encoder_hidden_states=None,
                     encoder_attention_mask=None,
                     temb=temb,
+                    temb_proj=timestep_cond["blocks"][idx],
                 )
             else:
                 hidden_states = block(
                     hidden_states,
                     attention_mask=None,
                     encoder_hidden_states=encoder_hidden_states,
-                    encoder_attention_mask=None,
+                    encoder_attention_mask=encoder_attention_mask,
                     temb=temb,
+                    temb_proj=timestep_cond["blocks"][idx],
                 )
             all_hidden_states.append(hidden_states)
 
         # Output processing
-        conditioning = temb
-        shift, scale = self.proj_out_1(F.silu(conditioning)).chunk(2, dim=1)
+        shift, scale = timestep_cond["out"].chunk(2, dim=1)
         hidden_states = self.norm_out(hidden_states) * (1 + scale[:, None]) + shift[:, None]
         if return_all_hidden_states:
             return self.proj_out_2(hidden_states), all_hidden_states
@@ -349,15 +463,19 @@ class SelfAttentionTransformer(ModelMixin):
         self,
         hidden_states: torch.Tensor,  # Shape: (B, T, D)
         return_all_hidden_states: bool = False,
+        attention_mask: Optional[torch.Tensor] = None,  # Shape: (B, T), True for valid tokens
+        position_offset: int = 0,
     ):
 
         # Process through transformer blocks - single pass through the blocks
         hidden_states = hidden_states.contiguous()
         all_hidden_states = [hidden_states]
+        if attention_mask is not None:
+            attention_mask = attention_mask.bool().unsqueeze(1)
 
         # Process through transformer blocks
         for idx, block in enumerate(self.transformer_blocks):
-            hidden_states = block(hidden_states)
+            hidden_states = block(hidden_states, attention_mask=attention_mask, position_offset=position_offset)
             all_hidden_states.append(hidden_states)
 
         if return_all_hidden_states:
@@ -1,6 +1,9 @@
+from collections import OrderedDict
 from dataclasses import dataclass, field
+import json
 from pydantic import BaseModel, Field
 from pathlib import Path
+import time
 
 import yaml
 import numpy as np
@@ -9,9 +12,11 @@ import torch.nn.functional as F
 from einops import rearrange
 from torch import nn
 from torch.distributions import Beta
-from transformers import SiglipVisionModel, AutoModel
+import transformers
+from transformers import SiglipVisionConfig, SiglipVisionModel, AutoConfig, AutoImageProcessor, AutoModel
 
 from .modules import DiT, DiTConfig, SelfAttentionTransformer, SelfAttentionTransformerConfig
+from .solvers import get_ode_solver, make_time_grid
 
 _PAD_TOKEN = 0
 _IMG_TOKEN = 1
@@ -22,6 +27,39 @@ _ACT_TOKEN = 4
 _GAME_ID_TOKEN = 6
 
 
+def load_vision_encoder_config(name, config_dict=None):
+    """
+    Architecture config of the vision encoder `name`, without its weights: built from
+    `config_dict` (see checkpoint_vision_configs) when given, else fetched from the hub or
+    the local HF cache.
+    """
+    if "siglip" in name:
+        if config_dict is not None:
+            return SiglipVisionConfig.from_dict(config_dict)
+        return SiglipVisionConfig.from_pretrained(name)
+    if config_dict is not None:
+        return AutoConfig.for_model(**config_dict)
+    return AutoConfig.from_pretrained(name)
+
+
+def load_image_processor(name, config_dict=None):
+    """Image processor of the vision encoder `name`, from `config_dict` or the hub as in load_vision_encoder_config."""
+    if config_dict is not None:
+        return getattr(transformers, config_dict["image_processor_type"]).from_dict(config_dict)
+    return AutoImageProcessor.from_pretrained(name, use_fast=True)
+
+
+def checkpoint_vision_configs(name):
+    """
+    The vision encoder and image processor configs of `name` as plain dicts, to store in a
+    checkpoint so that loading it needs no network access.
+    """
+    return {
+        "vision_encoder_config": load_vision_encoder_config(name).to_dict(),
+        "image_processor_config": json.loads(load_image_processor(name).to_json_string()),
+    }
+
+
 class NitroGen_Config(BaseModel):
     model_type: str = Field(default="nitrogen", frozen=True)
 
@@ -38,6 +76,9 @@ class NitroGen_Config(BaseModel):
     noise_s: float = Field(default=0.999, description="Flow matching noise Beta distribution s.")
     num_timestep_buckets: int = Field(default=1000, description="Number of timestep discretization buckets.")
     num_inference_timesteps: int = Field(default=None, description="Number of inference steps for noise diffusion.")
+    ode_solver: str = Field(default="euler", description="ODE solver for sampling: euler, heun (rk2) or rk4.")
+    time_grid: str = Field(default="uniform", description="Time grid for sampling: uniform, cosine or quadratic.")
+    strip_vl_padding: bool = Field(default=False, description="Drop VL padding tokens and mask the rest when sampling.")
     max_num_embodiments: int = Field(default=1, description="Number of embodiments.")
     vision_encoder_name: str = Field(default="google/siglip-large-patch16-256", description="Vision encoder name.")
     vision_hidden_size: int = Field(default=768, description="Siglip hidden size.")
@@ -100,6 +141,34 @@ class SinusoidalPositionalEncoding(nn.Module):
 
 
 
+def group_categories(cat_ids, num_categories):
+    """
+    Split a batch by category: a list of (category, rows) where `rows` is the boolean
+    mask of the batch items of that category, or None when it covers the whole batch.
+    With a single category this does not look at `cat_ids`, otherwise it reads them on
+    the host once, so modules compute the groups once and share them between layers.
+    """
+    if num_categories == 1:
+        return [(0, None)]
+    cat_list = cat_ids.tolist()
+    if len(set(cat_list)) == 1:
+        return [(cat_list[0], None)]
+    return [(cat_id, cat_ids == cat_id) for cat_id in sorted(set(cat_list))]
+
+
+def apply_by_category(layer_for_category, x, groups):
+    """Apply the layer of each category to its rows of `x` and reassemble the batch."""
+    out = None
+    for cat_id, rows in groups:
+        if rows is None:
+            return layer_for_category(cat_id, x)
+        y = layer_for_category(cat_id, x[rows])
+        if out is None:
+            out = y.new_empty((x.shape[0], *y.shape[1:]))
+        out[rows] = y
+    return out
+
+
 class CategorySpecificLinear(nn.Module):
     def __init__(self, num_categories, input_dim, hidden_dim):
         super().__init__()
@@ -108,10 +177,12 @@ class CategorySpecificLinear(nn.Module):
         self.W = nn.Parameter(0.02 * torch.randn(num_categories, input_dim, hidden_dim))
         self.b = nn.Parameter(torch.zeros(num_categories, hidden_dim))
 
-    def forward(self, x, cat_ids):
-        selected_W = self.W[cat_ids]
-        selected_b = self.b[cat_ids]
-        return torch.bmm(x, selected_W) + selected_b.unsqueeze(1)
+    def forward(self, x, cat_ids, groups=None):
+        # One plain linear per category present in the batch, instead of gathering a
+        # (B, input_dim, hidden_dim) weight copy for a bmm
+        if groups is None:
+            groups = group_categories(cat_ids, self.num_categories)
+        return apply_by_category(lambda cat_id, x: F.linear(x, self.W[cat_id].t(), self.b[cat_id]), x, groups)
 
 
 class CategorySpecificMLP(nn.Module):
@@ -122,8 +193,9 @@ class CategorySpecificMLP(nn.Module):
         self.layer2 = CategorySpecificLinear(num_categories, hidden_dim, output_dim)
 
     def forward(self, x, cat_ids):
-        hidden = F.relu(self.layer1(x, cat_ids))
-        return self.layer2(hidden, cat_ids)
+        groups = group_categories(cat_ids, self.num_categories)
+        hidden = F.relu(self.layer1(x, cat_ids, groups=groups))
+        return self.layer2(hidden, cat_ids, groups=groups)
 
 
 class MultiEmbodimentActionEncoder(nn.Module):
@@ -138,11 +210,13 @@ class MultiEmbodimentActionEncoder(nn.Module):
         self.W3 = CategorySpecificLinear(num_embodiments, hidden_size, hidden_size)  # (w -> w)
         self.pos_encoding = SinusoidalPositionalEncoding(hidden_size)
 
-    def forward(self, actions, timesteps, cat_ids):
+    def forward(self, actions, timesteps, cat_ids, tau_emb=None):
         """
         actions:   shape (B, T, action_dim)
         timesteps: shape (B,)  -- a single scalar per batch item
         cat_ids:   shape (B,)
+        tau_emb:   optional precomputed pos_encoding of the timesteps, shape (B, w) or (1, w);
+                   `timesteps` is ignored when it is given
         returns:   shape (B, T, hidden_size)
         """
         B, T, _ = actions.shape
@@ -150,7 +224,9 @@ class MultiEmbodimentActionEncoder(nn.Module):
         # 1) Expand each batch's single scalar time 'tau' across all T steps
         #    so that shape => (B, T)
         #    e.g. if timesteps is (B,), replicate across T
-        if timesteps.dim() == 1 and timesteps.shape[0] == B:
+        if tau_emb is not None:
+            pass
+        elif timesteps.dim() == 1 and timesteps.shape[0] == B:
             # shape (B,) => (B,T)
             timesteps = timesteps.unsqueeze(1).expand(-1, T)
         else:
@@ -159,17 +235,21 @@ class MultiEmbodimentActionEncoder(nn.Module):
             )
 
         # 2) Standard action MLP step for shape => (B, T, w)
-        a_emb = self.W1(actions, cat_ids)
+        groups = group_categories(cat_ids, self.num_embodiments)
+        a_emb = self.W1(actions, cat_ids, groups=groups)
 
         # 3) Get the sinusoidal encoding (B, T, w)
-        tau_emb = self.pos_encoding(timesteps).to(dtype=a_emb.dtype)
+        if tau_emb is not None:
+            tau_emb = tau_emb.unsqueeze(1).expand(B, T, -1).to(dtype=a_emb.dtype)
+        else:
+            tau_emb = self.pos_encoding(timesteps).to(dtype=a_emb.dtype)
 
         # 4) Concat along last dim => (B, T, 2w), then W2 => (B, T, w), swish
         x = torch.cat([a_emb, tau_emb], dim=-1)
-        x = swish(self.W2(x, cat_ids))
+        x = swish(self.W2(x, cat_ids, groups=groups))
 
         # 5) Finally W3 => (B, T, w)
-        x = self.W3(x, cat_ids)
+        x = self.W3(x, cat_ids, groups=groups)
         return x
 
 
@@ -181,26 +261,47 @@ class NitroGen(torch.nn.Module):
         self,
         config: NitroGen_Config,
         game_mapping: dict[str, int] | None = None, # Used to add a game ID token
+        vision_encoder_config=None, # Build the vision encoder from this config, without pretrained weights
     ):
         super().__init__()
         self.config = config
         self.hidden_size = config.hidden_size
         self.vision_hidden_size = config.vision_hidden_size
 
+        # With a vision_encoder_config, the weights come from a NitroGen checkpoint later on
         if "siglip" in config.vision_encoder_name:
-            model = SiglipVisionModel.from_pretrained(config.vision_encoder_name)
+            if vision_encoder_config is not None:
+                model = SiglipVisionModel(vision_encoder_config)
+            else:
+                model = SiglipVisionModel.from_pretrained(config.vision_encoder_name)
             self.vision_encoder = model.vision_model
             self.vision_encoder_type = "siglip"
         else:
-            self.vision_encoder = AutoModel.from_pretrained(config.vision_encoder_name)
+            if vision_encoder_config is not None:
+                self.vision_encoder = AutoModel.from_config(vision_encoder_config)
+            else:
+                self.vision_encoder = AutoModel.from_pretrained(config.vision_encoder_name)
             self.vision_encoder_type = "hf_auto"
-        self.beta_dist = Beta(config.noise_beta_alpha, config.noise_beta_beta)
+        # Beta validates its parameters with .item(): keep it on CPU when the model is built
+        # under torch.device("meta") (see load_model)
+        with torch.device("cpu"):
+            self.beta_dist = Beta(config.noise_beta_alpha, config.noise_beta_beta)
         self.num_timestep_buckets = config.num_timestep_buckets
         # self.model = instantiate(config.diffusion_model_cfg)
         self.model = DiT(config=config.diffusion_model_cfg)
         self.action_dim = config.action_dim
         self.action_horizon = config.action_horizon
         self.num_inference_timesteps = config.num_inference_timesteps
+        self.ode_solver = config.ode_solver
+        self.time_grid = config.time_grid
+        self.strip_vl_padding = config.strip_vl_padding
+        # Token assembly plans by token layout, least recently used first, see token_assembly_plan
+        self._token_assembly_plans = OrderedDict()
+        self.max_token_assembly_plans = 64
+        # Check the token layout on every assembly, this forces host syncs
+        self.validate_token_layout = False
+        # Timestep-only tensors for the sampler, see build_timestep_tables
+        self.timestep_tables = None
 
         # self.vl_self_attention_model = instantiate(config.vl_self_attention_cfg)
         self.vl_self_attention_model = SelfAttentionTransformer(config=config.vl_self_attention_cfg)
@@ -364,12 +465,22 @@ class NitroGen(torch.nn.Module):
         sample = self.beta_dist.sample([batch_size]).to(device, dtype=dtype)
         return (1 - sample) * self.config.noise_s
 
-    def encode_images(self, images): #, view_ids):
+    def encode_images(self, images, dropped_images=None): #, view_ids):
         batch_size, num_frames, channels, height, width = images.shape
-        images = images.reshape(-1, channels, height, width)
 
-        image_features = self.vision_encoder(images)["last_hidden_state"]
-        image_features = rearrange(image_features, "(b f) n d -> b f n d", f=num_frames)
+        if dropped_images is None:
+            images = images.reshape(-1, channels, height, width)
+            image_features = self.vision_encoder(images)["last_hidden_state"]
+            image_features = rearrange(image_features, "(b f) n d -> b f n d", f=num_frames)
+        else:
+            # Only run the vision encoder on live frames. Dropped (and padding) frames are
+            # left as zeros: prepare_vl_embs never places their tokens.
+            live_mask = dropped_images == 0  # [B, F]
+            live_features = self.vision_encoder(images[live_mask])["last_hidden_state"]
+            image_features = live_features.new_zeros(
+                (batch_size, num_frames, *live_features.shape[1:])
+            )
+            image_features[live_mask] = live_features
 
         # if self.vision_projector is not None:
         #     # change the hidden dimension of the vision features
@@ -378,71 +489,168 @@ class NitroGen(torch.nn.Module):
             image_features = self.mm_projector(image_features)  # [B, 256, 1024] -> [B, 16, 1024]
         return image_features
 
-    def prepare_input_embs(self, vl_token_ids, sa_token_ids, vision, action, dropped_images, game_ids=None):
-        B, T = vl_token_ids.shape
-        vl_embs = torch.full(
-            size=(B, T, self.vision_hidden_size), fill_value=0.0, dtype=vision.dtype, device=vision.device
+    def get_visual_features(self, data: dict, dropped_images=None):
+        """
+        Return per-frame vision features of shape [B, F, tokens_per_image, D].
+        Callers that cache features across requests (see InferenceSession) pass them
+        as `image_features`; otherwise the live frames are run through the vision encoder.
+        `dropped_images` defaults to the input's own dropped-frame mask.
+        """
+        if data.get("image_features") is not None:
+            return data["image_features"]
+        if data.get("images") is None:
+            raise ValueError("Expected `images` or `image_features` in the model inputs")
+        if dropped_images is None:
+            dropped_images = data.get("dropped_images")
+        return self.encode_images(data["images"], dropped_images)
+
+    @staticmethod
+    def _frame_tensor(*inputs: dict) -> torch.Tensor:
+        """
+        The frames (or cached features) of the first input that has any, which give the
+        batch size, device and dtype of the sampled actions.
+        """
+        for data in inputs:
+            for key in ["images", "image_features"]:
+                if data.get(key) is not None:
+                    return data[key]
+        raise ValueError("Expected `images` or `image_features` in the model inputs")
+
+    @staticmethod
+    def _shares_frames(data_cond: dict, data_uncond: dict) -> bool:
+        """
+        True when the uncond input is built from the same frame tensor (or cached features)
+        as the cond input, either by passing the same object or by leaving the frames out.
+        """
+        uncond_has_frames = any(data_uncond.get(key) is not None for key in ["image_features", "images"])
+        for key in ["image_features", "images"]:
+            if data_cond.get(key) is not None:
+                if data_uncond.get(key) is not None:
+                    return data_uncond[key] is data_cond[key]
+                return not uncond_has_frames
+        return False
+
+    def token_assembly_plan(self, vl_token_ids, sa_token_ids, dropped_images, tokens_per_image, layout_key=None):
+        """
+        Work out where every input lands in the VL and state-action token sequences:
+        for each position, the index of the vision token (in the flattened per-frame
+        features) or action token it takes, and masks of the image, game, separator and
+        action positions. Everything is computed with device ops, without host syncs.
+
+        The plan only depends on the token layout, so callers that know it on the host
+        (context length, dropped-frame pattern, game-token presence; see InferenceSession)
+        pass it as `layout_key` and the plan is cached on the model. Batches combine the
+        layouts of their sessions, so only the max_token_assembly_plans most recently used
+        plans are kept.
+        """
+        if self.validate_token_layout:
+            self._validate_token_layout(vl_token_ids, dropped_images, tokens_per_image)
+        if layout_key is not None:
+            cache_key = (
+                layout_key,
+                vl_token_ids.shape,
+                None if sa_token_ids is None else sa_token_ids.shape,
+                tokens_per_image,
+                vl_token_ids.device,
+            )
+            plan = self._token_assembly_plans.get(cache_key)
+            if plan is not None:
+                # Single OrderedDict calls are atomic, a concurrent eviction at worst drops the plan
+                try:
+                    self._token_assembly_plans.move_to_end(cache_key)
+                except KeyError:
+                    pass
+                return plan
+
+        plan = self._vl_assembly_plan(vl_token_ids, dropped_images, tokens_per_image)
+        if sa_token_ids is not None:
+            plan.update(self._sa_assembly_plan(sa_token_ids))
+        if layout_key is not None:
+            self._token_assembly_plans[cache_key] = plan
+            while len(self._token_assembly_plans) > self.max_token_assembly_plans:
+                try:
+                    self._token_assembly_plans.popitem(last=False)
+                except KeyError:
+                    break
+        return plan
+
+    def _vl_assembly_plan(self, vl_token_ids, dropped_images, tokens_per_image):
+        B = vl_token_ids.shape[0]
+        vision_mask = vl_token_ids == _IMG_TOKEN  # [B, T]
+        # Vision tokens of the live frames, flattened over frames: [B, F * tokens_per_image]
+        live_tokens = (dropped_images == 0).repeat_interleave(tokens_per_image, dim=1)
+        num_vision_tokens = live_tokens.shape[1]
+
+        # The k-th _IMG_TOKEN of a row takes the k-th live vision token of that row
+        live_rank = live_tokens.long().cumsum(dim=1) - 1
+        rank_to_index = torch.zeros((B, num_vision_tokens + 1), dtype=torch.long, device=vl_token_ids.device)
+        rank_to_index.scatter_(
+            1,
+            torch.where(live_tokens, live_rank, num_vision_tokens),  # dropped tokens go to a spare column
+            torch.arange(num_vision_tokens, device=vl_token_ids.device).expand(B, -1),
         )
+        vision_rank = (vision_mask.long().cumsum(dim=1) - 1).clamp(min=0)
 
-        # Extract dimensions from vision tensor
-        B, num_images, tokens_per_image, hidden_size = vision.shape
-
-        # Create mask for _IMG_TOKEN positions
-        vision_mask = (vl_token_ids == _IMG_TOKEN)  # [B, T]
+        return {
+            "vision_index": rank_to_index.gather(1, vision_rank),
+            "vision_mask": vision_mask.unsqueeze(-1),
+            "game_mask": (vl_token_ids == _GAME_ID_TOKEN).unsqueeze(-1),
+            "sep_mask": (vl_token_ids == _IMG_SEP_TOKEN).unsqueeze(-1),
+        }
 
-        #  Flatten vision tensor over the num_images dimension
-        vision_flat = vision.reshape(B, -1, self.vision_hidden_size)  # [B, T * tokens_per_image, hidden_size]
+    def _sa_assembly_plan(self, sa_token_ids):
+        # The k-th _ACT_TOKEN of a row takes the k-th action
+        action_mask = sa_token_ids == _ACT_TOKEN
+        return {
+            "action_index": (action_mask.long().cumsum(dim=1) - 1).clamp(min=0),
+            "action_mask": action_mask.unsqueeze(-1),
+        }
 
-        # Create a mask for the flattened vision dimension
-        # Each image contributes tokens_per_image tokens, so expand the mask accordingly
-        non_dropped_mask_expanded = (dropped_images == 0).unsqueeze(-1).repeat(1, 1, tokens_per_image).reshape(B, -1)  # [B, T * tokens_per_image]
+    def _validate_token_layout(self, vl_token_ids, dropped_images, tokens_per_image):
+        """The layout checks of the assembly, which need host syncs: only run with validate_token_layout."""
+        num_vision_tokens = (vl_token_ids == _IMG_TOKEN).sum(dim=1)
+        num_live_tokens = (dropped_images == 0).sum(dim=1) * tokens_per_image
+        assert torch.equal(num_vision_tokens, num_live_tokens), (
+            f"Number of valid vision embeddings {num_live_tokens.tolist()} does not match "
+            f"the number of _IMG_TOKEN positions {num_vision_tokens.tolist()}"
+        )
 
-        # Select only non-dropped vision embeddings
-        # This will give us the embeddings we need to place
-        valid_vision_embs = vision_flat[non_dropped_mask_expanded]  # [total_valid_tokens, 1152]
+        game_tokens_per_batch = (vl_token_ids == _GAME_ID_TOKEN).sum(dim=1)  # [B]
+        if game_tokens_per_batch.sum().item() > 0:
+            assert torch.all(game_tokens_per_batch == 1), (
+                f"Expected exactly 1 game token per batch item, but got: {game_tokens_per_batch.tolist()}. "
+                f"Each batch item must have exactly one _GAME_ID_TOKEN."
+            )
 
-        assert valid_vision_embs.shape[0] == vision_mask.sum().item(), (
-            f"Number of valid vision embeddings {valid_vision_embs.shape[0]} does not match "
-            f"the number of _IMG_TOKEN positions {vision_mask.sum().item()}"
-        )
-        # Now we need to place these at the vision_mask positions
-        # Get indices where vision_mask is True
-        batch_indices, token_indices = vision_mask.nonzero(as_tuple=True)
+    def prepare_vl_embs(self, vl_token_ids, vision, dropped_images, game_ids=None, plan=None):
+        """
+        Place the vision features, game embedding and separators at their VL positions.
+        `plan` comes from token_assembly_plan and is built here when missing.
+        """
+        B, num_images, tokens_per_image, hidden_size = vision.shape
+        if plan is None:
+            plan = self.token_assembly_plan(vl_token_ids, None, dropped_images, tokens_per_image)
 
-        # Place the valid embeddings at the masked positions
-        vl_embs[batch_indices, token_indices] = valid_vision_embs
+        #  Flatten vision tensor over the num_images dimension
+        vision_flat = vision.reshape(B, -1, self.vision_hidden_size)  # [B, num_images * tokens_per_image, hidden_size]
+        vision_index = plan["vision_index"].unsqueeze(-1).expand(-1, -1, self.vision_hidden_size)
+        vl_embs = torch.where(plan["vision_mask"], vision_flat.gather(1, vision_index), 0.0)
 
         # Handle Game ID tokens
         if self.game_mapping is not None and game_ids is not None:
-            game_mask = vl_token_ids == _GAME_ID_TOKEN  # shape: (B, T)
-            num_game_tokens = game_mask.sum().item()
-            if num_game_tokens > 0:
-
-                # Assert that each batch item has exactly one game token
-                game_tokens_per_batch = game_mask.sum(dim=1)  # [B] - count of game tokens per batch item
-                assert torch.all(game_tokens_per_batch == 1), (
-                    f"Expected exactly 1 game token per batch item, but got: {game_tokens_per_batch.tolist()}. "
-                    f"Each batch item must have exactly one _GAME_ID_TOKEN."
-                )
-                
-                # Get game embeddings for each batch item
-                game_embs = self.game_embedding(game_ids)  # [B, vision_hidden_size]
-                batch_indices, token_indices = game_mask.nonzero(as_tuple=True)
-                vl_embs[batch_indices, token_indices] = game_embs[batch_indices].to(dtype=vl_embs.dtype)
+            game_embs = self.game_embedding(game_ids)  # [B, vision_hidden_size]
+            vl_embs = torch.where(plan["game_mask"], game_embs.unsqueeze(1).to(dtype=vl_embs.dtype), vl_embs)
 
         # Project image separator using the learnable sep_embedding.
-        sep_mask = vl_token_ids == _IMG_SEP_TOKEN  # shape: (B, T)
-        num_sep = sep_mask.sum().item()
-        if num_sep > 0:
-            # Expand the separator embedding for each occurrence.
-            repeated_sep = self.vis_sep_embedding.unsqueeze(0).expand(num_sep, self.hidden_size)
-            # Assign the separator embeddings to the correct positions.
-            vl_embs[sep_mask] = repeated_sep.to(dtype=vl_embs.dtype)
+        if getattr(self, "vis_sep_embedding", None) is not None:
+            vl_embs = torch.where(plan["sep_mask"], self.vis_sep_embedding.to(dtype=vl_embs.dtype), vl_embs)
 
+        return vl_embs
+
+    def prepare_sa_embs(self, sa_token_ids, action, plan=None):
         B, T = sa_token_ids.shape
-        sa_embs = torch.full(
-            size=(B, T, self.hidden_size), fill_value=0.0, dtype=action.dtype, device=vision.device
-        )
+        if plan is None:
+            plan = self._sa_assembly_plan(sa_token_ids)
 
         # Project state.
         # state_mask = sa_token_ids == _PROPRIO_TOKEN
@@ -450,18 +658,87 @@ class NitroGen(torch.nn.Module):
         # sa_embs = sa_embs.masked_scatter(state_mask, state)
 
         # Project action.
-        action_mask = sa_token_ids == _ACT_TOKEN
-        action_mask = action_mask.unsqueeze(-1).expand_as(sa_embs)
-        sa_embs = sa_embs.masked_scatter(action_mask, action)
+        action_index = plan["action_index"].unsqueeze(-1).expand(-1, -1, self.hidden_size)
+        sa_embs = torch.where(plan["action_mask"], action.gather(1, action_index), 0.0)
 
         # Add positional embeddings
-        pos_ids = torch.arange(T, dtype=torch.long, device=sa_token_ids.device)
         if self.config.add_pos_embed:
-            pos_embs = self.position_embedding(pos_ids)  # (T, hidden_size)
+            # Same as position_embedding(arange(T)), without building the ids on every step
+            pos_embs = self.position_embedding.weight[:T]  # (T, hidden_size)
             pos_embs = pos_embs.unsqueeze(0).expand(B, T, self.hidden_size)
             sa_embs = sa_embs + pos_embs
+        return sa_embs
+
+    def prepare_input_embs(self, vl_token_ids, sa_token_ids, vision, action, dropped_images, game_ids=None, plan=None):
+        if plan is None:
+            plan = self.token_assembly_plan(vl_token_ids, sa_token_ids, dropped_images, vision.shape[2])
+        vl_embs = self.prepare_vl_embs(vl_token_ids, vision, dropped_images, game_ids=game_ids, plan=plan)
+        sa_embs = self.prepare_sa_embs(sa_token_ids, action, plan=plan)
         return vl_embs, sa_embs
 
+    def encode_vl_context(
+        self, vl_token_ids, visual_features, dropped_images, game_ids=None, vl_attn_mask=None, plan=None
+    ):
+        """
+        Build and mix the vision-language tokens. They do not depend on the noisy
+        actions, so samplers call this once per request instead of once per step.
+
+        Without `vl_attn_mask`, every token, padding included, is mixed and attended to, as
+        in training. With it, the leading columns that are padding in every batch item are
+        dropped, the remaining padding is masked out of the attention, and tokens keep
+        their original positions. Returns the VL embeddings and the mask the DiT has to
+        apply to them (None when nothing is masked).
+        """
+        vl_embs = self.prepare_vl_embs(vl_token_ids, visual_features, dropped_images, game_ids=game_ids, plan=plan)
+        if vl_attn_mask is None:
+            return self.vl_self_attention_model(vl_embs), None
+
+        # The tokenizer left-pads: keep everything from the first column valid in any item
+        vl_attn_mask = vl_attn_mask.bool()
+        offset = int(vl_attn_mask.any(dim=0).int().argmax())
+        vl_embs = vl_embs[:, offset:]
+        vl_attn_mask = vl_attn_mask[:, offset:]
+        if bool(vl_attn_mask.all()):
+            vl_attn_mask = None
+        vl_embs = self.vl_self_attention_model(vl_embs, attention_mask=vl_attn_mask, position_offset=offset)
+        return vl_embs, vl_attn_mask
+
+    def predict_velocity(
+        self,
+        action_features,
+        t_discretized,
+        vl_embs,
+        vl_attn_mask,
+        sa_token_ids,
+        embodiment_id,
+        encoder_kv_cache=None,
+        timestep_cond=None,
+        plan=None,
+    ):
+        """
+        Run the DiT on the action tokens against a precomputed VL context.
+        `encoder_kv_cache` comes from `self.model.precompute_encoder_kv(vl_embs)`; with it,
+        each step only projects the action-token queries in the cross-attention blocks.
+        `timestep_cond` is a row of the timestep tables (see timestep_cond); `t_discretized`
+        is only encoded when it is missing.
+        `vl_attn_mask` is the mask returned by encode_vl_context, None attends to every VL token.
+        `plan` is the token assembly plan of the request (see token_assembly_plan).
+        """
+        sa_embs = self.prepare_sa_embs(sa_token_ids, action_features, plan=plan)
+        timesteps = None
+        if timestep_cond is None:
+            timesteps = torch.from_numpy(np.array([t_discretized])).to(sa_embs.device).long()
+        model_output = self.model(
+            hidden_states=sa_embs,
+            encoder_hidden_states=vl_embs,
+            encoder_attention_mask=vl_attn_mask,
+            timestep=timesteps,
+            encoder_kv_cache=encoder_kv_cache,
+            timestep_cond=timestep_cond,
+        )
+        pred = self.action_decoder(model_output, embodiment_id)
+        return pred[:, -self.action_horizon :]
+
     def pack_actions(self, buttons, j_left, j_right):
         # Check that the first three dims of each input is the same
         assert buttons.shape[:3] == j_left.shape[:3] == j_right.shape[:3], (
@@ -546,10 +823,11 @@ class NitroGen(torch.nn.Module):
 
         vl_embs = self.vl_self_attention_model(vl_embs)
         # vl_embs = self.qformer(vl_embs)
+        # The model is trained attending to the VL padding: vl_attn_mask is not applied
         model_output, all_hidden_states = self.model(
             hidden_states=sa_embs,
             encoder_hidden_states=vl_embs,
-            encoder_attention_mask=data["vl_attn_mask"],
+            encoder_attention_mask=None,
             timestep=t_discretized,
             return_all_hidden_states=True,
         )
@@ -570,83 +848,267 @@ class NitroGen(torch.nn.Module):
             "loss": loss,
         }
 
+    def discretize_time(self, t_cont: float) -> int:
+        """Map continuous time in [0,1] to a timestep bucket, as seen during training."""
+        return min(int(t_cont * self.num_timestep_buckets), self.num_timestep_buckets - 1)
+
+    def schedule_buckets(self, num_steps=None, ode_solver=None, time_grid=None, t_start=0.0) -> list[int]:
+        """
+        Timestep buckets at which the sampler evaluates the velocity for a given schedule,
+        including the intermediate times of multi-stage solvers. Arguments left to None
+        fall back to the model defaults; `t_start` is the start time of a warm start.
+        """
+        num_steps = num_steps if num_steps is not None else self.num_inference_timesteps
+        step_fn = get_ode_solver(ode_solver if ode_solver is not None else self.ode_solver)
+        grid = make_time_grid(num_steps, time_grid if time_grid is not None else self.time_grid, t_start)
+
+        buckets = set()
+
+        def record_time(x, t):
+            buckets.add(self.discretize_time(t))
+            return 0.0
+
+        for t_cont, t_next in zip(grid[:-1], grid[1:]):
+            step_fn(record_time, 0.0, t_cont, t_next)
+        return sorted(buckets)
+
+    @torch.inference_mode()
+    def build_timestep_tables(self, num_steps=None, ode_solver=None, time_grid=None, t_start=0.0):
+        """
+        Precompute, on the model's device, everything the denoising loop derives from the
+        timestep alone: the action encoder's sinusoidal encoding and the DiT's timestep
+        embedding and modulations (see DiT.precompute_timestep_cond). The tables hold one row
+        per bucket of the schedule and are extended when a later call uses new buckets.
+        Loaders call this once with the serving schedule; the samplers call it per request,
+        which is a no-op once the schedule is covered.
+        """
+        buckets = self.schedule_buckets(num_steps, ode_solver, time_grid, t_start)
+        tables = self.timestep_tables
+        device, dtype = self.device, self.dtype
+        if tables is not None and tables["temb"].device == device and tables["temb"].dtype == dtype:
+            if all(bucket in tables["rows"] for bucket in buckets):
+                return tables
+            # Keep the rows already computed, so that the row of a bucket never changes
+            buckets = list(tables["rows"]) + [bucket for bucket in buckets if bucket not in tables["rows"]]
+
+        timesteps = torch.tensor(buckets, dtype=torch.long, device=device)
+        tables = self.model.precompute_timestep_cond(timesteps)
+        tables["tau"] = self.action_encoder.pos_encoding(timesteps[:, None])[:, 0].to(dtype)
+        tables["rows"] = {bucket: row for row, bucket in enumerate(buckets)}
+        self.timestep_tables = tables
+        return tables
+
+    def timestep_cond(self, tables, t_discretized: int):
+        """Row of the timestep tables for one bucket, with a batch dimension of 1 that broadcasts."""
+        row = tables["rows"][t_discretized]
+        return {
+            "temb": tables["temb"][row : row + 1],
+            "blocks": [None if emb is None else emb[row : row + 1] for emb in tables["blocks"]],
+            "out": tables["out"][row : row + 1],
+            "tau": tables["tau"][row : row + 1],
+        }
+
+    def integrate(
+        self,
+        velocity_fn,
+        actions,
+        num_steps=None,
+        ode_solver=None,
+        time_grid=None,
+        tolerance=None,
+        deadline=None,
+        t_start=0.0,
+    ):
+        """
+        Integrate dx/dt = velocity_fn(x, t) from t=`t_start` (0 unless warm starting) to t=1
+        with the given solver and time grid. Arguments left to None fall back to the model
+        defaults (see NitroGen_Config).
+
+        Integration stops early when the relative change of the velocity between two steps
+        falls below `tolerance`, or when the next step would end after `deadline` (a
+        time.perf_counter() timestamp). The remaining interval is then covered with a single
+        jump along the last velocity, which is exact once the flow has straightened out.
+
+        Returns the actions and the number of solver steps that ran.
+        """
+        num_steps = num_steps if num_steps is not None else self.num_inference_timesteps
+        step_fn = get_ode_solver(ode_solver if ode_solver is not None else self.ode_solver)
+        grid = make_time_grid(num_steps, time_grid if time_grid is not None else self.time_grid, t_start)
+
+        if tolerance is None and deadline is None:
+            for t_cont, t_next in zip(grid[:-1], grid[1:]):
+                actions = step_fn(velocity_fn, actions, t_cont, t_next)
+            return actions, num_steps
+
+        velocities = []
+
+        def tracked_velocity_fn(x, t):
+            velocity = velocity_fn(x, t)
+            velocities.append(velocity)
+            return velocity
+
+        prev_velocity = None
+        step_times = []
+        for i, (t_cont, t_next) in enumerate(zip(grid[:-1], grid[1:])):
+            if deadline is not None and step_times:
+                # Leave room for one more step of average duration
+                if time.perf_counter() + sum(step_times) / len(step_times) > deadline:
+                    break
+
+            step_start = time.perf_counter()
+            velocities.clear()
+            actions = step_fn(tracked_velocity_fn, actions, t_cont, t_next)
+            if deadline is not None:
+                if actions.is_cuda:
+                    torch.cuda.synchronize(actions.device)
+                step_times.append(time.perf_counter() - step_start)
+
+            # Velocity at the start of the step, comparable across solvers
+            velocity = velocities[0].float()
+            last_velocity = velocities[-1]
+            if tolerance is not None and prev_velocity is not None:
+                change = (velocity - prev_velocity).norm() / prev_velocity.norm().clamp_min(1e-6)
+                if change.item() < tolerance:
+                    i += 1
+                    break
+            prev_velocity = velocity
+        else:
+            return actions, num_steps
+
+        # Stopped early: jump straight to t=1 along the last velocity
+        actions = actions + (1.0 - grid[i]) * last_velocity
+        return actions, i
+
+    @staticmethod
+    def init_noisy_actions(noise, init_actions=None, t_start=0.0):
+        """
+        Starting point of the sampler. Cold start: pure noise at t=0. Warm start: an earlier
+        estimate of the actions (e.g. the previous chunk shifted in time) re-noised to
+        `t_start` along the training path, (1 - t) * noise + t * actions, from where the
+        sampler only integrates over [t_start, 1].
+        """
+        if init_actions is None:
+            return noise
+        return (1.0 - t_start) * noise + t_start * init_actions.to(device=noise.device, dtype=noise.dtype)
+
     @torch.inference_mode()
-    def get_action(self, data: dict, old_layout:bool = False) -> dict:
+    def get_action(
+        self,
+        data: dict,
+        old_layout: bool = False,
+        num_steps: int | None = None,
+        ode_solver: str | None = None,
+        time_grid: str | None = None,
+        tolerance: float | None = None,
+        deadline: float | None = None,
+        strip_vl_padding: bool | None = None,
+        init_actions: torch.Tensor | None = None,
+        t_start: float = 0.0,
+    ) -> dict:
         """
         For i in [0..N-1]:
-          1) t = i/N
-          2) velocity = model(x(t), t)
-          3) x(t + dt) = x(t) + dt * velocity
+          1) t_i, t_{i+1} = time_grid[i], time_grid[i+1]  (uniform grid: t_i = i/N)
+          2) velocity = model(x(t), t) at the points the solver asks for
+          3) x(t_{i+1}) = solver step from x(t_i)  (Euler: x(t_i) + (t_{i+1} - t_i) * velocity)
+        With a tolerance or a deadline the loop may stop early (see integrate); the number of
+        steps that ran is returned under "num_steps". `strip_vl_padding` (default from the
+        config) drops and masks the VL padding, see encode_vl_context. `init_actions` and
+        `t_start` warm start the sampler, see init_noisy_actions.
         """
 
         # data = action_input
         embodiment_id = data["embodiment_id"]
+        if strip_vl_padding is None:
+            strip_vl_padding = self.strip_vl_padding
 
-        batch_size = data["images"].shape[0]
-        device = data["images"].device
-        dtype = data["images"].dtype
+        frames = self._frame_tensor(data)
+        batch_size, device, dtype = frames.shape[0], frames.device, frames.dtype
         actions = torch.randn(
             size=(batch_size, self.config.action_horizon, self.config.action_dim),
             dtype=dtype,
             device=device,
         )
+        actions = self.init_noisy_actions(actions, init_actions, t_start)
 
-        # 1) Hyperparameters for flow sampling
-        num_steps = self.num_inference_timesteps
-        dt = 1.0 / num_steps
-
-        # 2) Encode static context (images, text, state) once if it does not depend on actions
-        visual_features = self.encode_images(data["images"]) #, data["view_ids"])
+        # 1) Encode static context (images, text, state) once if it does not depend on actions
+        visual_features = self.get_visual_features(data) #, data["view_ids"])
         # text_features = self.siglip_model.text_model(
         #     input_ids=data["lang_input_ids"]
         # ).last_hidden_state
         # state_features = self.state_encoder(data["state"], embodiment_id)
 
-        # 3) Start denoising the actions
-        for i in range(num_steps):
-            # ---- (a) Discretize continuous time in [0,1]
-            t_cont = i / float(num_steps)  # e.g. goes 0, 1/N, 2/N, ...
-            t_discretized = int(t_cont * self.num_timestep_buckets)
+        # 2) Build and mix the VL context once, it does not change across steps
+        plan = self.token_assembly_plan(
+            data["vl_token_ids"],
+            data["sa_token_ids"],
+            data["dropped_images"],
+            visual_features.shape[2],
+            layout_key=data.get("token_layout"),
+        )
+        vl_embs, vl_attn_mask = self.encode_vl_context(
+            data["vl_token_ids"],
+            visual_features,
+            data["dropped_images"],
+            game_ids=data["game_ids"],
+            vl_attn_mask=data["vl_attn_mask"] if strip_vl_padding else None,
+            plan=plan,
+        )
+        # vl_embs = self.qformer(vl_embs)
+        encoder_kv_cache = self.model.precompute_encoder_kv(vl_embs)
+        timestep_tables = self.build_timestep_tables(num_steps, ode_solver, time_grid, t_start)
+
+        def velocity_fn(actions, t_cont):
+            # ---- (a) Discretize continuous time in [0,1] and look up its embeddings
+            t_discretized = self.discretize_time(t_cont)
+            timestep_cond = self.timestep_cond(timestep_tables, t_discretized)
 
-            # ---- (b) Build embeddings (actions included)
-            # Pass the *current* actions at time t into the action encoder
+            # ---- (b) Embed the *current* actions at time t
             action_features = self.action_encoder(
                 actions,
-                (torch.ones(actions.shape[0]) * t_discretized).to(device),
+                None,
                 embodiment_id,
+                tau_emb=timestep_cond["tau"],
             )
-            vl_embs, sa_embs = self.prepare_input_embs(
-                data["vl_token_ids"],
-                data["sa_token_ids"],
-                visual_features,
-                # text_features,
-                # state_features,
-                action_features,
-                data["dropped_images"],
-                game_ids=data["game_ids"],
-            )
-            vl_embs = self.vl_self_attention_model(vl_embs)
-            # vl_embs = self.qformer(vl_embs)
+
             # ---- (c) Forward pass to get velocity = d/dt x(t)
-            timesteps = torch.from_numpy(np.array([t_discretized])).to(device).long()
-            model_output = self.model(
-                hidden_states=sa_embs,
-                encoder_hidden_states=vl_embs,
-                encoder_attention_mask=data["vl_attn_mask"],
-                timestep=timesteps,
+            return self.predict_velocity(
+                action_features,
+                t_discretized,
+                vl_embs,
+                vl_attn_mask,
+                data["sa_token_ids"],
+                embodiment_id,
+                encoder_kv_cache=encoder_kv_cache,
+                timestep_cond=timestep_cond,
+                plan=plan,
             )
-            pred = self.action_decoder(model_output, embodiment_id)
-            pred_velocity = pred[:, -actions.shape[1] :]
 
-            # ---- (d) Naive Euler step: x(t + dt) = x(t) + dt * velocity
-            actions = actions + dt * pred_velocity
+        # 3) Denoise the actions
+        actions, steps_run = self.integrate(
+            velocity_fn, actions, num_steps, ode_solver, time_grid, tolerance=tolerance, deadline=deadline,
+            t_start=t_start,
+        )
 
         return {
             "action_tensor": actions,
+            "num_steps": steps_run,
         }
 
     @torch.inference_mode()
-    def get_action_with_cfg(self, data_cond: dict, data_uncond: dict, cfg_scale: float = 1.0) -> dict:
+    def get_action_with_cfg(
+        self,
+        data_cond: dict,
+        data_uncond: dict,
+        cfg_scale: float = 1.0,
+        num_steps: int | None = None,
+        ode_solver: str | None = None,
+        time_grid: str | None = None,
+        tolerance: float | None = None,
+        deadline: float | None = None,
+        strip_vl_padding: bool | None = None,
+        init_actions: torch.Tensor | None = None,
+        t_start: float = 0.0,
+    ) -> dict:
         """
         Use a form of classifier free guidance to sample actions. This can only be used on
         models that were trained on multiple frames of actions. The idea is that we sample
@@ -657,99 +1119,127 @@ class NitroGen(torch.nn.Module):
         data_without_hist = unconditional input
         
         This function works with any kind of conditioning, not just history.
+        Both inputs must share their sequence lengths: they are stacked into one batch.
 
         For i in [0..N-1]:
-          1) t = i/N
+          1) t_i, t_{i+1} = time_grid[i], time_grid[i+1]  (uniform grid: t_i = i/N)
           2) velocity = (1 - cfg_scale) * model(x(t), t, None) + cfg_scale * model(x(t), t, history)
-          3) x(t + dt) = x(t) + dt * velocity
+          3) x(t_{i+1}) = solver step from x(t_i)  (Euler: x(t_i) + (t_{i+1} - t_i) * velocity)
+        With a tolerance or a deadline the loop may stop early (see integrate); the number of
+        steps that ran is returned under "num_steps". `strip_vl_padding` (default from the
+        config) drops and masks the VL padding, see encode_vl_context. `init_actions` and
+        `t_start` warm start the sampler, see init_noisy_actions.
         """
 
         # data = action_input
         embodiment_id = data_cond["embodiment_id"]
+        if strip_vl_padding is None:
+            strip_vl_padding = self.strip_vl_padding
 
-        batch_size = data_cond["images"].shape[0]
-        device = data_cond["images"].device
-        dtype = data_cond["images"].dtype
+        frames = self._frame_tensor(data_cond, data_uncond)
+        batch_size, device, dtype = frames.shape[0], frames.device, frames.dtype
         actions = torch.randn(
             size=(batch_size, self.config.action_horizon, self.config.action_dim),
             dtype=dtype,
             device=device,
         )
+        actions = self.init_noisy_actions(actions, init_actions, t_start)
 
-        # 1) Hyperparameters for flow sampling
-        num_steps = self.num_inference_timesteps
-        dt = 1.0 / num_steps
-
-        # 2) Encode static context (images, text, state) once if it does not depend on actions
-        visual_features_cond = self.encode_images(data_cond["images"])
-        visual_features_uncond = self.encode_images(data_uncond["images"])
+        # Stack the cond and uncond inputs into a single batch of 2B: every step then runs
+        # one forward pass, and the velocity is split back into its two halves.
+        data = {
+            key: torch.cat([data_cond[key], data_uncond[key]], dim=0)
+            for key in ["vl_token_ids", "sa_token_ids", "vl_attn_mask", "dropped_images"]
+        }
+        embodiment_id_stacked = torch.cat([embodiment_id, data_uncond["embodiment_id"]], dim=0)
+
+        # 1) Encode static context (images, text, state) once if it does not depend on actions
+        if self._shares_frames(data_cond, data_uncond):
+            # Both inputs see the same frames and only differ in their dropped-frame masks:
+            # encode the frames live in either input once, the masks pick each input's
+            # tokens in prepare_vl_embs.
+            visual_features = self.get_visual_features(
+                data_cond,
+                dropped_images=torch.logical_and(data_cond["dropped_images"], data_uncond["dropped_images"]),
+            )
+            visual_features = torch.cat([visual_features, visual_features], dim=0)
+        else:
+            for key in ["image_features", "images"]:
+                if data_cond.get(key) is not None and data_uncond.get(key) is not None:
+                    data[key] = torch.cat([data_cond[key], data_uncond[key]], dim=0)
+                    visual_features = self.get_visual_features(data)
+                    break
+            else:
+                # The inputs bring their frames in different forms (live frames on one side,
+                # cached features on the other): encode each on its own.
+                visual_features = torch.cat(
+                    [self.get_visual_features(data_cond), self.get_visual_features(data_uncond)], dim=0
+                )
         # text_features = self.siglip_model.text_model(
         #     input_ids=data["lang_input_ids"]
         # ).last_hidden_state
         # state_features = self.state_encoder(data["state"], embodiment_id)
 
-        # 3) Start denoising the actions
-        for i in range(num_steps):
-            # ---- (a) Discretize continuous time in [0,1]
-            t_cont = i / float(num_steps)  # e.g. goes 0, 1/N, 2/N, ...
-            t_discretized = int(t_cont * self.num_timestep_buckets)
+        # 2) Build and mix both VL contexts once, they do not change across steps
+        layout_key = None
+        if data_cond.get("token_layout") is not None and data_uncond.get("token_layout") is not None:
+            layout_key = (data_cond["token_layout"], data_uncond["token_layout"])
+        plan = self.token_assembly_plan(
+            data["vl_token_ids"],
+            data["sa_token_ids"],
+            data["dropped_images"],
+            visual_features.shape[2],
+            layout_key=layout_key,
+        )
+        vl_embs, vl_attn_mask = self.encode_vl_context(
+            data["vl_token_ids"],
+            visual_features,
+            data["dropped_images"],
+            vl_attn_mask=data["vl_attn_mask"] if strip_vl_padding else None,
+            plan=plan,
+        )
+        encoder_kv_cache = self.model.precompute_encoder_kv(vl_embs)
+        timestep_tables = self.build_timestep_tables(num_steps, ode_solver, time_grid, t_start)
+
+        def velocity_fn(actions, t_cont):
+            # ---- (a) Discretize continuous time in [0,1] and look up its embeddings
+            t_discretized = self.discretize_time(t_cont)
+            timestep_cond = self.timestep_cond(timestep_tables, t_discretized)
 
-            # ---- (b) Build embeddings (actions included)
-            # Pass the *current* actions at time t into the action encoder
+            # ---- (b) Embed the *current* actions at time t
             action_features = self.action_encoder(
                 actions,
-                (torch.ones(actions.shape[0]) * t_discretized).to(device),
+                None,
                 embodiment_id,
+                tau_emb=timestep_cond["tau"],
             )
 
-            # Predict velocity with history
-            vl_embs, sa_embs = self.prepare_input_embs(
-                data_cond["vl_token_ids"],
-                data_cond["sa_token_ids"],
-                visual_features_cond,
-                action_features,
-                data_cond["dropped_images"],
-            )
-            vl_embs = self.vl_self_attention_model(vl_embs)
-            # ---- (c) Forward pass to get velocity = d/dt x(t)
-            timesteps = torch.from_numpy(np.array([t_discretized])).to(device).long()
-            model_output = self.model(
-                hidden_states=sa_embs,
-                encoder_hidden_states=vl_embs,
-                encoder_attention_mask=data_cond["vl_attn_mask"],
-                timestep=timesteps,
-            )
-            pred = self.action_decoder(model_output, embodiment_id)
-            pred_velocity_cond = pred[:, -actions.shape[1] :]
-
-            # Predict velocity without history
-            vl_embs, sa_embs = self.prepare_input_embs(
-                data_uncond["vl_token_ids"],
-                data_uncond["sa_token_ids"],
-                visual_features_uncond,
-                action_features,
-                data_uncond["dropped_images"],
-            )
-            vl_embs = self.vl_self_attention_model(vl_embs)
-            # ---- (c) Forward pass to get velocity = d/dt x(t)
-            timesteps = torch.from_numpy(np.array([t_discretized])).to(device).long()
-            model_output = self.model(
-                hidden_states=sa_embs,
-                encoder_hidden_states=vl_embs,
-                encoder_attention_mask=data_uncond["vl_attn_mask"],
-                timestep=timesteps,
+            # ---- (c) Predict velocity with and without history in one pass
+            pred_velocity = self.predict_velocity(
+                torch.cat([action_features, action_features], dim=0),
+                t_discretized,
+                vl_embs,
+                vl_attn_mask,
+                data["sa_token_ids"],
+                embodiment_id_stacked,
+                encoder_kv_cache=encoder_kv_cache,
+                timestep_cond=timestep_cond,
+                plan=plan,
             )
-            pred = self.action_decoder(model_output, embodiment_id)
-            pred_velocity_uncond = pred[:, -actions.shape[1] :]
+            pred_velocity_cond, pred_velocity_uncond = pred_velocity.chunk(2, dim=0)
 
             # ---- (d) Combine velocities with cfg_scale
-            pred_velocity = pred_velocity_cond + cfg_scale * (pred_velocity_cond - pred_velocity_uncond)
+            return pred_velocity_cond + cfg_scale * (pred_velocity_cond - pred_velocity_uncond)
 
-            # ---- (e) Naive Euler step: x(t + dt) = x(t) + dt * velocity
-            actions = actions + dt * pred_velocity
+        # 3) Denoise the actions
+        actions, steps_run = self.integrate(
+            velocity_fn, actions, num_steps, ode_solver, time_grid, tolerance=tolerance, deadline=deadline,
+            t_start=t_start,
+        )
 
         return {
             "action_tensor": actions,
+            "num_steps": steps_run,
         }
 
     @property
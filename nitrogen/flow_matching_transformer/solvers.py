@@ -0,0 +1,95 @@
+"""
+Fixed-step ODE solvers for the flow-matching sampler.
+
+The sampler integrates dx/dt = v(x, t) from t=0 (noise) to t=1 (actions). A solver
+step maps x(t) to x(t_next) using one or more evaluations of `velocity_fn(x, t)`;
+higher-order solvers spend more model evaluations per step but need far fewer steps
+for the same accuracy. Time grids control where the steps are placed in [0, 1].
+"""
+import math
+
+
+def euler_step(velocity_fn, x, t, t_next):
+    """First order, 1 velocity evaluation per step."""
+    return x + (t_next - t) * velocity_fn(x, t)
+
+
+def heun_step(velocity_fn, x, t, t_next):
+    """Second order (explicit trapezoidal / RK2), 2 velocity evaluations per step."""
+    dt = t_next - t
+    v = velocity_fn(x, t)
+    v_next = velocity_fn(x + dt * v, t_next)
+    return x + dt * 0.5 * (v + v_next)
+
+
+def rk4_step(velocity_fn, x, t, t_next):
+    """Classic fourth order Runge-Kutta, 4 velocity evaluations per step."""
+    dt = t_next - t
+    t_mid = t + 0.5 * dt
+    k1 = velocity_fn(x, t)
+    k2 = velocity_fn(x + 0.5 * dt * k1, t_mid)
+    k3 = velocity_fn(x + 0.5 * dt * k2, t_mid)
+    k4 = velocity_fn(x + dt * k3, t_next)
+    return x + dt / 6.0 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+ODE_SOLVERS = {
+    "euler": euler_step,
+    "heun": heun_step,
+    "rk2": heun_step,
+    "rk4": rk4_step,
+}
+
+# Number of velocity evaluations (DiT forward passes) per solver step
+SOLVER_EVALS_PER_STEP = {
+    "euler": 1,
+    "heun": 2,
+    "rk2": 2,
+    "rk4": 4,
+}
+
+
+def _uniform_grid(num_steps):
+    return [i / float(num_steps) for i in range(num_steps + 1)]
+
+
+def _cosine_grid(num_steps):
+    # Denser near t=0 and t=1, where the velocity field changes fastest
+    return [0.5 * (1.0 - math.cos(math.pi * i / num_steps)) for i in range(num_steps + 1)]
+
+
+def _quadratic_grid(num_steps):
+    # Denser near t=1, where the fine details of the actions are resolved
+    return [1.0 - (1.0 - i / float(num_steps)) ** 2 for i in range(num_steps + 1)]
+
+
+TIME_GRIDS = {
+    "uniform": _uniform_grid,
+    "cosine": _cosine_grid,
+    "quadratic": _quadratic_grid,
+}
+
+
+def get_ode_solver(name: str):
+    if name not in ODE_SOLVERS:
+        raise ValueError(f"Unknown ODE solver '{name}'. Available: {sorted(ODE_SOLVERS)}")
+    return ODE_SOLVERS[name]
+
+
+def make_time_grid(num_steps: int, name: str = "uniform", t_start: float = 0.0) -> list[float]:
+    """
+    Return the num_steps + 1 times [t_start, ..., 1] at which the solver steps start and
+    end. A `t_start` above 0 (warm start) squeezes the grid into [t_start, 1].
+    """
+    if name not in TIME_GRIDS:
+        raise ValueError(f"Unknown time grid '{name}'. Available: {sorted(TIME_GRIDS)}")
+    if num_steps < 1:
+        raise ValueError(f"num_steps must be at least 1, got {num_steps}")
+    if not 0.0 <= t_start < 1.0:
+        raise ValueError(f"t_start must be in [0, 1), got {t_start}")
+    grid = TIME_GRIDS[name](num_steps)
+    grid[0], grid[-1] = 0.0, 1.0
+    if t_start > 0.0:
+        grid = [t_start + (1.0 - t_start) * t for t in grid]
+        grid[-1] = 1.0
+    return grid
@@ -7,16 +7,19 @@ import zmq
 class ModelClient:
     """Client for model inference server."""
     
-    def __init__(self, host="localhost", port=5555):
+    def __init__(self, host="localhost", port=5555, session_id=None):
         """
         Initialize client connection.
         
         Args:
             host: Server hostname or IP
             port: Server port
+            session_id: Server session to use, clients with different IDs keep separate
+                contexts (default: the server's shared default session)
         """
         self.host = host
         self.port = port
+        self.session_id = session_id
         self.timeout_ms = 30000
 
         self.context = zmq.Context()
@@ -44,7 +47,7 @@ class ModelClient:
             "image": image
         }
         
-        self.socket.send(pickle.dumps(request))
+        self._send(request)
         response = pickle.loads(self.socket.recv())
         
         if response["status"] != "ok":
@@ -56,7 +59,7 @@ class ModelClient:
         """Reset the server's session (clear buffers)."""
         request = {"type": "reset"}
         
-        self.socket.send(pickle.dumps(request))
+        self._send(request)
         response = pickle.loads(self.socket.recv())
         
         if response["status"] != "ok":
@@ -68,7 +71,7 @@ class ModelClient:
         """Get session info from the server."""
         request = {"type": "info"}
         
-        self.socket.send(pickle.dumps(request))
+        self._send(request)
         response = pickle.loads(self.socket.recv())
         
         if response["status"] != "ok":
@@ -76,6 +79,21 @@ class ModelClient:
         
         return response["info"]
 
+    def configure(self, **settings) -> dict:
+        """Change this client's session settings, e.g. selected_game or cfg_scale."""
+        self._send({"type": "configure", **settings})
+        response = pickle.loads(self.socket.recv())
+
+        if response["status"] != "ok":
+            raise RuntimeError(f"Server error: {response.get('message', 'Unknown error')}")
+
+        return response["info"]
+
+    def _send(self, request):
+        if self.session_id is not None:
+            request["session_id"] = self.session_id
+        self.socket.send(pickle.dumps(request))
+
     def close(self):
         """Close the connection."""
         self.socket.close()
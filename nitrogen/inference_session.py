@@ -1,14 +1,23 @@
+import os
+import copy
 import time
 import json
+import shutil
+import hashlib
+import threading
 from collections import deque
 
 import torch
 import numpy as np
 
-from transformers import AutoImageProcessor
-from nitrogen.flow_matching_transformer.nitrogen import NitroGen, NitroGen_Config
+from safetensors.torch import load_file, save_file
+from nitrogen.flow_matching_transformer.nitrogen import (
+    NitroGen, NitroGen_Config, checkpoint_vision_configs, load_image_processor, load_vision_encoder_config,
+)
 from nitrogen.mm_tokenizers import NitrogenTokenizerConfig, NitrogenTokenizer, Tokenizer
 from nitrogen.cfg import CkptConfig
+from nitrogen.multi_lora import attach_lora_adapters, select_lora_adapters
+from nitrogen.quantization import dequantize_state_dict, quantize_model
 from nitrogen.shared import PATH_REPO
 from peft import PeftModel
 from pathlib import Path
@@ -40,9 +49,217 @@ def summarize_parameters(module, name='model', depth=0, max_depth=3):
             summarize_parameters(child_module, child_name, depth + 1, max_depth)
 
 
-def _load_monolithic_checkpoint(checkpoint_path: str):
-    """Load model and args from a monolithic checkpoint (.pt)."""
-    checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+def set_num_threads(num_threads: int = None, num_interop_threads: int = None):
+    """
+    Set torch's intra-op and inter-op thread pools, None keeps the torch default.
+    Call before loading the model: the inter-op pool cannot be resized once it has started.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        torch.set_num_interop_threads(num_interop_threads)
+
+
+def materialize_buffers(model):
+    """
+    Create the non-persistent buffers of a model built on the meta device (under
+    torch.device("meta"), which only affects the calling thread): checkpoints do not hold
+    them. The only ones in NitroGen are the position ids of the vision encoder.
+    """
+    for module_name, module in model.named_modules():
+        for name in module._non_persistent_buffers_set:
+            buffer = module._buffers.get(name)
+            if buffer is None or not buffer.is_meta:
+                continue
+            if name != "position_ids":
+                raise RuntimeError(f"Cannot materialize the non-persistent buffer {module_name}.{name} of a meta model")
+            module._buffers[name] = torch.arange(buffer.shape[-1]).expand(buffer.shape)
+
+
+# Safetensors checkpoint layout: a directory with the config and the weights
+SAFETENSORS_CONFIG_FILE = "config.json"
+SAFETENSORS_WEIGHTS_FILE = "model.safetensors"
+# The int8 scales of quantized checkpoints are stored next to the weights under this prefix
+_SCALES_PREFIX = "quantization.scales."
+
+
+def is_safetensors_checkpoint(checkpoint_path: str):
+    path = Path(checkpoint_path)
+    return path.is_dir() and (path / SAFETENSORS_WEIGHTS_FILE).exists()
+
+
+def _load_checkpoint_file(checkpoint_path: str):
+    """
+    Load a monolithic checkpoint (.pt) or a safetensors checkpoint directory (see
+    convert_checkpoint) into a dict with the .pt layout. The tensors are memory-mapped from
+    the file instead of read into RAM.
+    """
+    if is_safetensors_checkpoint(checkpoint_path):
+        return _load_safetensors_checkpoint(checkpoint_path)
+    try:
+        return torch.load(checkpoint_path, map_location="cpu", mmap=True, weights_only=False)
+    except RuntimeError:
+        # Checkpoints in the legacy (pre zipfile) format cannot be mapped
+        return torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+
+
+def _load_safetensors_checkpoint(checkpoint_dir: str):
+    path = Path(checkpoint_dir)
+    with open(path / SAFETENSORS_CONFIG_FILE) as f:
+        checkpoint = json.load(f)
+    # Pages of the file load lazily and are shared through the page cache by every
+    # process that maps it
+    tensors = load_file(str(path / SAFETENSORS_WEIGHTS_FILE), device="cpu")
+    checkpoint["model"] = {name: t for name, t in tensors.items() if not name.startswith(_SCALES_PREFIX)}
+    if "quantization" in checkpoint:
+        checkpoint["quantization"]["scales"] = {
+            name[len(_SCALES_PREFIX):]: t for name, t in tensors.items() if name.startswith(_SCALES_PREFIX)
+        }
+    return checkpoint
+
+
+def convert_checkpoint(src_path: str, dst_dir: str, embed_vision_configs: bool = False):
+    """
+    Write a checkpoint (.pt, possibly quantized) as a safetensors checkpoint directory:
+    config.json with the ckpt_config and the other plain entries, and model.safetensors
+    with the weights. load_model memory-maps the weights instead of unpickling them.
+    With `embed_vision_configs`, the vision configs are stored too (see
+    checkpoint_vision_configs), so that loading needs no network access.
+    """
+    checkpoint = _load_checkpoint_file(src_path)
+    ckpt_config = checkpoint["ckpt_config"]
+    if hasattr(ckpt_config, "model_dump"):
+        ckpt_config = ckpt_config.model_dump(mode="json")
+    config = {"ckpt_config": ckpt_config}
+    for key in ["vision_encoder_config", "image_processor_config"]:
+        if key in checkpoint:
+            config[key] = checkpoint[key]
+    if embed_vision_configs:
+        config.update(checkpoint_vision_configs(ckpt_config["model_cfg"]["vision_encoder_name"]))
+
+    tensors = {name: t.contiguous() for name, t in checkpoint["model"].items()}
+    if "quantization" in checkpoint:
+        config["quantization"] = {"weight_dtype": checkpoint["quantization"]["weight_dtype"]}
+        for name, scale in checkpoint["quantization"]["scales"].items():
+            tensors[_SCALES_PREFIX + name] = scale.contiguous()
+
+    _save_safetensors_checkpoint(dst_dir, config, tensors)
+
+
+def _save_safetensors_checkpoint(dst_dir, config: dict, tensors: dict):
+    path = Path(dst_dir)
+    path.mkdir(parents=True, exist_ok=True)
+    save_file(tensors, str(path / SAFETENSORS_WEIGHTS_FILE), metadata={"format": "pt"})
+    with open(path / SAFETENSORS_CONFIG_FILE, "w") as f:
+        json.dump(config, f, indent=4)
+
+
+class LoraCache:
+    """
+    Directory of merged LoRA models in the safetensors checkpoint layout, keyed by the
+    content hashes of the base checkpoint and the adapter (and the merge dtype), so that
+    restarts load the merged weights instead of merging again. The least recently used
+    entries are evicted once the cache exceeds `max_bytes` (None: unlimited).
+    """
+
+    # File hashes by path, size and mtime, so that unchanged checkpoints are hashed once
+    HASHES_FILE = "hashes.json"
+
+    def __init__(self, cache_dir: str, max_bytes: int = None):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, base_model_path: str, adapter_path: str, dtype: str):
+        hashes_path = self.cache_dir / self.HASHES_FILE
+        memo = json.loads(hashes_path.read_text()) if hashes_path.exists() else {}
+        key = f"{self._content_hash(base_model_path, memo)[:16]}-{self._content_hash(adapter_path, memo)[:16]}-{dtype}"
+        tmp_path = hashes_path.with_suffix(f".tmp-{os.getpid()}")
+        tmp_path.write_text(json.dumps(memo, indent=4))
+        os.replace(tmp_path, hashes_path)
+        return key
+
+    @staticmethod
+    def _file_hash(path: Path, memo: dict):
+        stat = path.stat()
+        entry = memo.get(str(path.resolve()))
+        if entry is None or (entry["size"], entry["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 24), b""):
+                    digest.update(block)
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+            memo[str(path.resolve())] = entry
+        return entry["sha256"]
+
+    @classmethod
+    def _content_hash(cls, path: str, memo: dict):
+        """sha256 over a file, or over the relative paths and contents of a directory's files."""
+        path = Path(path)
+        files = sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+        digest = hashlib.sha256()
+        for file in files:
+            digest.update(str(file.relative_to(path)).encode() if path.is_dir() else b"")
+            digest.update(cls._file_hash(file, memo).encode())
+        return digest.hexdigest()
+
+    def lookup(self, key: str):
+        """The cached checkpoint directory for `key`, or None. A hit counts as a use for eviction."""
+        path = self.cache_dir / key
+        if not is_safetensors_checkpoint(str(path)):
+            return None
+        os.utime(path)
+        return path
+
+    def store(self, key: str, model, ckpt_config, img_proc):
+        """Write a merged model as the entry for `key`, then evict down to max_bytes."""
+        config = {
+            "ckpt_config": ckpt_config.model_dump(mode="json"),
+            "vision_encoder_config": model.vision_encoder.config.to_dict(),
+            "image_processor_config": json.loads(img_proc.to_json_string()),
+        }
+        tensors = {name: t.detach().to("cpu").contiguous() for name, t in model.state_dict().items()}
+        # Write next to the entry and rename it into place, so that a concurrent or
+        # interrupted start never sees a partial entry
+        tmp_path = self.cache_dir / f".{key}.tmp-{os.getpid()}"
+        _save_safetensors_checkpoint(tmp_path, config, tensors)
+        try:
+            os.rename(tmp_path, self.cache_dir / key)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(tmp_path)
+        self.evict(keep=key)
+        return self.cache_dir / key
+
+    def evict(self, keep: str = None):
+        """Remove the least recently used entries (except `keep`) until the cache fits max_bytes."""
+        if self.max_bytes is None:
+            return
+        entries = [p for p in self.cache_dir.iterdir() if p.is_dir() and not p.name.startswith(".")]
+        sizes = {p: sum(f.stat().st_size for f in p.rglob("*") if f.is_file()) for p in entries}
+        total = sum(sizes.values())
+        for path in sorted(entries, key=lambda p: p.stat().st_mtime):
+            if total <= self.max_bytes:
+                break
+            if path.name == keep:
+                continue
+            print(f"Evicting merged LoRA weights {path} from the cache")
+            shutil.rmtree(path, ignore_errors=True)
+            total -= sizes[path]
+
+
+def _load_monolithic_checkpoint(checkpoint_path: str, device: str = "cuda", dtype: str = "bfloat16"):
+    """
+    Load model and args from a monolithic checkpoint (.pt) or a safetensors checkpoint
+    directory (see convert_checkpoint) onto `device` in `dtype`. Quantized checkpoints
+    (see nitrogen.quantization.quantize_checkpoint) are dequantized straight to `dtype`.
+
+    The model is built on the meta device and takes the checkpoint tensors as its
+    parameters, so the pretrained vision encoder is never downloaded or materialized.
+    Checkpoints that store the vision configs (see checkpoint_vision_configs) load without
+    network access; otherwise only the config files come from the hub or the HF cache.
+    """
+    checkpoint = _load_checkpoint_file(checkpoint_path)
     ckpt_config = CkptConfig.model_validate(checkpoint["ckpt_config"])
     model_cfg = ckpt_config.model_cfg
     tokenizer_cfg = ckpt_config.tokenizer_cfg
@@ -51,7 +268,7 @@ def _load_monolithic_checkpoint(checkpoint_path: str):
     print(json.dumps(ckpt_config.model_dump(), indent=4))
 
     # Initialize tokenizer and language model
-    img_proc = AutoImageProcessor.from_pretrained(model_cfg.vision_encoder_name, use_fast=True)
+    img_proc = load_image_processor(model_cfg.vision_encoder_name, checkpoint.get("image_processor_config"))
 
     # Create VLM with pre-loaded language model
     if isinstance(model_cfg, NitroGen_Config):
@@ -65,7 +282,11 @@ def _load_monolithic_checkpoint(checkpoint_path: str):
             ]
         tokenizer = NitrogenTokenizer(tokenizer_cfg)
         game_mapping = tokenizer.game_mapping
-        model = NitroGen(config=model_cfg, game_mapping=game_mapping)
+        vision_encoder_config = load_vision_encoder_config(
+            model_cfg.vision_encoder_name, checkpoint.get("vision_encoder_config")
+        )
+        with torch.device("meta"):
+            model = NitroGen(config=model_cfg, game_mapping=game_mapping, vision_encoder_config=vision_encoder_config)
         # model.num_inference_timesteps = 16
         action_downsample_ratio = 1
     else:
@@ -75,19 +296,34 @@ def _load_monolithic_checkpoint(checkpoint_path: str):
 
     print(model)
 
-    model.load_state_dict(checkpoint["model"])
+    state_dict = checkpoint["model"]
+    if "quantization" in checkpoint:
+        print(f"Dequantizing {checkpoint['quantization']['weight_dtype']} checkpoint weights")
+        state_dict = dequantize_state_dict(state_dict, checkpoint["quantization"], dtype=getattr(torch, dtype))
+    model.load_state_dict(state_dict, assign=True)
+    materialize_buffers(model)
     model.eval()
     tokenizer.eval()
-    model.to("cuda", dtype=torch.bfloat16)
+    model.to(device, dtype=getattr(torch, dtype))
 
     return model, tokenizer, img_proc, ckpt_config, game_mapping, action_downsample_ratio
 
-def load_model(checkpoint_path: str, base_model_path: str = None):
+def load_model(
+    checkpoint_path: str,
+    base_model_path: str = None,
+    device: str = "cuda",
+    dtype: str = "bfloat16",
+    lora_cache_dir: str = None,
+    lora_cache_max_bytes: int = None,
+):
     """
-    Load model from checkpoint (monolithic or LoRA).
+    Load model from checkpoint (monolithic .pt, safetensors directory or LoRA) onto `device` (e.g. "cuda", "cpu")
+    with parameters in `dtype` (a torch dtype name such as "bfloat16" or "float32").
     
     If checkpoint_path is a LoRA adapter (directory with adapter_config.json),
     it requires base_model_path to be provided to load the base weights first.
+    With `lora_cache_dir`, the merged weights are kept in a LoraCache there and later
+    loads of the same base and adapter skip the merge.
     """
     path = Path(checkpoint_path)
     
@@ -99,9 +335,17 @@ def load_model(checkpoint_path: str, base_model_path: str = None):
     if is_lora:
         if base_model_path is None:
             raise ValueError(f"Checkpoint {checkpoint_path} is a LoRA adapter but no --base-model provided.")
+
+        cache = LoraCache(lora_cache_dir, lora_cache_max_bytes) if lora_cache_dir else None
+        if cache is not None:
+            cache_key = cache.key(base_model_path, checkpoint_path, dtype)
+            cached_path = cache.lookup(cache_key)
+            if cached_path is not None:
+                print(f"Loading merged LoRA weights from {cached_path}...")
+                return _load_monolithic_checkpoint(str(cached_path), device, dtype)
             
         print(f"Loading base model from {base_model_path}...")
-        model, tokenizer, img_proc, ckpt_config, game_mapping, action_downsample_ratio = _load_monolithic_checkpoint(base_model_path)
+        model, tokenizer, img_proc, ckpt_config, game_mapping, action_downsample_ratio = _load_monolithic_checkpoint(base_model_path, device, dtype)
         
         print(f"Loading LoRA adapter from {checkpoint_path}...")
         model = PeftModel.from_pretrained(model, checkpoint_path)
@@ -110,15 +354,37 @@ def load_model(checkpoint_path: str, base_model_path: str = None):
         
         # Ensure eval mode and dtype
         model.eval()
-        model.to("cuda", dtype=torch.bfloat16)
+        model.to(device, dtype=getattr(torch, dtype))
+
+        if cache is not None:
+            print(f"Caching merged LoRA weights in {cache.store(cache_key, model, ckpt_config, img_proc)}")
         
         return model, tokenizer, img_proc, ckpt_config, game_mapping, action_downsample_ratio
     else:
         # Assume monolithic checkpoint
-        return _load_monolithic_checkpoint(checkpoint_path)
+        return _load_monolithic_checkpoint(checkpoint_path, device, dtype)
 
 class InferenceSession:
     """Manages state for a single inference session."""
+
+    # Per-session settings a client may change, see configure
+    CONFIGURABLE_SETTINGS = [
+        "selected_game",
+        "cfg_scale",
+        "num_steps",
+        "ode_solver",
+        "time_grid",
+        "strip_vl_padding",
+        "tolerance",
+        "latency_budget_ms",
+        "warm_start_t",
+        "warm_start_steps",
+        "warm_start_shift",
+        "scene_cache_threshold",
+        "scene_refresh_steps",
+        "scene_cache_max_hits",
+        "lora_adapter",
+    ]
     
     def __init__(
         self,
@@ -132,7 +398,22 @@ class InferenceSession:
         old_layout: bool,
         cfg_scale: float,
         action_downsample_ratio: float,
-        context_length=None
+        context_length=None,
+        num_steps=None,
+        ode_solver=None,
+        time_grid=None,
+        tolerance=None,
+        latency_budget_ms=None,
+        device="cuda",
+        dtype="bfloat16",
+        strip_vl_padding=None,
+        warm_start_t=None,
+        warm_start_steps=None,
+        warm_start_shift=1,
+        scene_cache_threshold=None,
+        scene_refresh_steps=None,
+        scene_cache_max_hits=None,
+        lora_adapter=None,
     ):
         self.model = model
         self.tokenizer = tokenizer
@@ -145,6 +426,42 @@ class InferenceSession:
         self.action_downsample_ratio = action_downsample_ratio
         self.ckpt_path = ckpt_path
 
+        # Where inputs are placed and the dtype they (and autocast) use, matching load_model
+        self.device = device
+        self.dtype = getattr(torch, dtype)
+
+        # Sampler settings, None means the checkpoint default
+        self.num_steps = num_steps
+        self.ode_solver = ode_solver
+        self.time_grid = time_grid
+        self.strip_vl_padding = strip_vl_padding
+        # Adaptive stopping, None disables it. Both can be overridden per predict call.
+        self.tolerance = tolerance
+        self.latency_budget_ms = latency_budget_ms
+        # Warm start (see warm_start_actions): start from the previous chunk shifted by
+        # warm_start_shift actions and re-noised to warm_start_t, then run warm_start_steps
+        # (default num_steps) steps over [warm_start_t, 1]. None disables it.
+        self.warm_start_t = warm_start_t
+        self.warm_start_steps = warm_start_steps
+        self.warm_start_shift = warm_start_shift
+        # Scene cache (see scene_cache_lookup): when a frame differs from the one the last
+        # chunk was predicted from by at most scene_cache_threshold, return that chunk again
+        # or, with scene_refresh_steps, re-predict it with that many steps. At most
+        # scene_cache_max_hits consecutive hits (None: unlimited). None disables it.
+        self.scene_cache_threshold = scene_cache_threshold
+        self.scene_refresh_steps = scene_refresh_steps
+        self.scene_cache_max_hits = scene_cache_max_hits
+        self.scene_cache_stats = {"requests": 0, "reused": 0, "refreshed": 0}
+        self._clear_scene_cache()
+        # Unmerged LoRA adapter of this session (see nitrogen.multi_lora), None: the base model
+        self.lora_adapter = lora_adapter
+        # Raw sampler output of the last prediction, on the device
+        self.last_action_tensor = None
+        # Number of denoising steps the last prediction actually ran
+        self.last_num_steps = None
+        # Action deviation from the unquantized model, see action_deviation
+        self.quantization_report = None
+
         # Load modality config
         self.modality_config = self.ckpt_config.modality_cfg
 
@@ -155,13 +472,78 @@ class InferenceSession:
         # Buffers
         self.obs_buffer = deque(maxlen=self.max_buffer_size)
         self.action_buffer = deque(maxlen=self.max_buffer_size)
+        # Ring buffer of per-frame vision features, kept on the device, so that each
+        # predict only runs the vision encoder on the newest frame
+        self.feature_buffer = deque(maxlen=self.max_buffer_size)
+        # Serializes the requests of this session's client
+        self.lock = threading.Lock()
 
     @classmethod
-    def from_ckpt(cls, checkpoint_path: str, base_model_path: str = None, old_layout=False, cfg_scale=1.0, context_length=None):
-        """Create an InferenceSession from a checkpoint."""
-        model, tokenizer, img_proc, ckpt_config, game_mapping, action_downsample_ratio = load_model(checkpoint_path, base_model_path)
+    def from_ckpt(
+        cls,
+        checkpoint_path: str,
+        base_model_path: str = None,
+        old_layout=False,
+        cfg_scale=1.0,
+        context_length=None,
+        num_steps=None,
+        ode_solver=None,
+        time_grid=None,
+        tolerance=None,
+        latency_budget_ms=None,
+        device="cuda",
+        dtype="bfloat16",
+        quantize=None,
+        quantization_check_frames=None,
+        strip_vl_padding=None,
+        warm_start_t=None,
+        warm_start_steps=None,
+        warm_start_shift=1,
+        scene_cache_threshold=None,
+        scene_refresh_steps=None,
+        scene_cache_max_hits=None,
+        lora_cache_dir=None,
+        lora_cache_max_bytes=None,
+        lora_adapters=None,
+        lora_adapter=None,
+        ask_game=True,
+    ):
+        """
+        Create an InferenceSession from a checkpoint.
+
+        With `quantize` (see nitrogen.quantization), the model is quantized after loading and
+        the action deviation from the unquantized model is measured on
+        `quantization_check_frames` (random frames by default) and kept in `quantization_report`.
+
+        `lora_adapters` ({name: adapter directory}) are loaded unmerged on top of the model,
+        which sessions then pick with their `lora_adapter` (this session: `lora_adapter`).
 
-        if game_mapping is not None:
+        With a game mapping, the game is asked for on the console; with `ask_game=False` (e.g.
+        when a server reloads the checkpoint) the session starts unconditional instead.
+        """
+        model, tokenizer, img_proc, ckpt_config, game_mapping, action_downsample_ratio = load_model(
+            checkpoint_path, base_model_path, device=device, dtype=dtype,
+            lora_cache_dir=lora_cache_dir, lora_cache_max_bytes=lora_cache_max_bytes,
+        )
+        reference_model = None
+        if quantize is not None:
+            reference_model = copy.deepcopy(model)
+            quantize_model(model, quantize)
+        if isinstance(ckpt_config.model_cfg, NitroGen_Config):
+            # Precompute the timestep embeddings of the serving schedule on the device
+            model.build_timestep_tables(num_steps, ode_solver, time_grid)
+            if warm_start_t is not None:
+                model.build_timestep_tables(
+                    warm_start_steps if warm_start_steps is not None else num_steps, ode_solver, time_grid, warm_start_t
+                )
+            if scene_cache_threshold is not None and scene_refresh_steps is not None:
+                model.build_timestep_tables(
+                    scene_refresh_steps, ode_solver, time_grid, warm_start_t if warm_start_t is not None else 0.0
+                )
+
+        if game_mapping is not None and not ask_game:
+            selected_game = None
+        elif game_mapping is not None:
             # Ask user to pick a game from the list
             print("Available games in tokenizer mapping:")
             for game, idx in game_mapping.items():
@@ -181,7 +563,7 @@ class InferenceSession:
             selected_game = None
             print("No game mapping available, proceeding without game conditioning")
 
-        return cls(
+        session = cls(
             model,
             checkpoint_path,
             tokenizer,
@@ -192,9 +574,31 @@ class InferenceSession:
             old_layout,
             cfg_scale,
             action_downsample_ratio,
-            context_length
+            context_length,
+            num_steps=num_steps,
+            ode_solver=ode_solver,
+            time_grid=time_grid,
+            tolerance=tolerance,
+            latency_budget_ms=latency_budget_ms,
+            device=device,
+            dtype=dtype,
+            strip_vl_padding=strip_vl_padding,
+            warm_start_t=warm_start_t,
+            warm_start_steps=warm_start_steps,
+            warm_start_shift=warm_start_shift,
+            scene_cache_threshold=scene_cache_threshold,
+            scene_refresh_steps=scene_refresh_steps,
+            scene_cache_max_hits=scene_cache_max_hits,
         )
 
+        if reference_model is not None:
+            session.quantization_report = session.action_deviation(reference_model, quantization_check_frames)
+            print(f"{quantize} action deviation from the unquantized model: {session.quantization_report}")
+        if lora_adapters:
+            attach_lora_adapters(model, lora_adapters, device=device, dtype=session.dtype)
+        session.configure(lora_adapter=lora_adapter)
+        return session
+
     def info(self):
         return {
             "ckpt_path": self.ckpt_path,
@@ -205,18 +609,219 @@ class InferenceSession:
             "action_interleaving": self.action_interleaving,
             "is_flowmatching": self.is_flowmatching,
             "action_downsample_ratio": self.action_downsample_ratio,
+            "num_steps": self.num_steps,
+            "ode_solver": self.ode_solver,
+            "time_grid": self.time_grid,
+            "strip_vl_padding": self.strip_vl_padding,
+            "tolerance": self.tolerance,
+            "latency_budget_ms": self.latency_budget_ms,
+            "warm_start_t": self.warm_start_t,
+            "warm_start_steps": self.warm_start_steps,
+            "warm_start_shift": self.warm_start_shift,
+            "scene_cache_threshold": self.scene_cache_threshold,
+            "scene_refresh_steps": self.scene_refresh_steps,
+            "scene_cache_max_hits": self.scene_cache_max_hits,
+            "lora_adapter": self.lora_adapter,
+            "lora_adapters": sorted(getattr(self.model, "lora_adapters", None) or []),
+            "scene_cache_stats": {
+                **self.scene_cache_stats,
+                "hit_rate": (
+                    (self.scene_cache_stats["reused"] + self.scene_cache_stats["refreshed"])
+                    / self.scene_cache_stats["requests"]
+                    if self.scene_cache_stats["requests"] else 0.0
+                ),
+            },
+            "device": str(self.device),
+            "dtype": str(self.dtype),
+            "quantization_report": self.quantization_report,
         }
 
+    def fork(self, **settings):
+        """
+        A new session on the same model, tokenizer and image processor with empty buffers,
+        e.g. one per client. It starts from this session's settings; keyword arguments
+        override them (see configure).
+        """
+        session = copy.copy(self)
+        session.obs_buffer = deque(maxlen=self.max_buffer_size)
+        session.action_buffer = deque(maxlen=self.max_buffer_size)
+        session.feature_buffer = deque(maxlen=self.max_buffer_size)
+        session.lock = threading.Lock()
+        session.last_action_tensor = None
+        session.last_num_steps = None
+        session.scene_cache_stats = {"requests": 0, "reused": 0, "refreshed": 0}
+        session._clear_scene_cache()
+        session.configure(**settings)
+        return session
+
+    def configure(self, **settings):
+        """Change the CONFIGURABLE_SETTINGS of this session, e.g. its game or CFG scale."""
+        unknown = set(settings) - set(self.CONFIGURABLE_SETTINGS)
+        if unknown:
+            raise ValueError(f"Unknown session settings {sorted(unknown)}. Available: {self.CONFIGURABLE_SETTINGS}")
+        game = settings.get("selected_game")
+        if game is not None and (self.game_mapping is None or game not in self.game_mapping):
+            raise ValueError(f"Game '{game}' not found in the game mapping")
+        adapter = settings.get("lora_adapter")
+        if adapter is not None and adapter not in (getattr(self.model, "lora_adapters", None) or {}):
+            raise ValueError(f"LoRA adapter '{adapter}' is not loaded")
+        adapter_changed = "lora_adapter" in settings and settings["lora_adapter"] != self.lora_adapter
+        for name, value in settings.items():
+            setattr(self, name, value)
+        if any(name.startswith("scene_") for name in settings) or adapter_changed:
+            self._clear_scene_cache()
+        if adapter_changed:
+            # The context was encoded and the last chunk sampled with the previous adapter
+            self._reencode_context()
+
+    def rebind(self, template):
+        """
+        Move this session onto the model, tokenizer and image processor of `template`, e.g.
+        a session of a reloaded checkpoint, keeping its settings and context. A game or
+        LoRA adapter the new checkpoint does not have falls back to the template's.
+        """
+        for name in (
+            "model", "ckpt_path", "tokenizer", "img_proc", "ckpt_config", "game_mapping",
+            "action_downsample_ratio", "modality_config", "action_interleaving", "is_flowmatching",
+            "quantization_report",
+        ):
+            setattr(self, name, getattr(template, name))
+        if self.selected_game is not None and (self.game_mapping is None or self.selected_game not in self.game_mapping):
+            self.selected_game = template.selected_game
+        if self.lora_adapter is not None and self.lora_adapter not in (getattr(self.model, "lora_adapters", None) or {}):
+            self.lora_adapter = template.lora_adapter
+        if self.max_buffer_size != template.max_buffer_size:
+            self.max_buffer_size = template.max_buffer_size
+            self.obs_buffer = deque(self.obs_buffer, maxlen=self.max_buffer_size)
+            self.action_buffer = deque(self.action_buffer, maxlen=self.max_buffer_size)
+            self.feature_buffer = deque(maxlen=self.max_buffer_size)
+        self._clear_scene_cache()
+        self._reencode_context()
+
+    def _reencode_context(self):
+        """Drop the last chunk and re-run the vision encoder on the context, after a model or adapter change."""
+        self.last_action_tensor = None
+        self.feature_buffer.clear()
+        if self.is_flowmatching:
+            self.feature_buffer.extend(self._encode_frame(frame) for frame in list(self.obs_buffer))
+
     def reset(self):
         """Reset all buffers."""
         self.obs_buffer.clear()
         self.action_buffer.clear()
+        self.feature_buffer.clear()
+        self.last_action_tensor = None
+        self._clear_scene_cache()
 
-    def predict(self, obs):
-        start_time = time.time()
+    def _clear_scene_cache(self):
+        # Signature of the frame the cached result was predicted from, the result, and the
+        # number of consecutive hits on it
+        self.scene_cache_signature = None
+        self.scene_cache_result = None
+        self.scene_cache_hits = 0
+
+    def scene_cache_lookup(self, obs, signature=None):
+        """
+        Compare a new frame with the frame the cached result was predicted from (see
+        scene_signature, `signature` when already computed). Returns "reuse" when the
+        cached result can be returned as is, "refresh" when it should be re-predicted with
+        scene_refresh_steps steps, and None on a miss or when the scene cache is off.
+        """
+        if self.scene_cache_threshold is None or obs is None:
+            return None
+        self.scene_cache_stats["requests"] += 1
+        if signature is None:
+            signature = scene_signature(obs)
+        scene = self.scene_cache_peek(signature)
+        if scene is None:
+            # Later hits compare against this frame, not the last hit, so that a slowly
+            # changing scene does not drift away from the cached result
+            self._clear_scene_cache()
+            self.scene_cache_signature = signature
+            return None
+        self.scene_cache_hits += 1
+        self.scene_cache_stats["reused" if scene == "reuse" else "refreshed"] += 1
+        return scene
+
+    def scene_cache_peek(self, signature):
+        """
+        What scene_cache_lookup would return for a frame with this signature, without
+        updating the cache. Servers use it to skip preprocessing frames the cache answers.
+        """
+        if (
+            self.scene_cache_threshold is None
+            or self.scene_cache_result is None
+            or (self.scene_cache_max_hits is not None and self.scene_cache_hits >= self.scene_cache_max_hits)
+            or scene_distance(signature, self.scene_cache_signature) > self.scene_cache_threshold
+        ):
+            return None
+        return "reuse" if self.scene_refresh_steps is None else "refresh"
 
-        current_frame = self.img_proc([obs], return_tensors="pt")["pixel_values"]
+    def process_frame(self, obs):
+        """
+        Run the image processor on a frame. It does not touch the session state, so servers
+        may run it ahead of predict on another thread and pass the result as `pixel_values`.
+        """
+        return self.img_proc([obs], return_tensors="pt")["pixel_values"]
+
+    def observe(self, obs, pixel_values=None):
+        """
+        Process a new frame and push it into the context buffers. `pixel_values` is the
+        frame already run through process_frame.
+        """
+        current_frame = pixel_values if pixel_values is not None else self.process_frame(obs)
         self.obs_buffer.append(current_frame)
+        if self.is_flowmatching:
+            self.feature_buffer.append(self._encode_frame(current_frame))
+
+    def predict(self, obs, tolerance=None, latency_budget_ms=None, pixel_values=None, signature=None):
+        """
+        Predict the next action chunk for a new frame. `tolerance` and `latency_budget_ms`
+        override the session's adaptive stopping settings for this call. `pixel_values`
+        is the frame already run through process_frame, `signature` its scene_signature.
+        A frame the scene cache reuses the last result for (see scene_cache_lookup) is not
+        added to the context.
+        """
+        start_time = time.time()
+        scene = self.scene_cache_lookup(obs, signature)
+        if scene == "reuse":
+            return self.scene_cache_result
+        request = self.prepare_predict(obs, tolerance, latency_budget_ms, pixel_values, refresh=scene == "refresh")
+
+        # Run inference
+        if self.is_flowmatching:
+            model_output = self.sample_actions(*request["model_inputs"], **request["sampler_overrides"])
+            predicted_actions = self.decode_actions(model_output)
+        else:
+            predicted_actions = self._predict_ar(request["pixel_values"], request["action_tensors"])
+
+        result = self.finish_predict(predicted_actions)
+        inference_time = time.time() - start_time
+        print(f"Inference time: {inference_time:.3f}s")
+        return result
+
+    def prepare_predict(self, obs, tolerance=None, latency_budget_ms=None, pixel_values=None, refresh=False):
+        """
+        First half of predict: observe the frame and build the model inputs. Returns the
+        request (pixel values, action history, flow-matching model inputs and sampler
+        overrides) for the sampler, see also predict_batch. `refresh` runs
+        scene_refresh_steps steps (see scene_cache_lookup).
+        """
+        tolerance = tolerance if tolerance is not None else self.tolerance
+        latency_budget_ms = latency_budget_ms if latency_budget_ms is not None else self.latency_budget_ms
+        sampler_overrides = {"tolerance": tolerance}
+        if latency_budget_ms is not None:
+            # The budget covers the whole request, including frame preprocessing
+            sampler_overrides["deadline"] = time.perf_counter() + latency_budget_ms / 1000.0
+        init_actions = self.warm_start_actions()
+        if init_actions is not None:
+            sampler_overrides.update(init_actions=init_actions, t_start=self.warm_start_t)
+            if self.warm_start_steps is not None:
+                sampler_overrides["num_steps"] = self.warm_start_steps
+        if refresh:
+            sampler_overrides["num_steps"] = self.scene_refresh_steps
+
+        self.observe(obs, pixel_values)
         
         # Prepare model inputs
         pixel_values = torch.cat(list(self.obs_buffer), dim=0)
@@ -238,17 +843,35 @@ class InferenceSession:
             else:
                 print(f"  - {k}: None")
 
-        # Run inference
-        if self.is_flowmatching:
-            predicted_actions = self._predict_flowmatching(pixel_values, action_tensors)
-        else:
-            predicted_actions = self._predict_ar(pixel_values, action_tensors)
-        
+        return {
+            "pixel_values": pixel_values,
+            "action_tensors": action_tensors,
+            "model_inputs": self.prepare_model_inputs(pixel_values) if self.is_flowmatching else None,
+            "sampler_overrides": sampler_overrides,
+        }
+
+    def warm_start_actions(self):
+        """
+        Initial actions for a warm start: the previous chunk shifted forward by
+        warm_start_shift actions (the ones executed since), with the last action held to
+        refill the horizon. None when warm start is off or there is no previous chunk.
+        """
+        if self.warm_start_t is None or self.last_action_tensor is None:
+            return None
+        previous = self.last_action_tensor
+        shift = min(self.warm_start_shift, previous.shape[1])
+        return torch.cat([previous[:, shift:], previous[:, -1:].expand(-1, shift, -1)], dim=1)
+
+    def decode_actions(self, model_output):
+        """Decode a flow-matching sampler output into actions."""
+        self.last_action_tensor = model_output["action_tensor"]
+        self.last_num_steps = model_output["num_steps"]
+        return self.tokenizer.decode(model_output)
+
+    def finish_predict(self, predicted_actions):
+        """Second half of predict: record the predicted actions and convert them for the client."""
         # Add to action buffer
         self.action_buffer.append(predicted_actions)
-        
-        inference_time = time.time() - start_time
-        print(f"Inference time: {inference_time:.3f}s")
 
         # Convert to list of action dicts
         n_actions = len(predicted_actions["buttons"])
@@ -256,20 +879,75 @@ class InferenceSession:
         j_right = predicted_actions["j_right"].squeeze().float().cpu().numpy()
         buttons = predicted_actions["buttons"].squeeze().float().cpu().numpy()
 
-        return {
+        result = {
             "j_left": j_left,
             "j_right": j_right,
             "buttons": buttons,
         }
+        if self.scene_cache_threshold is not None:
+            self.scene_cache_result = result
+        return result
+
+    def batch_key(self, tolerance=None):
+        """
+        Sessions whose predict requests give equal keys can run them as one sampler call
+        (see predict_batch): same model, tokenizer and sampler settings.
+        """
+        return (
+            id(self.model),
+            id(self.tokenizer),
+            self.is_flowmatching,
+            self.max_buffer_size,
+            self.cfg_scale,
+            self.old_layout,
+            self.num_steps,
+            self.ode_solver,
+            self.time_grid,
+            self.strip_vl_padding,
+            tolerance if tolerance is not None else self.tolerance,
+            self.warm_start_t,
+            self.warm_start_steps,
+            self.warm_start_t is not None and self.last_action_tensor is not None,
+            str(self.device),
+            self.dtype,
+        )
+
+    def _autocast(self):
+        """Autocast to the session dtype; disabled for float32, which CPU autocast rejects."""
+        return torch.autocast(
+            device_type=torch.device(self.device).type,
+            dtype=self.dtype,
+            enabled=self.dtype != torch.float32,
+        )
 
-    def _predict_flowmatching(self, pixel_values, action_tensors):
+    def _encode_frame(self, frame):
+        """Run the vision encoder on a single processed frame, returns [tokens_per_image, D]."""
+        with torch.inference_mode(), select_lora_adapters(self.model, [self.lora_adapter]):
+            with self._autocast():
+                features = self.model.encode_images(
+                    frame.unsqueeze(0).to(self.device, dtype=self.dtype)
+                )
+        return features[0, 0]
 
+    def prepare_model_inputs(self, pixel_values):
+        """
+        Tokenize the current context into the model inputs with and without history
+        (the latter is the unconditional input for classifier-free guidance).
+        """
         available_frames = len(self.obs_buffer)
         frames = torch.zeros((self.max_buffer_size, *pixel_values.shape[1:]), 
-                            dtype=torch.bfloat16, device="cuda")
-        frames[-available_frames:] = pixel_values.to(dtype=torch.bfloat16)
-        dropped_frames = torch.zeros((self.max_buffer_size,), dtype=torch.bool, device="cuda")
+                            dtype=self.dtype, device=self.device)
+        frames[-available_frames:] = pixel_values.to(dtype=self.dtype)
+        # Frame masks stay on the host: the tokenizer reads them to lay out the tokens
+        dropped_frames = torch.zeros((self.max_buffer_size,), dtype=torch.bool)
         dropped_frames[:self.max_buffer_size - available_frames] = True
+
+        # Assemble the cached features in the same layout as `frames`. Padded slots are
+        # dropped frames, the model never reads them.
+        frame_features = list(self.feature_buffer)
+        image_features = torch.zeros((self.max_buffer_size, *frame_features[0].shape),
+                                     dtype=frame_features[0].dtype, device=self.device)
+        image_features[-len(frame_features):] = torch.stack(frame_features)
         
         data_with_history = {
             "frames": frames,
@@ -278,7 +956,7 @@ class InferenceSession:
         }
         tokenized_data_with_history = self.tokenizer.encode(data_with_history)
         
-        frame_mask = torch.ones((self.max_buffer_size,), dtype=torch.bool, device="cuda")
+        frame_mask = torch.ones((self.max_buffer_size,), dtype=torch.bool)
         frame_mask[-1] = False
         data_without_history = {
             "frames": frames,
@@ -287,33 +965,211 @@ class InferenceSession:
         }
         tokenized_data_without_history = self.tokenizer.encode(data_without_history)
         
-        # Convert to CUDA tensors with batch dimension and enforce bfloat16
+        # Move to the session device with a batch dimension and enforce the session dtype
         for tokenized_data in [tokenized_data_with_history, tokenized_data_without_history]:
             for k, v in tokenized_data.items():
                 if isinstance(v, torch.Tensor):
-                    v = v.unsqueeze(0).to("cuda")
+                    v = v.unsqueeze(0).to(self.device)
                 elif isinstance(v, np.ndarray):
-                    v = torch.tensor(v, device="cuda").unsqueeze(0)
+                    v = torch.tensor(v, device=self.device).unsqueeze(0)
                 else:
                     tokenized_data[k] = [v]
                     continue
                 
                 if v.is_floating_point():
-                    v = v.to(dtype=torch.bfloat16)
+                    v = v.to(dtype=self.dtype)
                 
                 tokenized_data[k] = v
-        
-        with torch.inference_mode():
-            with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
+
+        # Both inputs come from the same frame stack: share it and its cached features so
+        # that the model treats them as one stack under two dropped-frame masks
+        tokenized_data_without_history["images"] = tokenized_data_with_history["images"]
+        image_features = image_features.unsqueeze(0)
+        tokenized_data_with_history["image_features"] = image_features
+        tokenized_data_without_history["image_features"] = image_features
+
+        # The token layout only depends on the dropped frames and the game token, key the
+        # model's cached token assembly plans on it
+        has_game_token = bool(getattr(self.tokenizer, "game_mapping", None))
+        tokenized_data_with_history["token_layout"] = (tuple(dropped_frames.tolist()), has_game_token)
+        tokenized_data_without_history["token_layout"] = (tuple(frame_mask.tolist()), has_game_token)
+
+        return tokenized_data_with_history, tokenized_data_without_history
+
+    def sample_actions(
+        self, tokenized_data_with_history, tokenized_data_without_history, model=None, lora_adapters=None,
+        **sampler_overrides,
+    ):
+        """
+        Run the flow-matching sampler with this session's settings. Keyword arguments
+        (num_steps, ode_solver, time_grid, strip_vl_padding, tolerance, deadline) override them
+        for this call only.
+        `model` defaults to the session model. `lora_adapters` is the LoRA adapter of each
+        batch item (default: this session's).
+        """
+        model = model if model is not None else self.model
+        lora_adapters = lora_adapters if lora_adapters is not None else [self.lora_adapter]
+        sampler_kwargs = {
+            "num_steps": self.num_steps,
+            "ode_solver": self.ode_solver,
+            "time_grid": self.time_grid,
+            "strip_vl_padding": self.strip_vl_padding,
+            "tolerance": self.tolerance,
+            **sampler_overrides,
+        }
+        with torch.inference_mode(), select_lora_adapters(model, lora_adapters):
+            with self._autocast():
                 if self.cfg_scale == 1.0:
-                    model_output = self.model.get_action(tokenized_data_with_history, 
-                                                        old_layout=self.old_layout)
+                    model_output = model.get_action(tokenized_data_with_history, 
+                                                        old_layout=self.old_layout,
+                                                        **sampler_kwargs)
                 else:
-                    model_output = self.model.get_action_with_cfg(
+                    model_output = model.get_action_with_cfg(
                         tokenized_data_with_history,
                         tokenized_data_without_history,
-                        cfg_scale=self.cfg_scale
+                        cfg_scale=self.cfg_scale,
+                        **sampler_kwargs
                     )
-                predicted_actions = self.tokenizer.decode(model_output)
-        
-        return predicted_actions
+        return model_output
+
+    def action_deviation(self, reference_model, frames=None, num_seeds=4):
+        """
+        Sample actions for the same context and noise with the session model and
+        `reference_model` (e.g. the model before quantization) and report how far apart they
+        are: the max and mean absolute difference of the action tensors and the fraction of
+        buttons that differ. `frames` default to random images. Buffers are reset afterwards.
+        """
+        if frames is None:
+            rng = np.random.default_rng(0)
+            frames = [rng.integers(0, 256, (256, 256, 3), dtype=np.uint8) for _ in range(self.max_buffer_size)]
+
+        self.reset()
+        for frame in frames:
+            self.observe(frame)
+        tokenized_data_with_history, tokenized_data_without_history = self.prepare_model_inputs(
+            torch.cat(list(self.obs_buffer), dim=0)
+        )
+        self.reset()
+        # Let each model run its own vision encoder instead of using the cached features
+        tokenized_data_with_history.pop("image_features")
+        tokenized_data_without_history.pop("image_features")
+
+        max_errors, mean_errors, button_mismatches = [], [], []
+        for seed in range(num_seeds):
+            outputs = []
+            for model in [self.model, reference_model]:
+                torch.manual_seed(seed)
+                outputs.append(self.sample_actions(
+                    tokenized_data_with_history, tokenized_data_without_history, model=model, tolerance=None
+                ))
+            error = (outputs[0]["action_tensor"].float() - outputs[1]["action_tensor"].float()).abs()
+            max_errors.append(error.max().item())
+            mean_errors.append(error.mean().item())
+            buttons = [self.tokenizer.decode(output)["buttons"] for output in outputs]
+            button_mismatches.append((buttons[0] != buttons[1]).float().mean().item())
+
+        return {
+            "max_abs_error": max(max_errors),
+            "mean_abs_error": float(np.mean(mean_errors)),
+            "button_mismatch_rate": float(np.mean(button_mismatches)),
+        }
+
+
+def scene_signature(obs, size=16):
+    """
+    Cheap perceptual fingerprint of an RGB frame for the scene cache: its grayscale mean
+    over a size x size grid of blocks, in [0, 1]. Small enough to compare every frame.
+    """
+    frame = np.asarray(obs, dtype=np.float32)
+    if frame.ndim == 3:
+        frame = frame.mean(axis=2)
+    height, width = frame.shape
+    rows = np.linspace(0, height, min(size, height) + 1).astype(int)
+    cols = np.linspace(0, width, min(size, width) + 1).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(frame, rows[:-1], axis=0), cols[:-1], axis=1)
+    return sums / np.outer(np.diff(rows), np.diff(cols)) / 255.0
+
+
+def scene_distance(a, b):
+    """Mean absolute difference of two scene signatures, in [0, 1]."""
+    if a.shape != b.shape:
+        return 1.0
+    return float(np.abs(a - b).mean())
+
+
+def collate_model_inputs(model_inputs):
+    """
+    Stack the (cond, uncond) model inputs of several sessions (see
+    InferenceSession.prepare_model_inputs) into one batch. As within a session, the
+    uncond input shares the frames and cached features of the cond input.
+    """
+    batched = []
+    for inputs in zip(*model_inputs):
+        data = {}
+        for key, value in inputs[0].items():
+            if batched and key in ["images", "image_features"]:
+                data[key] = batched[0][key]
+            elif isinstance(value, torch.Tensor):
+                data[key] = torch.cat([x[key] for x in inputs], dim=0)
+            elif key == "token_layout":
+                data[key] = tuple(x[key] for x in inputs)
+            else:
+                data[key] = [item for x in inputs for item in x[key]]
+        batched.append(data)
+    return tuple(batched)
+
+
+def predict_batch(requests):
+    """
+    Predict for several sessions with one sampler call. `requests` is a list of
+    (session, obs, predict_kwargs); the sessions must be distinct and have equal
+    batch_key, e.g. one per emulator sharing the model. The batch stops at the earliest
+    latency budget deadline. Returns the predict results in request order.
+    """
+    session = requests[0][0]
+    # A checkpoint reload may move sessions to another model after they were batched
+    if len(requests) == 1 or not session.is_flowmatching or any(s.model is not session.model for s, _, _ in requests):
+        return [s.predict(obs, **predict_kwargs) for s, obs, predict_kwargs in requests]
+
+    start_time = time.time()
+    # Stationary scenes are answered from the session's scene cache, outside the batch
+    results = [None] * len(requests)
+    prepared, batched = [], []
+    for i, (s, obs, predict_kwargs) in enumerate(requests):
+        predict_kwargs = dict(predict_kwargs)
+        scene = s.scene_cache_lookup(obs, predict_kwargs.pop("signature", None))
+        if scene == "reuse":
+            results[i] = s.scene_cache_result
+        else:
+            prepared.append(s.prepare_predict(obs, **predict_kwargs, refresh=scene == "refresh"))
+            batched.append(i)
+    if not prepared:
+        return results
+
+    overrides = [p["sampler_overrides"] for p in prepared]
+    sampler_overrides = {"tolerance": overrides[0]["tolerance"]}
+    deadlines = [o["deadline"] for o in overrides if "deadline" in o]
+    if deadlines:
+        sampler_overrides["deadline"] = min(deadlines)
+    # The sampler starts the whole batch at one time: warm start only if every request can
+    if all("init_actions" in o for o in overrides):
+        sampler_overrides["t_start"] = overrides[0]["t_start"]
+        sampler_overrides["init_actions"] = torch.cat([o["init_actions"] for o in overrides], dim=0)
+    # Likewise for the step count of warm starts and scene cache refreshes
+    num_steps = {o.get("num_steps") for o in overrides}
+    if len(num_steps) == 1 and None not in num_steps:
+        sampler_overrides["num_steps"] = num_steps.pop()
+
+    # Sessions with different LoRA adapters share the batch, see nitrogen.multi_lora
+    model_output = session.sample_actions(
+        *collate_model_inputs([p["model_inputs"] for p in prepared]),
+        lora_adapters=[requests[i][0].lora_adapter for i in batched],
+        **sampler_overrides,
+    )
+    for row, i in enumerate(batched):
+        s = requests[i][0]
+        output = {"action_tensor": model_output["action_tensor"][row:row + 1], "num_steps": model_output["num_steps"]}
+        results[i] = s.finish_predict(s.decode_actions(output))
+
+    print(f"Batched inference time ({len(prepared)} requests): {time.time() - start_time:.3f}s")
+    return results
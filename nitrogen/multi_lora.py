@@ -0,0 +1,220 @@
+"""
+Unmerged LoRA adapters: serve one base model with any number of PEFT LoRA adapters and
+pick the adapter per request.
+
+attach_lora_adapters wraps every linear layer an adapter targets in a LoraLinear, which
+keeps the base layer and the low-rank factors of each adapter, so that memory grows with
+the adapters' size instead of the model's. Inside select_lora_adapters(model, names),
+request row i runs with adapter names[i]: a batch that mixes adapters adds each adapter's
+low-rank update to the rows of its requests only. Adapters of the DiT timestep modules and
+of the vision encoder cannot be applied per request and are rejected (load those merged).
+"""
+import json
+import math
+import re
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+from torch import nn
+from safetensors.torch import load_file
+
+# DiT modules that only see the timestep: NitroGen.build_timestep_tables computes them once
+# for all requests, so they cannot differ per adapter
+_TIMESTEP_MODULES = re.compile(r"^model\.(timestep_encoder|proj_out_1|transformer_blocks\.\d+\.norm1)(\.|$)")
+# Vision encoder layers see the live frames of all requests flattened request-major, not the
+# request rows LoraSelection.groups assumes
+_VISION_MODULES = re.compile(r"^vision_encoder(\.|$)")
+# PEFT adapter weight names: base_model.model.<module>.lora_A[.<adapter>].weight
+_LORA_KEY = re.compile(r"^(?:base_model\.model\.)?(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$")
+
+
+class LoraSelection:
+    """
+    The adapter id of each request row, shared by the LoraLinear layers of a model. It is
+    kept per thread, since servers run the requests of different sessions on several threads.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def select(self, adapter_ids):
+        """Select adapter ids (None: the base model) per request row, returns the previous selection."""
+        previous = getattr(self._local, "adapter_ids", None)
+        self._local.adapter_ids = adapter_ids
+        self._local.groups = {}
+        return previous
+
+    def groups(self, batch_size: int, device):
+        """
+        (adapter_id, rows) of a layer input with `batch_size` rows, where rows is None when
+        the group covers the whole input. Inputs may stack the requests several times (e.g.
+        the conditional and unconditional halves of CFG), so row j belongs to request j % B.
+        This holds for every layer outside the vision encoder, see attach_lora_adapters.
+        Rows are built once per selection and input size, without host syncs.
+        """
+        adapter_ids = getattr(self._local, "adapter_ids", None)
+        if not adapter_ids:
+            return []
+        key = (batch_size, str(device))
+        groups = self._local.groups.get(key)
+        if groups is None:
+            num_requests = len(adapter_ids)
+            if batch_size % num_requests:
+                raise ValueError(f"A LoRA layer input of {batch_size} rows does not stack {num_requests} requests")
+            if len(set(adapter_ids)) == 1:
+                groups = [(adapter_ids[0], None)]
+            else:
+                groups = []
+                for adapter_id in sorted(set(adapter_ids) - {None}):
+                    requests = [i for i, other in enumerate(adapter_ids) if other == adapter_id]
+                    rows = [i + k * num_requests for k in range(batch_size // num_requests) for i in requests]
+                    groups.append((adapter_id, torch.tensor(rows, device=device)))
+            self._local.groups[key] = groups
+        return groups
+
+
+class LoraLinear(nn.Module):
+    """
+    A linear layer (float or int8 quantized) plus the unmerged LoRA factors of any number of
+    adapters, applied per request row as selected in the model's LoraSelection. The layer
+    input must have the batch as its first dimension.
+    """
+
+    def __init__(self, base: nn.Module, selection: LoraSelection):
+        super().__init__()
+        self.base = base
+        self.selection = selection
+        self.lora_A = nn.ParameterDict()
+        self.lora_B = nn.ParameterDict()
+        self.scales = {}
+
+    def add_adapter(self, adapter_id: int, lora_A, lora_B, scale: float):
+        key = str(adapter_id)
+        self.lora_A[key] = nn.Parameter(lora_A, requires_grad=False)
+        self.lora_B[key] = nn.Parameter(lora_B, requires_grad=False)
+        self.scales[key] = scale
+
+    def forward(self, x):
+        y = self.base(x)
+        for adapter_id, rows in self.selection.groups(x.shape[0], x.device):
+            key = str(adapter_id)
+            if key not in self.lora_A:
+                continue
+            lora_A, lora_B, scale = self.lora_A[key], self.lora_B[key], self.scales[key]
+            if rows is None:
+                y = y + nn.functional.linear(nn.functional.linear(x, lora_A), lora_B) * scale
+            else:
+                delta = nn.functional.linear(nn.functional.linear(x.index_select(0, rows), lora_A), lora_B) * scale
+                y = y.index_add(0, rows, delta.to(y.dtype))
+        return y
+
+
+def _pattern_value(pattern, module_name: str, default):
+    """Per-module override of a PEFT config value (rank_pattern / alpha_pattern)."""
+    for key, value in (pattern or {}).items():
+        if re.match(rf"(.*\.)?{key}$", module_name):
+            return value
+    return default
+
+
+def load_lora_adapter(adapter_path: str):
+    """
+    Read a PEFT LoRA adapter directory into {module name: (lora_A, lora_B, scale)}.
+    Only plain LoRA on linear layers can be served unmerged: adapters with DoRA, trained
+    biases or modules_to_save raise a ValueError (load those merged instead).
+    """
+    path = Path(adapter_path)
+    config = json.loads((path / "adapter_config.json").read_text())
+    if (
+        config.get("peft_type", "LORA") != "LORA"
+        or config.get("use_dora")
+        or config.get("modules_to_save")
+        or config.get("fan_in_fan_out")
+        or config.get("bias", "none") != "none"
+    ):
+        raise ValueError(f"{adapter_path} is not a plain LoRA adapter and cannot be served unmerged, load it merged instead")
+
+    weights_path = path / "adapter_model.safetensors"
+    if weights_path.exists():
+        weights = load_file(str(weights_path))
+    else:
+        weights = torch.load(path / "adapter_model.bin", map_location="cpu", weights_only=True)
+
+    factors = {}
+    for key, tensor in weights.items():
+        match = _LORA_KEY.match(key)
+        if match is None:
+            raise ValueError(f"{adapter_path}: unsupported adapter weight '{key}'")
+        factors.setdefault(match.group(1), {})[match.group(2)] = tensor
+
+    adapter = {}
+    for module_name, factor in factors.items():
+        rank = factor["A"].shape[0]
+        alpha = _pattern_value(config.get("alpha_pattern"), module_name, config["lora_alpha"])
+        scale = alpha / math.sqrt(rank) if config.get("use_rslora") else alpha / rank
+        adapter[module_name] = (factor["A"], factor["B"], scale)
+    return adapter
+
+
+def attach_lora_adapters(model: nn.Module, adapters: dict, device=None, dtype=None):
+    """
+    Load PEFT LoRA adapters ({name: adapter directory}) into `model` unmerged, with their
+    factors on `device` in `dtype`. The adapters must have been trained on this model.
+    Returns model.lora_adapters, the adapter id of every loaded name.
+    """
+    if getattr(model, "lora_selection", None) is None:
+        model.lora_selection = LoraSelection()
+        model.lora_adapters = {}
+
+    for name, adapter_path in adapters.items():
+        if name in model.lora_adapters:
+            raise ValueError(f"LoRA adapter '{name}' is already loaded")
+        adapter = load_lora_adapter(adapter_path)
+        # Check every target before changing the model
+        for module_name in adapter:
+            if _TIMESTEP_MODULES.match(module_name):
+                raise ValueError(
+                    f"LoRA adapter '{name}' adapts the timestep module {module_name}, which is shared by all "
+                    "requests; load it merged instead"
+                )
+            if _VISION_MODULES.match(module_name):
+                raise ValueError(
+                    f"LoRA adapter '{name}' adapts the vision encoder module {module_name}, which cannot be "
+                    "applied per request; load it merged instead"
+                )
+            module = model.get_submodule(module_name)
+            if not isinstance(module, LoraLinear) and not hasattr(module, "in_features"):
+                raise ValueError(f"LoRA adapter '{name}' targets {module_name}, which is not a linear layer")
+
+        adapter_id = len(model.lora_adapters)
+        for module_name, (lora_A, lora_B, scale) in adapter.items():
+            module = model.get_submodule(module_name)
+            if not isinstance(module, LoraLinear):
+                parent_name, _, child_name = module_name.rpartition(".")
+                module = LoraLinear(module, model.lora_selection)
+                setattr(model.get_submodule(parent_name), child_name, module)
+            module.add_adapter(adapter_id, lora_A.to(device, dtype), lora_B.to(device, dtype), scale)
+        model.lora_adapters[name] = adapter_id
+        print(f"Loaded LoRA adapter '{name}' from {adapter_path} ({len(adapter)} layers)")
+    return model.lora_adapters
+
+
+@contextmanager
+def select_lora_adapters(model: nn.Module, adapter_names):
+    """
+    Run `model` on the calling thread with adapter adapter_names[i] for request row i
+    (None: the base model).
+    """
+    selection = getattr(model, "lora_selection", None)
+    if selection is None:
+        if any(name is not None for name in adapter_names):
+            raise ValueError("No LoRA adapters are loaded")
+        yield
+        return
+    previous = selection.select([None if name is None else model.lora_adapters[name] for name in adapter_names])
+    try:
+        yield
+    finally:
+        selection.select(previous)
@@ -0,0 +1,169 @@
+"""
+Quantization of NitroGen models.
+
+Serving: `int8-dynamic` stores the weights of every linear layer in the vision tower, the
+VL self-attention transformer, the DiT and the action encoder/decoder as int8 with
+per-output-channel scales, and quantizes activations on the fly, so that the matmuls
+run as int8 GEMMs. PyTorch only provides these kernels on CPU.
+
+Checkpoints: `quantize_checkpoint` writes a weight-only int8 (per-channel scales) or
+bfloat16 copy of a checkpoint, which load_model dequantizes while loading. It can also
+store the vision configs in the copy, so that loading it needs no network access.
+"""
+import torch
+from torch import nn
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+
+from nitrogen.flow_matching_transformer.nitrogen import (
+    CategorySpecificLinear, apply_by_category, checkpoint_vision_configs, group_categories,
+)
+
+QUANTIZATION_MODES = ["int8-dynamic"]
+
+
+def _quantize_linear(linear: nn.Linear):
+    linear.qconfig = per_channel_dynamic_qconfig
+    return DynamicQuantizedLinear.from_float(linear)
+
+
+class DynamicQuantizedCategorySpecificLinear(nn.Module):
+    """
+    int8 dynamic counterpart of CategorySpecificLinear: one quantized linear layer per
+    category, applied to the batch items of that category.
+    """
+
+    def __init__(self, linears):
+        super().__init__()
+        self.num_categories = len(linears)
+        self.linears = nn.ModuleList(linears)
+
+    @classmethod
+    def from_float(cls, module: CategorySpecificLinear):
+        linears = []
+        for W, b in zip(module.W, module.b):
+            # W is stored as (input_dim, hidden_dim), nn.Linear expects (out, in)
+            linear = nn.Linear(W.shape[0], W.shape[1])
+            with torch.no_grad():
+                linear.weight.copy_(W.t())
+                linear.bias.copy_(b)
+            linears.append(_quantize_linear(linear))
+        return cls(linears)
+
+    def forward(self, x, cat_ids, groups=None):
+        if groups is None:
+            groups = group_categories(cat_ids, self.num_categories)
+        return apply_by_category(lambda cat_id, x: self.linears[cat_id](x), x, groups)
+
+
+def quantize_model(model, mode: str = "int8-dynamic"):
+    """
+    Quantize a NitroGen model in place for inference and return it. The model must be on
+    CPU in float32 (load it with device="cpu", dtype="float32").
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode '{mode}'. Available: {QUANTIZATION_MODES}")
+    if model.device.type != "cpu" or model.dtype != torch.float32:
+        raise ValueError(
+            f"{mode} quantization needs the model on CPU in float32, got {model.device} {model.dtype}"
+        )
+
+    qconfig_spec = {nn.Linear: per_channel_dynamic_qconfig}
+    for module in [model.vision_encoder, model.vl_self_attention_model, model.model.transformer_blocks]:
+        quantize_dynamic(module, qconfig_spec, dtype=torch.qint8, inplace=True)
+    # The DiT timestep MLPs only run when the timestep tables are built: keep them in float
+    model.model.proj_out_2 = _quantize_linear(model.model.proj_out_2)
+
+    for mlp in [model.action_encoder, model.action_decoder]:
+        for name, child in list(mlp.named_children()):
+            if isinstance(child, CategorySpecificLinear):
+                setattr(mlp, name, DynamicQuantizedCategorySpecificLinear.from_float(child))
+
+    # Tables built from the float weights would no longer match the quantized model
+    model.timestep_tables = None
+    return model
+
+
+CHECKPOINT_WEIGHT_DTYPES = ["int8", "bfloat16"]
+
+
+def _is_linear_weight(name: str, tensor: torch.Tensor):
+    """
+    Weights of the linear layers: nn.Linear (out, in) `.weight` matrices, apart from the
+    embedding tables (position, game and token embeddings), and CategorySpecificLinear
+    (categories, in, out) `.W` tensors. Both get one int8 scale per output channel by
+    reducing dimension 1.
+    """
+    module_name, _, param = name.rpartition(".")
+    if param == "W":
+        return tensor.ndim == 3
+    return param == "weight" and tensor.ndim == 2 and not module_name.endswith("embedding")
+
+
+def quantize_state_dict(state_dict: dict, weight_dtype: str = "int8"):
+    """
+    Weight-only quantization of a state dict. Returns the new state dict and the metadata
+    dequantize_state_dict needs. With int8, the linear layer weights become int8 with a
+    float32 scale per output channel; everything else (biases, norms, embeddings, the conv
+    patch embedding, buffers) is kept. With bfloat16, every floating point tensor is cast.
+    """
+    if weight_dtype not in CHECKPOINT_WEIGHT_DTYPES:
+        raise ValueError(f"Unknown weight dtype '{weight_dtype}'. Available: {CHECKPOINT_WEIGHT_DTYPES}")
+
+    quantized, scales = {}, {}
+    for name, tensor in state_dict.items():
+        if not tensor.is_floating_point():
+            quantized[name] = tensor
+        elif weight_dtype == "bfloat16":
+            quantized[name] = tensor.to(torch.bfloat16)
+        elif not _is_linear_weight(name, tensor):
+            quantized[name] = tensor
+        else:
+            tensor = tensor.float()
+            scale = tensor.abs().amax(dim=1, keepdim=True).clamp_min(1e-12) / 127.0
+            quantized[name] = torch.round(tensor / scale).clamp(-127, 127).to(torch.int8)
+            scales[name] = scale
+    return quantized, {"weight_dtype": weight_dtype, "scales": scales}
+
+
+def dequantize_state_dict(state_dict: dict, quantization: dict, dtype=torch.float32):
+    """Inverse of quantize_state_dict, producing floating point tensors in `dtype`."""
+    scales = quantization["scales"]
+    return {
+        name: (
+            tensor.to(dtype) * scales[name].to(dtype) if name in scales
+            else tensor.to(dtype) if tensor.is_floating_point()
+            else tensor
+        )
+        for name, tensor in state_dict.items()
+    }
+
+
+# Checkpoint entries besides the weights that a copy keeps
+VISION_CONFIG_KEYS = ["vision_encoder_config", "image_processor_config"]
+
+
+def quantize_checkpoint(src_path: str, dst_path: str, weight_dtype: str = "int8", embed_vision_configs: bool = False):
+    """
+    Write a weight-only quantized copy of a monolithic checkpoint (weight_dtype None keeps
+    the weights as they are). The result keeps the checkpoint layout (ckpt_config, model)
+    and adds the "quantization" metadata; it only holds tensors and plain Python types, so
+    it loads with torch.load(weights_only=True).
+
+    With `embed_vision_configs`, the vision encoder and image processor configs are
+    fetched once and stored in the copy (see checkpoint_vision_configs).
+    """
+    checkpoint = torch.load(src_path, map_location="cpu", weights_only=False)
+    ckpt_config = checkpoint["ckpt_config"]
+    if hasattr(ckpt_config, "model_dump"):
+        ckpt_config = ckpt_config.model_dump(mode="json")
+    output = {"ckpt_config": ckpt_config, **{key: checkpoint[key] for key in VISION_CONFIG_KEYS if key in checkpoint}}
+    if embed_vision_configs:
+        output.update(checkpoint_vision_configs(ckpt_config["model_cfg"]["vision_encoder_name"]))
+    if weight_dtype is None:
+        output["model"] = checkpoint["model"]
+        if "quantization" in checkpoint:
+            output["quantization"] = checkpoint["quantization"]
+    else:
+        output["model"], output["quantization"] = quantize_state_dict(checkpoint["model"], weight_dtype)
+    torch.save(output, dst_path)
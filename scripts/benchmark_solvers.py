@@ -0,0 +1,143 @@
+"""
+Compare the flow-matching ODE solvers against a high-step Euler reference.
+
+For every solver, time grid and step count, sample action chunks from the same
+context and the same initial noise, and report the error against the reference
+together with the number of DiT evaluations and the sampling latency.
+
+With --warm-start-t, the same settings also run warm started from the chunk predicted
+one frame earlier (the context without its last frame), re-noised to each given time.
+
+    python scripts/benchmark_solvers.py models/nvidia/NitroGen/ng.pt --images debug/*.png
+"""
+import time
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+from nitrogen.inference_session import InferenceSession, load_model, set_num_threads
+from nitrogen.flow_matching_transformer.solvers import ODE_SOLVERS, SOLVER_EVALS_PER_STEP, TIME_GRIDS
+
+
+def load_frames(paths, num_frames, seed):
+    if paths:
+        return [Image.open(p).convert("RGB").resize((256, 256)) for p in paths]
+    rng = np.random.default_rng(seed)
+    return [Image.fromarray(rng.integers(0, 256, (256, 256, 3), dtype=np.uint8)) for _ in range(num_frames)]
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def sample(session, cond, uncond, seed, **sampler_kwargs):
+    torch.manual_seed(seed)
+    synchronize(session.device)
+    start = time.perf_counter()
+    actions = session.sample_actions(cond, uncond, **sampler_kwargs)["action_tensor"]
+    synchronize(session.device)
+    return actions.float(), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark flow-matching ODE solvers")
+    parser.add_argument("ckpt", type=str)
+    parser.add_argument("--base-model", type=str, default=None, help="Path to base model (required for LoRA adapters)")
+    parser.add_argument("--images", type=str, nargs="*", default=None, help="Context frames (default: random frames)")
+    parser.add_argument("--num-frames", type=int, default=4, help="Number of random frames when --images is not given")
+    parser.add_argument("--game", type=str, default=None, help="Game name from the tokenizer mapping (default: unconditional)")
+    parser.add_argument("--cfg", type=float, default=1.0, help="CFG scale")
+    parser.add_argument("--solvers", type=str, nargs="+", default=["euler", "heun", "rk4"], choices=sorted(ODE_SOLVERS))
+    parser.add_argument("--time-grids", type=str, nargs="+", default=["uniform"], choices=sorted(TIME_GRIDS))
+    parser.add_argument("--steps", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--reference-steps", type=int, default=256, help="Euler steps for the reference solution")
+    parser.add_argument("--seeds", type=int, default=4, help="Number of noise seeds to average over")
+    parser.add_argument("--warm-start-t", type=float, nargs="*", default=[], help="Also sample warm started from the previous chunk, re-noised to each of these times")
+    parser.add_argument("--warm-start-shift", type=int, default=1, help="Actions executed between the previous and the current chunk")
+    parser.add_argument("--strip-vl-padding", action="store_true", help="Sample the compared settings with the VL padding stripped (the reference keeps it)")
+    parser.add_argument("--device", type=str, default="cuda", help="Device to run the model on, e.g. cuda or cpu")
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=["bfloat16", "float16", "float32"])
+    parser.add_argument("--num-threads", type=int, default=None, help="Intra-op CPU threads (default: torch default)")
+    parser.add_argument("--num-interop-threads", type=int, default=None, help="Inter-op CPU threads (default: torch default)")
+    args = parser.parse_args()
+
+    set_num_threads(args.num_threads, args.num_interop_threads)
+    model, tokenizer, img_proc, ckpt_config, game_mapping, action_downsample_ratio = load_model(
+        args.ckpt, args.base_model, device=args.device, dtype=args.dtype
+    )
+    session = InferenceSession(
+        model,
+        args.ckpt,
+        tokenizer,
+        img_proc,
+        ckpt_config,
+        game_mapping=game_mapping,
+        selected_game=args.game,
+        old_layout=False,
+        cfg_scale=args.cfg,
+        action_downsample_ratio=action_downsample_ratio,
+        device=args.device,
+        dtype=args.dtype,
+    )
+
+    frames = load_frames(args.images, args.num_frames, seed=0)
+    init_actions = {0.0: None}
+    if args.warm_start_t:
+        # The previous chunk, sampled with the session settings from the context one frame earlier
+        for frame in frames[:-1]:
+            session.observe(frame)
+        previous_cond, previous_uncond = session.prepare_model_inputs(torch.cat(list(session.obs_buffer), dim=0))
+        session.last_action_tensor = sample(session, previous_cond, previous_uncond, seed=len(frames))[0]
+        session.warm_start_shift = args.warm_start_shift
+        for t_start in args.warm_start_t:
+            session.warm_start_t = t_start
+            init_actions[t_start] = session.warm_start_actions()
+        frames = frames[-1:]
+    for frame in frames:
+        session.observe(frame)
+    pixel_values = torch.cat(list(session.obs_buffer), dim=0)
+    cond, uncond = session.prepare_model_inputs(pixel_values)
+
+    seeds = list(range(args.seeds))
+    references = [
+        sample(
+            session, cond, uncond, seed,
+            num_steps=args.reference_steps, ode_solver="euler", time_grid="uniform", strip_vl_padding=False,
+        )[0]
+        for seed in seeds
+    ]
+    print(f"Reference: euler, uniform grid, {args.reference_steps} steps, {len(seeds)} seeds")
+
+    # Warm up kernels so that the first row does not pay for compilation
+    sample(session, cond, uncond, 0, num_steps=1, ode_solver="euler", time_grid="uniform")
+
+    print(
+        f"{'solver':>8} {'grid':>10} {'t_start':>8} {'steps':>6} {'DiT evals':>10} "
+        f"{'max err':>10} {'mean err':>10} {'latency ms':>11}"
+    )
+    for solver in args.solvers:
+        for grid in args.time_grids:
+            for t_start, init in init_actions.items():
+                for num_steps in args.steps:
+                    max_errs, mean_errs, latencies = [], [], []
+                    for seed, reference in zip(seeds, references):
+                        actions, latency = sample(
+                            session, cond, uncond, seed, num_steps=num_steps, ode_solver=solver, time_grid=grid,
+                            strip_vl_padding=args.strip_vl_padding, init_actions=init, t_start=t_start,
+                        )
+                        err = (actions - reference).abs()
+                        max_errs.append(err.max().item())
+                        mean_errs.append(err.mean().item())
+                        latencies.append(latency)
+                    evals = SOLVER_EVALS_PER_STEP[solver] * num_steps
+                    print(
+                        f"{solver:>8} {grid:>10} {t_start:>8.2f} {num_steps:>6} {evals:>10} "
+                        f"{max(max_errs):>10.5f} {np.mean(mean_errs):>10.5f} {1000 * np.median(latencies):>11.2f}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""
+Convert a NitroGen checkpoint (.pt) into a safetensors checkpoint directory.
+
+The directory holds config.json (the checkpoint config) and model.safetensors (the
+weights). serve.py memory-maps the weights instead of unpickling the whole file, so they
+load lazily and servers on the same host share them through the page cache. Quantized
+checkpoints (see export_checkpoint.py) stay quantized.
+
+    python scripts/convert_checkpoint.py models/nvidia/NitroGen/ng.pt models/nvidia/NitroGen/ng
+"""
+import argparse
+from pathlib import Path
+
+from nitrogen.inference_session import SAFETENSORS_WEIGHTS_FILE, convert_checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a NitroGen checkpoint to safetensors")
+    parser.add_argument("src", type=str, help="Monolithic checkpoint (.pt)")
+    parser.add_argument("dst", type=str, help="Output directory")
+    parser.add_argument("--embed-vision-configs", action="store_true", help="Store the vision configs for offline loading")
+    args = parser.parse_args()
+
+    convert_checkpoint(args.src, args.dst, embed_vision_configs=args.embed_vision_configs)
+    src_size = Path(args.src).stat().st_size / 2**20
+    dst_size = (Path(args.dst) / SAFETENSORS_WEIGHTS_FILE).stat().st_size / 2**20
+    print(f"Wrote {args.dst}: {dst_size:.1f} MiB of weights ({src_size:.1f} MiB before)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+Write a weight-only quantized copy of a NitroGen checkpoint.
+
+int8 stores every weight matrix as int8 with a float32 scale per output channel (about a
+quarter of the float32 size), bfloat16 halves it, none keeps the weights. serve.py loads
+the result like any other checkpoint.
+
+With --embed-vision-configs, the vision encoder and image processor configs are fetched
+once and stored in the copy, so that serve.py starts without any network access.
+
+    python scripts/export_checkpoint.py models/nvidia/NitroGen/ng.pt models/nvidia/NitroGen/ng.int8.pt
+"""
+import os
+import argparse
+
+from nitrogen.quantization import CHECKPOINT_WEIGHT_DTYPES, quantize_checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a quantized NitroGen checkpoint")
+    parser.add_argument("src", type=str, help="Monolithic checkpoint (.pt)")
+    parser.add_argument("dst", type=str, help="Output checkpoint")
+    parser.add_argument("--weight-dtype", type=str, default="int8", choices=CHECKPOINT_WEIGHT_DTYPES + ["none"])
+    parser.add_argument("--embed-vision-configs", action="store_true", help="Store the vision configs for offline loading")
+    args = parser.parse_args()
+
+    weight_dtype = None if args.weight_dtype == "none" else args.weight_dtype
+    quantize_checkpoint(args.src, args.dst, weight_dtype, embed_vision_configs=args.embed_vision_configs)
+    src_size = os.path.getsize(args.src) / 2**20
+    dst_size = os.path.getsize(args.dst) / 2**20
+    print(f"Wrote {args.dst}: {dst_size:.1f} MiB ({src_size:.1f} MiB before, {args.weight_dtype} weights)")
+
+
+if __name__ == "__main__":
+    main()
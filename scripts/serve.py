@@ -1,5 +1,6 @@
 import zmq
 import datetime
+import gc
 import os
 import time
 import argparse
@@ -7,13 +8,206 @@ import pickle
 import struct
 import json
 import socket
+import queue
 import numpy as np
 import cv2
 import threading
-from nitrogen.inference_session import InferenceSession
+import itertools
+import traceback
+import torch
+from collections import defaultdict, deque
+from contextlib import ExitStack
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from nitrogen.inference_session import InferenceSession, predict_batch, scene_signature, set_num_threads
+from nitrogen.flow_matching_transformer.solvers import ODE_SOLVERS, TIME_GRIDS
+from nitrogen.quantization import QUANTIZATION_MODES
 
-# Lock to ensure thread safety for the stateful InferenceSession
-session_lock = threading.Lock()
+# Session of the clients that do not send a session ID
+DEFAULT_SESSION_ID = "default"
+
+
+class SessionManager:
+    """
+    Client sessions on top of one shared model. Each session keeps its own context
+    buffers, game selection and sampler settings; it is forked from `template` on first
+    use and evicted after `idle_timeout_s` seconds without requests (None keeps it).
+    With a `loader`, a function returning a new template session for a checkpoint, the
+    model can be swapped while serving (see reload); with a `reload_dir`, reload requests
+    can only load files inside it.
+    """
+
+    def __init__(self, template, idle_timeout_s=600.0, loader=None, reload_dir=None):
+        self.template = template
+        self.idle_timeout_s = idle_timeout_s
+        self.sessions = {}
+        self.last_used = {}
+        self.lock = threading.Lock()
+        self.loader = loader
+        self.reload_dir = None if reload_dir is None else Path(reload_dir).resolve()
+        # Held while a reload runs, reload_status describes the last one
+        self.reload_lock = threading.Lock()
+        self.reload_status = {"status": "idle"}
+
+    def get(self, session_id=DEFAULT_SESSION_ID):
+        with self.lock:
+            self._evict_idle()
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = self.template.fork()
+                print(f"Opened session {session_id} ({len(self.sessions)} active)", flush=True)
+            self.last_used[session_id] = time.monotonic()
+            return session
+
+    def close(self, session_id):
+        with self.lock:
+            if self.sessions.pop(session_id, None) is not None:
+                del self.last_used[session_id]
+                print(f"Closed session {session_id} ({len(self.sessions)} active)", flush=True)
+
+    def _evict_idle(self):
+        if self.idle_timeout_s is None:
+            return
+        now = time.monotonic()
+        for session_id, last_used in list(self.last_used.items()):
+            # A session in the middle of a request is not idle, however long it takes
+            if now - last_used > self.idle_timeout_s and not self.sessions[session_id].lock.locked():
+                del self.sessions[session_id], self.last_used[session_id]
+                print(f"Evicted idle session {session_id} ({len(self.sessions)} active)", flush=True)
+
+    def swap(self, template):
+        """
+        Make `template` the template of new sessions and move the open ones onto it (see
+        InferenceSession.rebind), each once its in-flight request has finished on the old
+        model. Returns the previous template.
+        """
+        with self.lock:
+            previous, self.template = self.template, template
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            with session.lock:
+                session.rebind(template)
+        return previous
+
+    def reload(self, **options):
+        """
+        Start loading a new template with loader(**options) on a background thread; it is
+        warmed up with one prediction, swapped in and the old model freed, while the
+        sessions keep serving on the old model. Raises ValueError when reloading is
+        disabled, a path lies outside reload_dir or a reload is already running.
+        """
+        if self.loader is None:
+            raise ValueError("Checkpoint reloading is disabled, start the server with --allow-reload")
+        self._check_reload_paths(options)
+        if not self.reload_lock.acquire(blocking=False):
+            raise ValueError("A checkpoint reload is already running")
+        self.reload_status = {"status": "loading", **options}
+        threading.Thread(target=self._reload, kwargs=options, daemon=True).start()
+
+    def _check_reload_paths(self, options):
+        # Checkpoints are unpickled, so a client must not point the loader at arbitrary files
+        paths = [options.get("ckpt"), options.get("base_model")]
+        lora_adapters = options.get("lora_adapters") or {}
+        if not isinstance(lora_adapters, dict):
+            raise ValueError("lora_adapters must map adapter names to paths")
+        paths.extend(lora_adapters.values())
+        for path in paths:
+            if path is None:
+                continue
+            if not isinstance(path, str):
+                raise ValueError(f"Expected a path, got {path!r}")
+            if self.reload_dir is not None and not Path(path).resolve().is_relative_to(self.reload_dir):
+                raise ValueError(f"{path} is outside the reload directory {self.reload_dir}")
+
+    def _reload(self, **options):
+        start_time = time.perf_counter()
+        try:
+            template = self.loader(**options)
+            game = self.template.selected_game
+            if game is not None and template.game_mapping is not None and game in template.game_mapping:
+                template.configure(selected_game=game)
+            # Run the kernels once before the clients do
+            template.fork().predict(np.zeros((256, 256, 3), dtype=np.uint8))
+            previous = self.swap(template)
+            print(f"Reloaded {template.ckpt_path} in {time.perf_counter() - start_time:.1f}s", flush=True)
+            self.reload_status = {"status": "done", **options, "seconds": time.perf_counter() - start_time}
+        except Exception as e:
+            traceback.print_exc()
+            self.reload_status = {"status": "failed", **options, "message": str(e)}
+            return
+        finally:
+            self.reload_lock.release()
+        # Free the old weights now rather than whenever the garbage collector runs
+        device = previous.device
+        del previous
+        gc.collect()
+        if torch.device(device).type == "cuda":
+            torch.cuda.empty_cache()
+
+
+class BatchScheduler:
+    """
+    Runs the predict requests of concurrent clients in batches. After the first pending
+    request, it waits up to `max_wait_ms` for up to `max_batch_size` requests, then runs
+    each group of compatible requests (see InferenceSession.batch_key) as one sampler
+    call. Requests of the same session run in arrival order, one per batch.
+    """
+
+    def __init__(self, max_batch_size=8, max_wait_ms=2.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, session, image, predict_kwargs=None):
+        """Queue a predict request, the future resolves to (result, num_steps)."""
+        future = Future()
+        self.requests.put((session, image, predict_kwargs or {}, future))
+        return future
+
+    def _collect(self):
+        pending = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000.0
+        while len(pending) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return pending
+
+    @staticmethod
+    def make_batches(pending):
+        """Split pending requests into batches of distinct, compatible sessions, in arrival order."""
+        rounds = defaultdict(lambda: defaultdict(list))
+        seen = defaultdict(int)
+        for request in pending:
+            session, _, predict_kwargs, _ = request
+            # The n-th request of a session goes to round n so that it sees the state of the previous one
+            round_index = seen[id(session)]
+            seen[id(session)] += 1
+            rounds[round_index][session.batch_key(predict_kwargs.get("tolerance"))].append(request)
+        return [batch for round_index in sorted(rounds) for batch in rounds[round_index].values()]
+
+    def _run(self):
+        while True:
+            for batch in self.make_batches(self._collect()):
+                try:
+                    with ExitStack() as stack:
+                        # Always lock sessions in the same order so that batches cannot deadlock
+                        for session in sorted({id(s): s for s, _, _, _ in batch}.values(), key=id):
+                            stack.enter_context(session.lock)
+                        results = predict_batch([(session, image, kwargs) for session, image, kwargs, _ in batch])
+                        num_steps = [session.last_num_steps for session, _, _, _ in batch]
+                except Exception as e:
+                    for _, _, _, future in batch:
+                        future.set_exception(e)
+                    continue
+                for (_, _, _, future), result, steps in zip(batch, results, num_steps):
+                    future.set_result((result, steps))
 
 def preprocess_image(img, mode="pad"):
     """
@@ -69,68 +263,173 @@ def preprocess_image(img, mode="pad"):
         return cv2.resize(img, target_size, interpolation=cv2.INTER_AREA)
     return img
 
-def handle_request(session, request, raw_image=None, debug_mode=False, debug_dir="debug", original_image=None):
-    """Universal request handler for ZeroMQ+Pickle and TCP+JSON+RawBytes protocols."""
-    with session_lock:
-        if request["type"] == "reset":
+def handle_request(session, request, raw_image=None, debug_mode=False, debug_dir="debug", original_image=None, scheduler=None, pixel_values=None, signature=None):
+    """
+    Universal request handler for ZeroMQ+Pickle and TCP+JSON+RawBytes protocols.
+    With a `scheduler` (BatchScheduler), predict requests are batched with other clients'.
+    `pixel_values` is the image already run through the session's image processor and
+    `signature` its scene_signature.
+    """
+    if request["type"] == "reset":
+        with session.lock:
             session.reset()
-            return {"status": "ok"}
-        elif request["type"] == "info":
+        return {"status": "ok"}
+    elif request["type"] == "info":
+        with session.lock:
             return {"status": "ok", "info": session.info()}
-        elif request["type"] == "predict":
-            # If this is a Pickle request, the image is already inside the object
-            image = raw_image if raw_image is not None else request.get("image")
-            
-            # Save debug artifacts if enabled
-            if debug_mode:
+    elif request["type"] == "configure":
+        # Per-session settings, e.g. {"type": "configure", "selected_game": ..., "cfg_scale": 2.0}
+        settings = {key: request[key] for key in session.CONFIGURABLE_SETTINGS if key in request}
+        with session.lock:
+            try:
+                session.configure(**settings)
+            except ValueError as e:
+                return {"status": "error", "message": str(e)}
+            return {"status": "ok", "info": session.info()}
+    elif request["type"] == "predict":
+        # If this is a Pickle request, the image is already inside the object
+        image = raw_image if raw_image is not None else request.get("image")
+
+        # A request may switch the session to another LoRA adapter (see --lora-adapter)
+        if "lora_adapter" in request and request["lora_adapter"] != session.lora_adapter:
+            with session.lock:
                 try:
-                    os.makedirs(debug_dir, exist_ok=True)
-                    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-                    prefix = f"{timestamp}"
-                    
-                    # 1. Received Image (Original)
-                    if original_image is not None:
-                        # Convert RGB back to BGR for cv2.imwrite
-                        cv2.imwrite(os.path.join(debug_dir, f"{prefix}_1_received.png"), cv2.cvtColor(original_image, cv2.COLOR_RGB2BGR))
-                    elif image is not None:
-                         # Fallback if original not provided separately
-                         cv2.imwrite(os.path.join(debug_dir, f"{prefix}_1_received.png"), cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
-
-                    # 2. JSON Parameters
-                    with open(os.path.join(debug_dir, f"{prefix}_2_params.json"), "w") as f:
-                        # Filter out large data if strictly needed, but request usually just has metadata + array
-                        # We should be careful not to dump huge arrays in text. 
-                        # The 'request' dict might contain the image if it's ZMQ pickle.
-                        # Create a safe copy for logging
-                        log_req = {k: v for k, v in request.items() if k != "image"}
-                        json.dump(log_req, f, indent=4)
-                    
-                    # 3. Image sent to model (Processed)
-                    if image is not None:
-                         cv2.imwrite(os.path.join(debug_dir, f"{prefix}_3_processed.png"), cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+                    session.configure(lora_adapter=request["lora_adapter"])
+                except ValueError as e:
+                    return {"status": "error", "message": str(e)}
+        
+        # Save debug artifacts if enabled
+        if debug_mode:
+            try:
+                os.makedirs(debug_dir, exist_ok=True)
+                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+                prefix = f"{timestamp}"
+                
+                # 1. Received Image (Original)
+                if original_image is not None:
+                    # Convert RGB back to BGR for cv2.imwrite
+                    cv2.imwrite(os.path.join(debug_dir, f"{prefix}_1_received.png"), cv2.cvtColor(original_image, cv2.COLOR_RGB2BGR))
+                elif image is not None:
+                     # Fallback if original not provided separately
+                     cv2.imwrite(os.path.join(debug_dir, f"{prefix}_1_received.png"), cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
 
-                except Exception as e:
-                    print(f"Debug logging error: {e}")
+                # 2. JSON Parameters
+                with open(os.path.join(debug_dir, f"{prefix}_2_params.json"), "w") as f:
+                    # Filter out large data if strictly needed, but request usually just has metadata + array
+                    # We should be careful not to dump huge arrays in text. 
+                    # The 'request' dict might contain the image if it's ZMQ pickle.
+                    # Create a safe copy for logging
+                    log_req = {k: v for k, v in request.items() if k != "image"}
+                    json.dump(log_req, f, indent=4)
+                
+                # 3. Image sent to model (Processed)
+                if image is not None:
+                     cv2.imwrite(os.path.join(debug_dir, f"{prefix}_3_processed.png"), cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
 
-            result = session.predict(image)
+            except Exception as e:
+                print(f"Debug logging error: {e}")
 
-            if debug_mode:
-                try:
-                     # 4. Model Response
-                    with open(os.path.join(debug_dir, f"{prefix}_4_response.json"), "w") as f:
-                        # Convert numpy types to native types for JSON serialization
-                        def default_converter(o):
-                            if isinstance(o, np.integer): return int(o)
-                            if isinstance(o, np.floating): return float(o)
-                            if isinstance(o, np.ndarray): return o.tolist()
-                            raise TypeError
-                        json.dump(result, f, indent=4, default=default_converter)
-                except Exception as e:
-                    print(f"Debug logging response error: {e}")
+        # Optional per-request adaptive stopping (see InferenceSession.predict)
+        predict_kwargs = {
+            key: request[key] for key in ("tolerance", "latency_budget_ms") if request.get(key) is not None
+        }
+        if pixel_values is not None:
+            predict_kwargs["pixel_values"] = pixel_values
+        if signature is not None:
+            predict_kwargs["signature"] = signature
+        if scheduler is not None:
+            result, num_steps = scheduler.submit(session, image, predict_kwargs).result()
+        else:
+            with session.lock:
+                result = session.predict(image, **predict_kwargs)
+                num_steps = session.last_num_steps
+
+        if debug_mode:
+            try:
+                 # 4. Model Response
+                with open(os.path.join(debug_dir, f"{prefix}_4_response.json"), "w") as f:
+                    # Convert numpy types to native types for JSON serialization
+                    def default_converter(o):
+                        if isinstance(o, np.integer): return int(o)
+                        if isinstance(o, np.floating): return float(o)
+                        if isinstance(o, np.ndarray): return o.tolist()
+                        raise TypeError
+                    json.dump(result, f, indent=4, default=default_converter)
+            except Exception as e:
+                print(f"Debug logging response error: {e}")
 
-            return {"status": "ok", "pred": result, "repeat": session.action_downsample_ratio}
-        return {"status": "error", "message": "Unknown type"}
+        return {
+            "status": "ok",
+            "pred": result,
+            "repeat": session.action_downsample_ratio,
+            "num_steps": num_steps,
+        }
+    return {"status": "error", "message": "Unknown type"}
+
+
+def handle_client_request(sessions, request, session_id=DEFAULT_SESSION_ID, **kwargs):
+    """
+    Route a request to its client session: the request's "session_id", or `session_id`
+    when it has none. A "close" request drops the session, "reload" starts a checkpoint
+    reload (see SessionManager.reload) and "reload_status" reports on it; everything else
+    goes to handle_request.
+    """
+    session_id = request.get("session_id", session_id)
+    if request["type"] == "close":
+        sessions.close(session_id)
+        response = {"status": "ok"}
+    elif request["type"] == "reload":
+        # e.g. {"type": "reload", "ckpt": ..., "base_model": ..., "lora_adapters": {name: path}}
+        options = {key: request[key] for key in ("ckpt", "base_model", "lora_adapters", "default_lora_adapter") if key in request}
+        try:
+            sessions.reload(**options)
+            response = {"status": "ok", "reload": sessions.reload_status}
+        except ValueError as e:
+            response = {"status": "error", "message": str(e)}
+    elif request["type"] == "reload_status":
+        response = {"status": "ok", "reload": sessions.reload_status}
+    else:
+        response = handle_request(sessions.get(session_id), request, **kwargs)
+    response["session_id"] = session_id
+    return response
+
+
+def read_exact(conn, size):
+    """Reads `size` bytes from the connection, fewer if it closes first."""
+    raw_data = b""
+    while len(raw_data) < size:
+        target = size - len(raw_data)
+        chunk = conn.recv(target)
+        if not chunk: 
+            break
+        raw_data += chunk
+    return raw_data
 
+def decode_image(raw_data, resize_mode='pad'):
+    """
+    Decodes an image file (BMP, PNG, etc.) or raw 256x256 RGB bytes.
+    Returns the preprocessed and original RGB images, or (None, None).
+    """
+    # Try to decode as generic image (BMP, PNG, etc.) from memory
+    img = np.frombuffer(raw_data, dtype=np.uint8)
+    try:
+        img = cv2.imdecode(img, cv2.IMREAD_COLOR) # Using opencv to decode buffer is safer/easier
+        if img is not None:
+            # OpenCV loads as BGR. 
+            # We need RGB.
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            original_img = img.copy()
+            img = preprocess_image(img, resize_mode)
+            return img, original_img
+    except Exception:
+        pass
+        
+    # Fallback: Assume Raw RGB 256x256x3
+    expected_raw = 256 * 256 * 3
+    if len(raw_data) == expected_raw:
+        img = np.frombuffer(raw_data, dtype=np.uint8).reshape(256, 256, 3).copy()
+        return img, img.copy()
+    return None, None
 
 def read_image_from_conn(conn, expected_size=None, resize_mode='pad'):
     """
@@ -139,34 +438,9 @@ def read_image_from_conn(conn, expected_size=None, resize_mode='pad'):
     Otherwise, detects BMP format by checking for 'BM' signature.
     """
     if expected_size is not None:
-        raw_data = b""
-        while len(raw_data) < expected_size:
-            target = expected_size - len(raw_data)
-            chunk = conn.recv(target)
-            if not chunk: 
-                break
-            raw_data += chunk
-            
+        raw_data = read_exact(conn, expected_size)
         if len(raw_data) == expected_size:
-             # Try to decode as generic image (BMP, PNG, etc.) from memory
-             img = np.frombuffer(raw_data, dtype=np.uint8)
-             try:
-                 img = cv2.imdecode(img, cv2.IMREAD_COLOR) # Using opencv to decode buffer is safer/easier
-                 if img is not None:
-                     # OpenCV loads as BGR. 
-                     # We need RGB.
-                     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                     original_img = img.copy()
-                     img = preprocess_image(img, resize_mode)
-                     return img, original_img
-             except Exception:
-                 pass
-                 
-             # Fallback: Assume Raw RGB 256x256x3
-             expected_raw = 256 * 256 * 3
-             if len(raw_data) == expected_raw:
-                  img = np.frombuffer(raw_data, dtype=np.uint8).reshape(256, 256, 3).copy()
-                  return img, img.copy()
+            return decode_image(raw_data, resize_mode)
         return None, None
 
     # 1. Peek/Read first 2 bytes to check for BMP signature 'BM'
@@ -283,8 +557,13 @@ def read_image_from_conn(conn, expected_size=None, resize_mode='pad'):
         
     return None, None
 
-def run_zmq_server(session, port, debug_mode=False, debug_dir="debug"):
-    """Runs the ZeroMQ server (original protocol)."""
+def run_zmq_server(sessions, port, debug_mode=False, debug_dir="debug", scheduler=None):
+    """
+    Runs the ZeroMQ server (original protocol). Requests without a "session_id" share
+    the default session.
+    """
+    if scheduler is not None:
+        return run_zmq_router(sessions, port, scheduler, debug_mode=debug_mode, debug_dir=debug_dir)
     context = zmq.Context()
     socket_zmq = context.socket(zmq.REP)
     socket_zmq.bind(f"tcp://*:{port}")
@@ -296,7 +575,7 @@ def run_zmq_server(session, port, debug_mode=False, debug_dir="debug"):
             req = pickle.loads(msg)
             # For ZMQ, we don't distinguish original vs processed in quite the same way yet
             # as it's often sent pre-processed or we treat it as is.
-            res = handle_request(session, req, debug_mode=debug_mode, debug_dir=debug_dir) 
+            res = handle_client_request(sessions, req, debug_mode=debug_mode, debug_dir=debug_dir) 
             # Note: We didn't pipe flags to run_zmq_server yet or update its signature, 
             # but user request emphasizes "received image" which implies the TCP/file path mostly.
             # However, ZMQ is also a "request".
@@ -309,7 +588,213 @@ def run_zmq_server(session, port, debug_mode=False, debug_dir="debug"):
         except Exception as e:
             print(f"ZMQ Error: {e}")
 
-def run_tcp_server(session, port, debug_mode=False, debug_dir="debug"):
+def run_zmq_router(sessions, port, scheduler, debug_mode=False, debug_dir="debug"):
+    """
+    ZeroMQ server for batched serving: a ROUTER socket (compatible with the REQ clients)
+    keeps many requests in flight and handles them on worker threads. ZeroMQ sockets are
+    not thread-safe, so the workers hand their replies back over an inproc socket each,
+    and this thread sleeps in one poll on both until a request or a reply arrives.
+    """
+    context = zmq.Context()
+    socket_zmq = context.socket(zmq.ROUTER)
+    socket_zmq.bind(f"tcp://*:{port}")
+    replies = context.socket(zmq.PULL)
+    replies.bind("inproc://replies")
+    print(f"ZMQ Server (batched) running on port {port}", flush=True)
+
+    workers = ThreadPoolExecutor(max_workers=4 * scheduler.max_batch_size)
+    worker_sockets = threading.local()
+
+    def handle(identity, msg):
+        try:
+            res = handle_client_request(sessions, pickle.loads(msg), debug_mode=debug_mode, debug_dir=debug_dir, scheduler=scheduler)
+        except Exception as e:
+            print(f"ZMQ Error: {e}")
+            res = {"status": "error", "message": str(e)}
+        sender = getattr(worker_sockets, "sender", None)
+        if sender is None:
+            sender = worker_sockets.sender = context.socket(zmq.PUSH)
+            sender.connect("inproc://replies")
+        sender.send_multipart([identity, b"", pickle.dumps(res)])
+
+    poller = zmq.Poller()
+    poller.register(socket_zmq, zmq.POLLIN)
+    poller.register(replies, zmq.POLLIN)
+    while True:
+        events = dict(poller.poll())
+        if socket_zmq in events:
+            identity, empty, msg = socket_zmq.recv_multipart()
+            workers.submit(handle, identity, msg)
+        if replies in events:
+            socket_zmq.send_multipart(replies.recv_multipart())
+
+def send_json_response(conn, res):
+    """Serializes a response as a JSON line, with the predicted actions as lists."""
+    # Convert numpy to lists for JSON
+    if "pred" in res:
+        res["pred"] = {k: v.tolist() for k, v in res["pred"].items()}
+    
+    response_json = json.dumps(res)
+    conn.sendall((response_json + "\n").encode('utf-8'))
+
+
+class PipelineStage:
+    """A thread pool that admits at most `max_pending` requests, running or queued."""
+
+    def __init__(self, name, workers, max_pending):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def run(self, fn, *args, **kwargs):
+        with self.slots:
+            return self.pool.submit(fn, *args, **kwargs).result()
+
+
+class RequestPipeline:
+    """
+    Staged processing of TCP requests. The connection threads only do socket I/O; image
+    decoding and preprocessing (decode_image, preprocess_image and the image processor)
+    run on the preprocess stage, the model on the model stage and JSON serialization on
+    the serialize stage. Each stage has its own thread pool and bounded admission, so one
+    client's frame is decoded while another's is on the model, and a burst of clients
+    waits at the stage boundaries instead of oversubscribing the CPU.
+
+    A connection keeps up to `connection_depth` requests in flight (see submit): its next
+    frame is decoded while the previous one is still on the model or being sent.
+    """
+
+    def __init__(self, preprocess_workers=4, model_workers=4, serialize_workers=2, max_pending=64, connection_depth=2):
+        self.preprocess = PipelineStage("preprocess", preprocess_workers, max_pending)
+        self.model = PipelineStage("model", model_workers, max_pending)
+        self.serialize = PipelineStage("serialize", serialize_workers, max_pending)
+        self.connection_depth = connection_depth
+        # Runs each request through the stages. A request only waits for earlier ones,
+        # which this FIFO pool started first, so any number of workers cannot deadlock.
+        self.requests = ThreadPoolExecutor(max_workers=max_pending, thread_name_prefix="request")
+
+    @staticmethod
+    def _preprocess(session, raw_data, image, original_image, resize_mode):
+        if raw_data is not None:
+            image, original_image = decode_image(raw_data, resize_mode)
+        if image is None:
+            return None, None, None, None
+        if session.scene_cache_threshold is None:
+            return image, original_image, session.process_frame(image), None
+        # Frames the scene cache will answer skip the image processor. This only peeks at
+        # the cache: if it changes meanwhile, predict processes the frame itself.
+        signature = scene_signature(image)
+        pixel_values = None if session.scene_cache_peek(signature) == "reuse" else session.process_frame(image)
+        return image, original_image, pixel_values, signature
+
+    def submit(self, conn, sessions, request, session_id, after=None, **kwargs):
+        """
+        Start one request through the stages without waiting for it, returns the Future of
+        its process result. `after` is the Future of the connection's previous request:
+        this one is preprocessed right away, but reaches the model only once that one has
+        been answered, so the session sees the requests in order and the responses go out
+        in order.
+        """
+        return self.requests.submit(self.process, conn, sessions, request, session_id, after=after, **kwargs)
+
+    def process(self, conn, sessions, request, session_id, raw_data=None, image=None, original_image=None, after=None, **kwargs):
+        """
+        Runs one request through the stages and sends its response. `raw_data` is the
+        undecoded image of a predict request, or `image`/`original_image` when it was
+        decoded while reading; `after` as in submit. Returns False when the image could
+        not be decoded.
+        """
+        pixel_values = signature = None
+        if request.get("type") == "predict":
+            session = sessions.get(request.get("session_id", session_id))
+            image, original_image, pixel_values, signature = self.preprocess.run(
+                self._preprocess, session, raw_data, image, original_image, request.get("resize_mode", "pad")
+            )
+            if image is None:
+                return False
+        if after is not None:
+            wait([after])
+        res = self.model.run(
+            handle_client_request, sessions, request, session_id,
+            raw_image=image, original_image=original_image, pixel_values=pixel_values, signature=signature, **kwargs,
+        )
+        self.serialize.run(send_json_response, conn, res)
+        return True
+
+def handle_tcp_connection(sessions, conn, session_id, debug_mode=False, debug_dir="debug", scheduler=None, pipeline=None):
+    """
+    Serves the requests of one TCP client until it disconnects. Requests without a
+    "session_id" use the connection's own session `session_id`, closed on disconnect.
+    With a `pipeline` (RequestPipeline), this thread only reads the requests and reads
+    the next one while up to pipeline.connection_depth are in flight.
+    """
+    in_flight = deque()
+    try:
+        while True:
+            # 1. Read request header (JSON string until \n)
+            # Read byte by byte until newline to avoid over-reading the pixel data
+            line_bytes = b""
+            while True:
+                char = conn.recv(1)
+                if not char: 
+                    break # Connection closed or empty
+                if char == b'\n':
+                    break
+                line_bytes += char
+            
+            if not line_bytes: 
+                break
+
+            try:
+                req = json.loads(line_bytes.decode('utf-8'))
+            except json.JSONDecodeError:
+                print("Invalid JSON received")
+                break
+
+            img = None
+            original_img = None
+            raw_data = None
+            
+            if req.get("type") == "predict":
+                expected_len = req.get("len")
+                resize_mode = req.get("resize_mode", "pad")
+                if pipeline is not None and expected_len is not None:
+                    # Only read the bytes here, the preprocess stage decodes them
+                    raw_data = read_exact(conn, expected_len)
+                    if len(raw_data) != expected_len:
+                        print("Incomplete or invalid image data received")
+                        break
+                else:
+                    img, original_img = read_image_from_conn(conn, expected_size=expected_len, resize_mode=resize_mode)
+                    if img is None:
+                        print("Incomplete or invalid image data received")
+                        break
+
+            # 3. Process and send JSON response
+            if pipeline is not None:
+                in_flight.append(pipeline.submit(
+                    conn, sessions, req, session_id, after=in_flight[-1] if in_flight else None,
+                    raw_data=raw_data, image=img, original_image=original_img,
+                    debug_mode=debug_mode, debug_dir=debug_dir, scheduler=scheduler,
+                ))
+                # Wait for the oldest requests only when too many are in flight
+                while in_flight and (len(in_flight) >= pipeline.connection_depth or in_flight[0].done()):
+                    if not in_flight.popleft().result():
+                        print("Incomplete or invalid image data received")
+                        return
+                continue
+            res = handle_client_request(sessions, req, session_id, raw_image=img, debug_mode=debug_mode, debug_dir=debug_dir, original_image=original_img, scheduler=scheduler)
+            send_json_response(conn, res)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"TCP Connection error: {e}", flush=True)
+    finally:
+        # Let the requests still in flight finish before the connection goes away
+        wait(in_flight)
+        conn.close()
+        sessions.close(session_id)
+
+def run_tcp_server(sessions, port, debug_mode=False, debug_dir="debug", scheduler=None, pipeline=None):
     """Runs the simple TCP server (for BizHawk/Lua)."""
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
@@ -318,81 +803,150 @@ def run_tcp_server(session, port, debug_mode=False, debug_dir="debug"):
         print(f"Error binding TCP port {port}: {e}")
         return
 
-    server.listen(1)
+    # Clients are served concurrently, one thread each (see handle_request for locking)
+    server.listen(64)
     print(f"Simple TCP Server (JSON+Bytes) running on port {port}", flush=True)
     
+    connection_ids = itertools.count(1)
     while True:
         conn, addr = server.accept()
         # print(f"TCP Client connected from {addr}")
-        try:
-            while True:
-                # 1. Read request header (JSON string until \n)
-                # Read byte by byte until newline to avoid over-reading the pixel data
-                line_bytes = b""
-                while True:
-                    char = conn.recv(1)
-                    if not char: 
-                        break # Connection closed or empty
-                    if char == b'\n':
-                        break
-                    line_bytes += char
-                
-                if not line_bytes: 
-                    break
-
-                try:
-                    req = json.loads(line_bytes.decode('utf-8'))
-                except json.JSONDecodeError:
-                    print("Invalid JSON received")
-                    break
-
-                img = None
-                original_img = None
-                
-                if req.get("type") == "predict":
-                    expected_len = req.get("len")
-                    resize_mode = req.get("resize_mode", "pad")
-                    img, original_img = read_image_from_conn(conn, expected_size=expected_len, resize_mode=resize_mode)
-                    if img is None:
-                        print("Incomplete or invalid image data received")
-                        break
-
-                # 3. Process and send JSON response
-                res = handle_request(session, req, raw_image=img, debug_mode=debug_mode, debug_dir=debug_dir, original_image=original_img)
-                
-                # Convert numpy to lists for JSON
-                if "pred" in res:
-                    res["pred"] = {k: v.tolist() for k, v in res["pred"].items()}
-                
-                response_json = json.dumps(res)
-                conn.sendall((response_json + "\n").encode('utf-8'))
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print(f"TCP Connection error: {e}", flush=True)
-        finally:
-            conn.close()
+        threading.Thread(
+            target=handle_tcp_connection,
+            args=(sessions, conn, f"tcp-{next(connection_ids)}", debug_mode, debug_dir, scheduler, pipeline),
+            daemon=True,
+        ).start()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("ckpt", type=str)
     parser.add_argument("--base-model", type=str, default="models/nvidia/NitroGen/ng.pt", help="Path to base model (required for LoRA adapters)")
+    parser.add_argument("--lora-cache-dir", type=str, default=None, help="Keep merged LoRA weights in this directory so that later starts skip the merge (default: merge at every start)")
+    parser.add_argument("--lora-adapter", type=str, action="append", default=[], metavar="NAME=PATH", help="Serve this LoRA adapter unmerged under NAME (repeatable); sessions pick one with lora_adapter")
+    parser.add_argument("--default-lora-adapter", type=str, default=None, help="LoRA adapter of new sessions (default: the base model)")
+    parser.add_argument("--lora-cache-max-gb", type=float, default=20.0, help="Evict the least recently used merged LoRA weights in --lora-cache-dir above this size")
     parser.add_argument("--zmq-port", type=int, default=5555, help="Port for ZeroMQ server")
     parser.add_argument("--tcp-port", type=int, default=5556, help="Port for Simple TCP server")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode to save images and jsons")
     parser.add_argument("--debug-dir", type=str, default="debug", help="Directory to save debug files")
+    parser.add_argument("--num-steps", type=int, default=None, help="Denoising steps per action chunk (default: from checkpoint)")
+    parser.add_argument("--solver", type=str, default=None, choices=sorted(ODE_SOLVERS), help="ODE solver for the flow-matching sampler (default: from checkpoint)")
+    parser.add_argument("--time-grid", type=str, default=None, choices=sorted(TIME_GRIDS), help="Time grid for the denoising steps (default: from checkpoint)")
+    parser.add_argument("--strip-vl-padding", action="store_true", default=None, help="Drop the vision-language padding tokens and mask the rest in attention (the model is trained attending to them)")
+    parser.add_argument("--tolerance", type=float, default=None, help="Stop denoising once the relative velocity change between steps is below this value")
+    parser.add_argument("--latency-budget-ms", type=float, default=None, help="Stop denoising early to answer each predict request within this many milliseconds")
+    parser.add_argument("--warm-start-t", type=float, default=None, help="Warm start each chunk from the previous one, re-noised to this time in [0, 1) (default: off)")
+    parser.add_argument("--warm-start-steps", type=int, default=None, help="Denoising steps of a warm-started chunk (default: --num-steps)")
+    parser.add_argument("--warm-start-shift", type=int, default=1, help="Actions the client executes between two predict requests, the previous chunk is shifted by this much")
+    parser.add_argument("--scene-cache-threshold", type=float, default=None, help="Reuse the last action chunk while frames differ from its frame by at most this much, in [0, 1] (default: off)")
+    parser.add_argument("--scene-refresh-steps", type=int, default=None, help="Re-predict cached scenes with this many denoising steps instead of reusing the chunk")
+    parser.add_argument("--scene-cache-max-hits", type=int, default=None, help="Run a full prediction after this many consecutive scene cache hits (default: unlimited)")
+    parser.add_argument("--device", type=str, default="cuda", help="Device to run the model on, e.g. cuda, cuda:1 or cpu")
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=["bfloat16", "float16", "float32"], help="Model and input dtype")
+    parser.add_argument("--num-threads", type=int, default=None, help="Intra-op CPU threads (default: torch default)")
+    parser.add_argument("--num-interop-threads", type=int, default=None, help="Inter-op CPU threads (default: torch default)")
+    parser.add_argument("--quantize", type=str, default=None, choices=QUANTIZATION_MODES, help="Quantize the model after loading (CPU, float32 only)")
+    parser.add_argument("--quantize-check-images", type=str, nargs="*", default=None, help="Frames used to measure the quantized model's action deviation (default: random frames)")
+    parser.add_argument("--session-idle-timeout-s", type=float, default=600.0, help="Evict client sessions after this many seconds without requests")
+    parser.add_argument("--max-batch-size", type=int, default=1, help="Batch up to this many concurrent predict requests into one sampler call (1 disables batching)")
+    parser.add_argument("--batch-wait-ms", type=float, default=2.0, help="How long to wait for more requests after the first one of a batch")
+    parser.add_argument("--preprocess-workers", type=int, default=4, help="Threads decoding and preprocessing TCP images (0 processes each request on its connection thread)")
+    parser.add_argument("--model-workers", type=int, default=4, help="Threads running TCP requests on the model (at least --max-batch-size when batching)")
+    parser.add_argument("--serialize-workers", type=int, default=2, help="Threads serializing TCP responses")
+    parser.add_argument("--max-pending", type=int, default=64, help="Requests admitted per pipeline stage, running or queued")
+    parser.add_argument("--connection-depth", type=int, default=2, help="Requests of one TCP connection in flight at once, the next frame is decoded while the previous one is on the model")
+    parser.add_argument("--max-action-deviation", type=float, default=None, help="Refuse to serve a quantized model whose max action deviation exceeds this value")
+    parser.add_argument("--allow-reload", action="store_true", help="Accept reload requests that swap the checkpoint while serving")
+    parser.add_argument("--reload-dir", type=str, default="models", help="Reload requests can only load checkpoints, base models and adapters inside this directory")
     
     args = parser.parse_args()
 
-    session = InferenceSession.from_ckpt(args.ckpt, base_model_path=args.base_model)
+    set_num_threads(args.num_threads, args.num_interop_threads)
+
+    quantization_check_frames = None
+    if args.quantize_check_images:
+        quantization_check_frames = [
+            preprocess_image(cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB))
+            for path in args.quantize_check_images
+        ]
+
+    def load_session(
+        ckpt=args.ckpt,
+        base_model=args.base_model,
+        lora_adapters=dict(adapter.split("=", 1) for adapter in args.lora_adapter),
+        default_lora_adapter=args.default_lora_adapter,
+        ask_game=False,
+    ):
+        """The template session of a checkpoint with the server settings, also used by reload requests."""
+        session = InferenceSession.from_ckpt(
+            ckpt,
+            base_model_path=base_model,
+            num_steps=args.num_steps,
+            ode_solver=args.solver,
+            time_grid=args.time_grid,
+            strip_vl_padding=args.strip_vl_padding,
+            tolerance=args.tolerance,
+            latency_budget_ms=args.latency_budget_ms,
+            warm_start_t=args.warm_start_t,
+            warm_start_steps=args.warm_start_steps,
+            warm_start_shift=args.warm_start_shift,
+            scene_cache_threshold=args.scene_cache_threshold,
+            scene_refresh_steps=args.scene_refresh_steps,
+            scene_cache_max_hits=args.scene_cache_max_hits,
+            device=args.device,
+            dtype=args.dtype,
+            quantize=args.quantize,
+            quantization_check_frames=quantization_check_frames,
+            lora_cache_dir=args.lora_cache_dir or None,
+            lora_cache_max_bytes=int(args.lora_cache_max_gb * 2**30),
+            lora_adapters=lora_adapters,
+            lora_adapter=default_lora_adapter,
+            ask_game=ask_game,
+        )
+        if args.max_action_deviation is not None and session.quantization_report is not None:
+            max_abs_error = session.quantization_report["max_abs_error"]
+            if max_abs_error > args.max_action_deviation:
+                raise ValueError(
+                    f"Rejecting {args.quantize} model: max action deviation {max_abs_error:.5f} "
+                    f"exceeds --max-action-deviation {args.max_action_deviation}"
+                )
+        return session
+
+    try:
+        session = load_session(ask_game=True)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+    # Every client gets its own session forked from this one, sharing the model
+    sessions = SessionManager(
+        session,
+        idle_timeout_s=args.session_idle_timeout_s,
+        loader=load_session if args.allow_reload else None,
+        reload_dir=args.reload_dir,
+    )
+
+    scheduler = None
+    if args.max_batch_size > 1:
+        scheduler = BatchScheduler(max_batch_size=args.max_batch_size, max_wait_ms=args.batch_wait_ms)
+
+    pipeline = None
+    if args.preprocess_workers > 0:
+        pipeline = RequestPipeline(
+            preprocess_workers=args.preprocess_workers,
+            # Batches only fill up when enough requests wait on the scheduler at once
+            model_workers=max(args.model_workers, args.max_batch_size),
+            serialize_workers=args.serialize_workers,
+            max_pending=args.max_pending,
+            connection_depth=args.connection_depth,
+        )
 
     # Start TCP server in a daemon thread
-    tcp_thread = threading.Thread(target=run_tcp_server, args=(session, args.tcp_port, args.debug, args.debug_dir), daemon=True)
+    tcp_thread = threading.Thread(target=run_tcp_server, args=(sessions, args.tcp_port, args.debug, args.debug_dir, scheduler, pipeline), daemon=True)
     tcp_thread.start()
     time.sleep(0.5)
 
     # Run ZMQ server in the main thread
     try:
-        run_zmq_server(session, args.zmq_port, debug_mode=args.debug, debug_dir=args.debug_dir)
+        run_zmq_server(sessions, args.zmq_port, debug_mode=args.debug, debug_dir=args.debug_dir, scheduler=scheduler)
     except KeyboardInterrupt:
         print("\nShutting down server...")
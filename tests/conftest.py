@@ -1,6 +1,8 @@
 
 import sys
 import os
+import subprocess
+import textwrap
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from unittest.mock import MagicMock, Mock
 
@@ -63,6 +65,8 @@ mock_torch.load = lambda *args, **kwargs: {
 mock_torch.bfloat16 = "bfloat16"
 mock_torch.bool = "bool"
 sys.modules['torch'] = mock_torch
+sys.modules['torch.ao.nn.quantized.dynamic'] = MagicMock()
+sys.modules['torch.ao.quantization'] = MagicMock()
 
 # Mock numpy
 mock_numpy = MagicMock()
@@ -97,6 +101,7 @@ mock_fmt_nitrogen.NitroGen = MagicMock()
 mock_fmt_nitrogen.NitroGen_Config = MockNitroGenConfig
 sys.modules['nitrogen.flow_matching_transformer'] = mock_fmt
 sys.modules['nitrogen.flow_matching_transformer.nitrogen'] = mock_fmt_nitrogen
+sys.modules['nitrogen.flow_matching_transformer.solvers'] = mock_fmt.solvers
 
 # Mock nitrogen.mm_tokenizers
 mock_mm = MagicMock()
@@ -186,9 +191,10 @@ def mock_tokenizer():
     """Create a mock tokenizer."""
     tokenizer = MagicMock()
     
-    # Mock encode to return a dict of tensors
-    tokenizer.encode.return_value = {
+    # Mock encode to return a new dict of tensors per call, like the real tokenizer
+    tokenizer.encode.side_effect = lambda data: {
         "frames": MockTensor(),
+        "images": MockTensor(),
         "buttons": MockTensor()
     }
     
@@ -228,3 +234,35 @@ def inference_session(mock_model, mock_tokenizer, mock_img_proc, mock_ckpt_confi
         context_length=16
     )
     return session
+
+
+_REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+_TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope="session")
+def run_with_torch():
+    """
+    Run a Python snippet against the real torch stack in a subprocess.
+
+    The mocks above replace torch for the whole test process, so numerical checks of the
+    model cannot run in-process. The snippet can import helpers from tests/tiny_model.py.
+    Tests are skipped when the real dependencies are not installed.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([_REPO_ROOT, _TESTS_DIR]))
+    probe = subprocess.run(
+        [sys.executable, "-c", "import torch, diffusers, transformers, polars"],
+        capture_output=True, env=env,
+    )
+
+    def run(code):
+        if probe.returncode != 0:
+            pytest.skip("torch, diffusers, transformers and polars are required")
+        result = subprocess.run(
+            [sys.executable, "-c", textwrap.dedent(code)],
+            capture_output=True, text=True, cwd=_REPO_ROOT, env=env,
+        )
+        assert result.returncode == 0, f"stdout:\n{result.stdout}\nstderr:\n{result.stderr}"
+        return result.stdout
+
+    return run
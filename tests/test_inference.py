@@ -3,6 +3,8 @@ import pytest
 import torch
 import numpy as np
 from collections import deque
+from unittest.mock import MagicMock
+from nitrogen.inference_session import InferenceSession
 
 def test_initialization(inference_session):
     """Test that the session initializes correctly."""
@@ -63,3 +65,274 @@ def test_info(inference_session):
     assert info["ckpt_path"] == "dummy_path.pt"
     assert info["context_length"] == 16
     assert info["cfg_scale"] == 1.5
+
+def test_predict_encodes_only_new_frame(inference_session, mock_model):
+    """Each predict runs the vision encoder on the newest frame only and reuses cached features."""
+    dummy_obs = np.zeros((256, 256, 3), dtype=np.uint8)
+
+    inference_session.predict(dummy_obs)
+    inference_session.predict(dummy_obs)
+
+    assert mock_model.encode_images.call_count == 2
+    assert len(inference_session.feature_buffer) == 2
+
+    data_cond, data_uncond = mock_model.get_action_with_cfg.call_args[0][:2]
+    assert "image_features" in data_cond
+    assert "image_features" in data_uncond
+
+def test_reset_invalidates_feature_cache(inference_session):
+    """Reset must drop the cached vision features along with the frames."""
+    dummy_obs = np.zeros((256, 256, 3), dtype=np.uint8)
+    inference_session.predict(dummy_obs)
+    assert len(inference_session.feature_buffer) == 1
+
+    inference_session.reset()
+
+    assert len(inference_session.feature_buffer) == 0
+
+def test_cfg_inputs_share_frames(inference_session, mock_model, mock_tokenizer):
+    """The cond and uncond inputs must hand the model the same frame stack and features."""
+    mock_tokenizer.encode.side_effect = lambda data: {"frames": data["frames"], "images": torch.zeros(1)}
+    dummy_obs = np.zeros((256, 256, 3), dtype=np.uint8)
+
+    inference_session.predict(dummy_obs)
+
+    data_cond, data_uncond = mock_model.get_action_with_cfg.call_args[0][:2]
+    assert data_cond is not data_uncond
+    assert data_uncond["images"] is data_cond["images"]
+    assert data_uncond["image_features"] is data_cond["image_features"]
+
+def test_predict_passes_latency_budget_as_deadline(inference_session, mock_model):
+    """A latency budget becomes an absolute deadline for the sampler; per-call values override the session."""
+    inference_session.tolerance = 0.01
+    dummy_obs = np.zeros((256, 256, 3), dtype=np.uint8)
+
+    inference_session.predict(dummy_obs)
+    kwargs = mock_model.get_action_with_cfg.call_args.kwargs
+    assert kwargs["tolerance"] == 0.01
+    assert "deadline" not in kwargs
+
+    inference_session.predict(dummy_obs, tolerance=0.1, latency_budget_ms=50)
+    kwargs = mock_model.get_action_with_cfg.call_args.kwargs
+    assert kwargs["tolerance"] == 0.1
+    assert kwargs["deadline"] is not None
+
+def test_session_places_inputs_on_its_device(mock_model, mock_tokenizer, mock_img_proc, mock_ckpt_config):
+    """Inputs follow the session's device and dtype, and float32 disables autocast."""
+    session = InferenceSession(
+        model=mock_model,
+        ckpt_path="dummy_path.pt",
+        tokenizer=mock_tokenizer,
+        img_proc=mock_img_proc,
+        ckpt_config=mock_ckpt_config,
+        game_mapping={"game1": 1},
+        selected_game="game1",
+        old_layout=False,
+        cfg_scale=1.5,
+        action_downsample_ratio=1,
+        device="cpu",
+        dtype="float32",
+    )
+    assert session.info()["device"] == "cpu"
+
+    torch.autocast.reset_mock()
+    session.predict(np.zeros((256, 256, 3), dtype=np.uint8))
+    assert torch.autocast.call_args.kwargs == {"device_type": torch.device("cpu").type, "dtype": torch.float32, "enabled": False}
+
+def test_predict_batch_runs_sessions_in_one_sampler_call(mock_model, mock_tokenizer, mock_img_proc, mock_ckpt_config):
+    """Sessions sharing a model are sampled together, and each keeps its own buffers."""
+    from nitrogen.inference_session import predict_batch
+
+    sessions = [
+        InferenceSession(
+            model=mock_model,
+            ckpt_path="dummy_path.pt",
+            tokenizer=mock_tokenizer,
+            img_proc=mock_img_proc,
+            ckpt_config=mock_ckpt_config,
+            game_mapping={"game1": 1},
+            selected_game="game1",
+            old_layout=False,
+            cfg_scale=1.5,
+            action_downsample_ratio=1,
+            context_length=16,
+        )
+        for _ in range(3)
+    ]
+    assert len({session.batch_key() for session in sessions}) == 1
+    dummy_obs = np.zeros((256, 256, 3), dtype=np.uint8)
+
+    results = predict_batch([(session, dummy_obs, {"latency_budget_ms": 50}) for session in sessions])
+
+    mock_model.get_action_with_cfg.assert_called_once()
+    data_cond, data_uncond = mock_model.get_action_with_cfg.call_args[0][:2]
+    assert data_uncond["image_features"] is data_cond["image_features"]
+    assert len(data_cond["token_layout"]) == 3
+    assert mock_model.get_action_with_cfg.call_args.kwargs["deadline"] is not None
+    assert len(results) == 3
+    assert all(len(session.action_buffer) == 1 and len(session.obs_buffer) == 1 for session in sessions)
+
+def test_fork_shares_the_model_but_not_the_context(inference_session, mock_model):
+    """Forked sessions keep their own buffers and settings on top of the same model."""
+    dummy_obs = np.zeros((256, 256, 3), dtype=np.uint8)
+    inference_session.predict(dummy_obs)
+
+    fork = inference_session.fork(cfg_scale=1.0, selected_game=None)
+
+    assert fork.model is inference_session.model
+    assert len(fork.obs_buffer) == 0 and len(fork.feature_buffer) == 0
+    assert fork.lock is not inference_session.lock
+    assert (fork.cfg_scale, fork.selected_game) == (1.0, None)
+    assert (inference_session.cfg_scale, inference_session.selected_game) == (1.5, "game1")
+
+    fork.predict(dummy_obs)
+    assert len(inference_session.obs_buffer) == 1 and len(fork.obs_buffer) == 1
+
+    with pytest.raises(ValueError):
+        fork.configure(selected_game="unknown game")
+    with pytest.raises(ValueError):
+        fork.configure(device="cpu")
+
+def test_predict_uses_preprocessed_pixel_values(inference_session, mock_img_proc):
+    """Frames already run through process_frame skip the image processor."""
+    dummy_obs = np.zeros((256, 256, 3), dtype=np.uint8)
+    pixel_values = inference_session.process_frame(dummy_obs)
+    assert mock_img_proc.call_count == 1
+
+    inference_session.predict(dummy_obs, pixel_values=pixel_values)
+
+    assert mock_img_proc.call_count == 1
+    assert inference_session.obs_buffer[-1] is pixel_values
+
+def test_predict_warm_starts_from_the_previous_chunk(inference_session, mock_model):
+    """With warm start on, only predicts that follow a chunk start from it, reset starts cold again."""
+    inference_session.warm_start_t = 0.5
+    inference_session.warm_start_steps = 2
+    dummy_obs = np.zeros((256, 256, 3), dtype=np.uint8)
+
+    inference_session.predict(dummy_obs)
+    assert "init_actions" not in mock_model.get_action_with_cfg.call_args.kwargs
+
+    inference_session.predict(dummy_obs)
+    kwargs = mock_model.get_action_with_cfg.call_args.kwargs
+    assert kwargs["init_actions"] is not None
+    assert kwargs["t_start"] == 0.5
+    assert kwargs["num_steps"] == 2
+
+    inference_session.reset()
+    inference_session.predict(dummy_obs)
+    assert "init_actions" not in mock_model.get_action_with_cfg.call_args.kwargs
+
+def test_scene_cache_reuses_or_refreshes_stationary_frames(inference_session, mock_model, monkeypatch):
+    """Frames close to the cached one skip the model or run a refresh, and are counted in info."""
+    import nitrogen.inference_session as inference_module
+    # Frames are plain numbers here, their signature is the number itself
+    monkeypatch.setattr(inference_module, "scene_signature", lambda obs: obs)
+    monkeypatch.setattr(inference_module, "scene_distance", lambda a, b: abs(a - b))
+    inference_session.configure(scene_cache_threshold=0.01, scene_cache_max_hits=2)
+
+    first = inference_session.predict(0.0)
+    # Peeking does not count as a request
+    assert inference_session.scene_cache_peek(0.005) == "reuse"
+    assert inference_session.scene_cache_peek(0.5) is None
+    assert inference_session.predict(0.005) is first
+    assert inference_session.predict(0.01) is first
+    assert mock_model.get_action_with_cfg.call_count == 1
+    assert len(inference_session.obs_buffer) == 1
+
+    # Past scene_cache_max_hits, and on a changed scene, the model runs again
+    inference_session.predict(0.01)
+    inference_session.predict(0.5)
+    assert mock_model.get_action_with_cfg.call_count == 3
+
+    inference_session.configure(scene_refresh_steps=1)
+    inference_session.predict(0.5)
+    inference_session.predict(0.5)
+    assert mock_model.get_action_with_cfg.call_count == 5
+    assert mock_model.get_action_with_cfg.call_args.kwargs["num_steps"] == 1
+
+    stats = inference_session.info()["scene_cache_stats"]
+    assert (stats["requests"], stats["reused"], stats["refreshed"]) == (7, 2, 1)
+    assert abs(stats["hit_rate"] - 3 / 7) < 1e-9
+
+    # A signature computed ahead of time (e.g. by the server) replaces the frame's
+    inference_session.predict(0.9, signature=0.5)
+    assert inference_session.info()["scene_cache_stats"]["refreshed"] == 2
+
+def test_lora_adapter_is_selected_per_session(inference_session, mock_model):
+    """Sessions run with their own unmerged adapter; switching re-encodes the context with it."""
+    mock_model.lora_adapters = {"a": 0}
+    dummy_obs = np.zeros((256, 256, 3), dtype=np.uint8)
+    inference_session.predict(dummy_obs)
+    assert mock_model.encode_images.call_count == 1
+
+    with pytest.raises(ValueError):
+        inference_session.configure(lora_adapter="b")
+    inference_session.configure(lora_adapter="a")
+    assert mock_model.encode_images.call_count == 2
+
+    mock_model.lora_selection.select.reset_mock()
+    inference_session.predict(dummy_obs)
+    mock_model.lora_selection.select.assert_any_call([0])
+    assert inference_session.info()["lora_adapters"] == ["a"]
+
+def test_rebind_moves_the_session_onto_a_reloaded_model(inference_session, mock_model):
+    """A rebound session keeps its settings and context, re-encoded with the new model."""
+    dummy_obs = np.zeros((256, 256, 3), dtype=np.uint8)
+    inference_session.predict(dummy_obs)
+    inference_session.configure(cfg_scale=3.0)
+
+    new_model = MagicMock()
+    template = inference_session.fork()
+    template.model = new_model
+    template.ckpt_path = "new.pt"
+    template.game_mapping = {"game2": 2}
+    template.selected_game = None
+
+    inference_session.rebind(template)
+
+    assert inference_session.model is new_model
+    assert inference_session.info()["ckpt_path"] == "new.pt"
+    assert inference_session.cfg_scale == 3.0
+    # game1 is not in the new game mapping
+    assert inference_session.selected_game is None
+    assert len(inference_session.feature_buffer) == 1
+    new_model.encode_images.assert_called_once()
+    assert inference_session.last_action_tensor is None
+
+def test_predict_with_cfg_matches_the_two_pass_reference(run_with_torch):
+    """InferenceSession.predict with cfg_scale != 1 samples like the original sequential CFG passes."""
+    run_with_torch("""
+        from types import SimpleNamespace
+        import numpy as np
+        import torch
+        from tiny_model import *
+        from nitrogen.inference_session import InferenceSession
+
+        model = make_model()
+        tokenizer = make_tokenizer()
+        ckpt_config = SimpleNamespace(
+            model_cfg=model.config, modality_cfg=SimpleNamespace(frame_per_sample=4, action_interleaving=False)
+        )
+
+        def img_proc(images, return_tensors="pt"):
+            return {"pixel_values": torch.stack([torch.tensor(image).permute(2, 0, 1).float() / 255.0 for image in images])}
+
+        session = InferenceSession(
+            model, "tiny.pt", tokenizer, img_proc, ckpt_config, game_mapping=GAME_MAPPING, selected_game="game1",
+            old_layout=False, cfg_scale=1.5, action_downsample_ratio=1, device="cpu", dtype="float32",
+        )
+        rng = np.random.default_rng(0)
+        frames = [rng.integers(0, 256, (IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.uint8) for _ in range(3)]
+        for frame in frames[:-1]:
+            session.predict(frame)
+        torch.manual_seed(5)
+        session.predict(frames[-1])
+        actions = session.last_action_tensor
+
+        torch.manual_seed(5)
+        noise = torch.randn_like(actions)
+        cond, uncond = session.prepare_model_inputs(torch.cat(list(session.obs_buffer), dim=0))
+        expected = reference_get_action_with_cfg(model, cond, uncond, noise, 1.5)
+        torch.testing.assert_close(actions, expected)
+    """)
@@ -50,6 +50,10 @@ def test_load_lora_checkpoint_success(mock_path):
     
     base_model_path = "base_model.pt"
     ckpt_path = "lora_ckpt"
+    # The base model is a .pt file, not a (safetensors) directory
+    base_path_obj = MagicMock()
+    base_path_obj.is_dir.return_value = False
+    mock_path.side_effect = lambda p: mock_path_obj if p == ckpt_path else base_path_obj
     
     # Mock peft
     mock_peft_model = sys.modules['peft'].PeftModel
@@ -82,3 +86,129 @@ def test_load_lora_checkpoint_missing_base(mock_path):
     # Call and expect error
     with pytest.raises(ValueError, match="no --base-model provided"):
         load_model("lora_ckpt", base_model_path=None)
+
+def test_load_model_device_and_dtype(mock_path):
+    """The model is moved to the requested device and dtype instead of CUDA/bfloat16."""
+    mock_path.return_value.is_dir.return_value = False
+    torch = sys.modules['torch']
+
+    model, *_ = load_model("dummy_ckpt.pt", device="cpu", dtype="float32")
+
+    model.to.assert_called_with("cpu", dtype=torch.float32)
+
+def test_load_model_builds_the_model_without_pretrained_weights(mock_path):
+    """The model is built from the vision config and takes the checkpoint tensors as its parameters."""
+    mock_path.return_value.is_dir.return_value = False
+    nitrogen_module = sys.modules['nitrogen.flow_matching_transformer.nitrogen']
+
+    model, *_ = load_model("dummy_ckpt.pt")
+
+    kwargs = nitrogen_module.NitroGen.call_args.kwargs
+    assert kwargs["vision_encoder_config"] is nitrogen_module.load_vision_encoder_config.return_value
+    assert model.load_state_dict.call_args.kwargs == {"assign": True}
+
+def test_meta_model_takes_the_checkpoint_tensors(run_with_torch):
+    """A model built on the meta device samples like the original once the state dict is assigned."""
+    run_with_torch("""
+        import threading
+        import torch
+        from tiny_model import *
+        from nitrogen.inference_session import materialize_buffers
+
+        model = make_model()
+        other_thread = []
+        with torch.device("meta"):
+            # Modules that other threads build meanwhile stay real
+            thread = threading.Thread(target=lambda: other_thread.append(torch.nn.Linear(2, 2)))
+            thread.start()
+            thread.join()
+            empty = NitroGen(config=model.config, game_mapping=GAME_MAPPING, vision_encoder_config=tiny_siglip_config())
+        assert all(param.is_meta for param in empty.parameters())
+        assert not other_thread[0].weight.is_meta
+
+        state_dict = model.state_dict()
+        empty.load_state_dict(state_dict, assign=True)
+        materialize_buffers(empty)
+        assert not any(buffer.is_meta for buffer in empty.buffers())
+        for name, buffer in model.named_buffers():
+            torch.testing.assert_close(empty.get_buffer(name), buffer)
+        assert empty.action_decoder.layer1.W.data_ptr() == state_dict["action_decoder.layer1.W"].data_ptr()
+
+        cond, _ = make_inputs(make_tokenizer())
+        actions, _ = sample_with_noise(empty.eval().get_action, cond)
+        expected, _ = sample_with_noise(model.get_action, cond)
+        torch.testing.assert_close(actions, expected)
+    """)
+
+def test_safetensors_checkpoint_round_trip(run_with_torch):
+    """Converted checkpoints, plain and int8, load back to the same config, weights and scales."""
+    run_with_torch("""
+        import os
+        import tempfile
+        import torch
+        from tiny_model import *
+        from nitrogen.inference_session import _load_checkpoint_file, convert_checkpoint, is_safetensors_checkpoint
+        from nitrogen.quantization import quantize_checkpoint
+
+        state_dict = make_model().state_dict()
+        with tempfile.TemporaryDirectory() as tmp:
+            src, quantized = os.path.join(tmp, "ng.pt"), os.path.join(tmp, "ng.int8.pt")
+            torch.save({"ckpt_config": {"model_cfg": {}}, "model": state_dict}, src)
+            quantize_checkpoint(src, quantized, "int8")
+
+            for path in (src, quantized):
+                dst = path[:-len(".pt")]
+                convert_checkpoint(path, dst)
+                assert is_safetensors_checkpoint(dst) and not is_safetensors_checkpoint(path)
+                expected, converted = torch.load(path, weights_only=True), _load_checkpoint_file(dst)
+                assert converted["ckpt_config"] == expected["ckpt_config"]
+                assert converted.keys() == expected.keys()
+                for name, tensor in expected["model"].items():
+                    assert torch.equal(converted["model"][name], tensor)
+                if "quantization" in expected:
+                    assert converted["quantization"]["weight_dtype"] == "int8"
+                    for name, scale in expected["quantization"]["scales"].items():
+                        assert torch.equal(converted["quantization"]["scales"][name], scale)
+    """)
+
+def test_lora_cache_reuses_and_evicts_merged_weights(run_with_torch):
+    """Merged weights are keyed by content, reloaded on a hit and evicted least recently used first."""
+    run_with_torch("""
+        import os
+        import tempfile
+        import time
+        import torch
+        from types import SimpleNamespace
+        from tiny_model import *
+        from nitrogen.inference_session import LoraCache, _load_checkpoint_file
+
+        model = make_model()
+        ckpt_config = SimpleNamespace(model_dump=lambda mode: {"model_cfg": {}})
+        img_proc = SimpleNamespace(to_json_string=lambda: '{"image_processor_type": "SiglipImageProcessor"}')
+        with tempfile.TemporaryDirectory() as tmp:
+            base, adapter = os.path.join(tmp, "ng.pt"), os.path.join(tmp, "adapter")
+            torch.save({"w": torch.ones(2)}, base)
+            os.makedirs(adapter)
+            with open(os.path.join(adapter, "adapter_config.json"), "w") as f:
+                f.write("{}")
+
+            cache = LoraCache(os.path.join(tmp, "cache"))
+            key = cache.key(base, adapter, "float32")
+            assert cache.key(base, adapter, "float32") == key
+            assert cache.lookup(key) is None
+            path = cache.store(key, model, ckpt_config, img_proc)
+            assert cache.lookup(key) == path
+            state_dict = _load_checkpoint_file(str(path))["model"]
+            for name, tensor in model.state_dict().items():
+                assert torch.equal(state_dict[name], tensor)
+
+            # Changing the adapter changes the key; the oldest entry goes first
+            time.sleep(0.01)
+            with open(os.path.join(adapter, "adapter_config.json"), "w") as f:
+                f.write('{"r": 8}')
+            other_key = cache.key(base, adapter, "float32")
+            assert other_key != key
+            cache.max_bytes = 1
+            cache.store(other_key, model, ckpt_config, img_proc)
+            assert cache.lookup(key) is None and cache.lookup(other_key) is not None
+    """)
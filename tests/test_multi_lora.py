@@ -0,0 +1,74 @@
+def test_unmerged_adapters_match_merged_weights_per_request(run_with_torch):
+    """Each request of a mixed batch samples like the model with its own adapter merged in."""
+    run_with_torch("""
+        import copy
+        import json
+        import os
+        import tempfile
+        import pytest
+        import torch
+        from safetensors.torch import save_file
+        from tiny_model import *
+        from nitrogen.multi_lora import attach_lora_adapters, select_lora_adapters
+
+        targets = ["model.transformer_blocks.0.attn1.to_q", "model.transformer_blocks.1.attn1.to_v"]
+
+        def save_adapter(path, targets, rank=2, alpha=4):
+            os.makedirs(path)
+            with open(os.path.join(path, "adapter_config.json"), "w") as f:
+                json.dump({"peft_type": "LORA", "r": rank, "lora_alpha": alpha, "bias": "none"}, f)
+            weights = {}
+            for name in targets:
+                linear = model.get_submodule(name)
+                weights[f"base_model.model.{name}.lora_A.weight"] = torch.randn(rank, linear.in_features)
+                weights[f"base_model.model.{name}.lora_B.weight"] = torch.randn(linear.out_features, rank)
+            save_file(weights, os.path.join(path, "adapter_model.safetensors"))
+            return weights
+
+        model = make_model()
+        tokenizer = make_tokenizer()
+        with tempfile.TemporaryDirectory() as tmp:
+            weights = save_adapter(os.path.join(tmp, "a"), targets)
+            save_adapter(os.path.join(tmp, "t"), ["model.timestep_encoder.timestep_embedder.linear_1"])
+            save_adapter(os.path.join(tmp, "v"), ["vision_encoder.encoder.layers.0.self_attn.q_proj"])
+
+            merged = copy.deepcopy(model)
+            with torch.no_grad():
+                for name in targets:
+                    lora_A = weights[f"base_model.model.{name}.lora_A.weight"]
+                    lora_B = weights[f"base_model.model.{name}.lora_B.weight"]
+                    merged.get_submodule(name).weight += 2 * lora_B @ lora_A
+            base = copy.deepcopy(model)
+
+            assert attach_lora_adapters(model, {"a": os.path.join(tmp, "a")}) == {"a": 0}
+            for rejected, reason in (("t", "timestep module"), ("v", "vision encoder module")):
+                with pytest.raises(ValueError, match=reason):
+                    attach_lora_adapters(model, {rejected: os.path.join(tmp, rejected)})
+
+        inputs = [make_inputs(tokenizer, available_frames=n, seed=n) for n in (1, 3)]
+        for item_cond, item_uncond in inputs:
+            item_uncond["images"] = item_cond["images"]
+        cond, uncond = [
+            {key: torch.cat([x[i][key] for x in inputs]) for key in inputs[0][i] if torch.is_tensor(inputs[0][i][key])}
+            for i in (0, 1)
+        ]
+        uncond["images"] = cond["images"]
+        assert cond["images"].shape[1] > 1
+
+        # With the vision features computed ahead of time, as InferenceSession provides them,
+        # and with the vision encoder run on every frame of both requests inside the selection
+        image_features = model.encode_images(cond["images"])
+        for features in (image_features, None):
+            cond["image_features"] = uncond["image_features"] = features
+            with select_lora_adapters(model, ["a", None]):
+                actions, noise = sample_with_noise(model.get_action_with_cfg, cond, uncond, cfg_scale=1.5)
+            for i, reference in ((0, merged), (1, base)):
+                item_cond, item_uncond = inputs[i]
+                expected = reference_get_action_with_cfg(reference, item_cond, item_uncond, noise[i:i + 1], 1.5)
+                torch.testing.assert_close(actions[i:i + 1], expected)
+
+        # Outside a selection, the model is the base model
+        actions, _ = sample_with_noise(model.get_action, inputs[0][0])
+        expected, _ = sample_with_noise(base.get_action, inputs[0][0])
+        torch.testing.assert_close(actions, expected)
+    """)
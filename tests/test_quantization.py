@@ -0,0 +1,77 @@
+def test_int8_dynamic_quantization_stays_close_to_float(run_with_torch):
+    """The quantized model samples actions close to the float model from the same noise."""
+    run_with_torch("""
+        import copy
+        import pytest
+        import torch
+        from tiny_model import *
+        from nitrogen.flow_matching_transformer.nitrogen import CategorySpecificLinear
+        from nitrogen.quantization import DynamicQuantizedCategorySpecificLinear, quantize_model
+
+        # Per-category layers pick each batch item's own weights
+        layer = CategorySpecificLinear(3, 8, 16)
+        quantized = DynamicQuantizedCategorySpecificLinear.from_float(layer)
+        x = torch.randn(4, 5, 8)
+        for cat_ids in (torch.tensor([0, 0, 0, 0]), torch.tensor([2, 0, 1, 2])):
+            torch.testing.assert_close(quantized(x, cat_ids), layer(x, cat_ids), atol=0.02, rtol=0.05)
+
+        model = make_model()
+        reference = copy.deepcopy(model)
+        quantize_model(model)
+        assert isinstance(model.action_decoder.layer2, DynamicQuantizedCategorySpecificLinear)
+        assert not any(isinstance(m, torch.nn.Linear) and type(m) is torch.nn.Linear
+                       for m in model.model.transformer_blocks.modules())
+
+        tokenizer = make_tokenizer()
+        cond, uncond = make_inputs(tokenizer)
+        actions, noise = sample_with_noise(model.get_action_with_cfg, cond, uncond, cfg_scale=1.5)
+        expected, _ = sample_with_noise(reference.get_action_with_cfg, cond, uncond, cfg_scale=1.5)
+        error = (actions - expected).abs()
+        assert error.mean() < 0.1 * expected.abs().mean()
+
+        with pytest.raises(ValueError):
+            quantize_model(make_model().to(dtype=torch.bfloat16))
+    """)
+
+
+def test_quantized_checkpoint_round_trip(run_with_torch):
+    """An int8 checkpoint is a fraction of the size and loads back into a model that samples the same actions."""
+    run_with_torch("""
+        import os
+        import tempfile
+        import torch
+        from tiny_model import *
+        from nitrogen.flow_matching_transformer.nitrogen import CategorySpecificLinear
+        from nitrogen.quantization import dequantize_state_dict, quantize_checkpoint
+
+        model = make_model()
+        with tempfile.TemporaryDirectory() as tmp:
+            src, dst = os.path.join(tmp, "ng.pt"), os.path.join(tmp, "ng.int8.pt")
+            torch.save({"ckpt_config": {"model_cfg": {}}, "model": model.state_dict()}, src)
+            quantize_checkpoint(src, dst, "int8")
+            assert os.path.getsize(dst) < 0.4 * os.path.getsize(src)
+            checkpoint = torch.load(dst, weights_only=True)
+
+        assert checkpoint["quantization"]["weight_dtype"] == "int8"
+        assert checkpoint["model"]["action_decoder.layer1.W"].dtype == torch.int8
+        assert checkpoint["quantization"]["scales"]["action_decoder.layer1.W"].shape[:2] == (1, 1)
+        # Only linear weights are quantized: embeddings, the patch conv and buffers are kept as they are
+        linear_weights = {
+            f"{name}.W" if isinstance(module, CategorySpecificLinear) else f"{name}.weight"
+            for name, module in model.named_modules()
+            if isinstance(module, (torch.nn.Linear, CategorySpecificLinear))
+        }
+        assert set(checkpoint["quantization"]["scales"]) == linear_weights
+        for name, tensor in model.state_dict().items():
+            if name not in linear_weights:
+                assert torch.equal(checkpoint["model"][name], tensor), name
+        state_dict = dequantize_state_dict(checkpoint["model"], checkpoint["quantization"])
+
+        restored = make_model()
+        restored.load_state_dict(state_dict)
+        tokenizer = make_tokenizer()
+        cond, _ = make_inputs(tokenizer)
+        actions, _ = sample_with_noise(restored.get_action, cond)
+        expected, _ = sample_with_noise(model.get_action, cond)
+        assert (actions - expected).abs().mean() < 0.1 * expected.abs().mean()
+    """)
@@ -0,0 +1,413 @@
+def test_get_action_matches_reference_sampler(run_with_torch):
+    """Hoisting the VL context out of the denoising loop must not change the sampled actions."""
+    run_with_torch("""
+        import torch
+        from tiny_model import *
+
+        for with_game in (True, False):
+            model = make_model(with_game=with_game)
+            tokenizer = make_tokenizer(with_game=with_game)
+            for available_frames in (1, 4):
+                cond, uncond = make_inputs(
+                    tokenizer, available_frames=available_frames, game="game1" if with_game else None
+                )
+
+                actions, noise = sample_with_noise(model.get_action, cond)
+                expected = reference_get_action(model, cond, noise)
+                torch.testing.assert_close(actions, expected)
+
+                actions, noise = sample_with_noise(model.get_action_with_cfg, cond, uncond, cfg_scale=1.5)
+                expected = reference_get_action_with_cfg(model, cond, uncond, noise, 1.5)
+                torch.testing.assert_close(actions, expected)
+    """)
+
+
+def test_dit_encoder_kv_cache_matches_uncached_forward(run_with_torch):
+    """Cached cross-attention keys/values must give the same DiT output as projecting per step."""
+    run_with_torch("""
+        import torch
+        from tiny_model import *
+
+        model = make_model()
+        dit = model.model
+        sa_embs = torch.randn(2, 16, model.hidden_size)
+        vl_embs = torch.randn(2, 65, model.vision_hidden_size)
+        cache = dit.precompute_encoder_kv(vl_embs)
+        assert [kv is None for kv in cache] == [False, True, False, True]
+
+        for t in (0, 250, 999):
+            timestep = torch.tensor([t])
+            expected = dit(hidden_states=sa_embs, encoder_hidden_states=vl_embs, timestep=timestep)
+            actual = dit(hidden_states=sa_embs, encoder_hidden_states=None, timestep=timestep, encoder_kv_cache=cache)
+            torch.testing.assert_close(actual, expected)
+    """)
+
+
+def test_cached_frame_features_match_encoding_the_stack(run_with_torch):
+    """Features encoded one frame at a time (as InferenceSession caches them) give the same actions."""
+    run_with_torch("""
+        import torch
+        from tiny_model import *
+
+        model = make_model()
+        tokenizer = make_tokenizer()
+        cond, uncond = make_inputs(tokenizer, available_frames=2)
+
+        frames = cond["images"][0]
+        image_features = torch.zeros(frames.shape[0], TOKENS_PER_FRAME, VISION_HIDDEN_SIZE)
+        for i in (2, 3):
+            image_features[i] = model.encode_images(frames[i][None, None])[0, 0]
+        cond["image_features"] = uncond["image_features"] = image_features[None]
+
+        actions, noise = sample_with_noise(model.get_action, cond)
+        torch.testing.assert_close(actions, reference_get_action(model, cond, noise))
+
+        actions, noise = sample_with_noise(model.get_action_with_cfg, cond, uncond, cfg_scale=1.5)
+        torch.testing.assert_close(actions, reference_get_action_with_cfg(model, cond, uncond, noise, 1.5))
+    """)
+
+
+def test_samplers_take_the_batch_from_whichever_frames_are_given(run_with_torch):
+    """Inputs may carry live frames, cached features, or one of each across cond and uncond."""
+    run_with_torch("""
+        import pytest
+        import torch
+        from tiny_model import *
+
+        model = make_model()
+        tokenizer = make_tokenizer()
+        cond, uncond = make_inputs(tokenizer, available_frames=2)
+        image_features = model.encode_images(cond["images"], cond["dropped_images"])
+
+        features_only = {k: v for k, v in cond.items() if k != "images"}
+        features_only["image_features"] = image_features
+        actions, noise = sample_with_noise(model.get_action, features_only)
+        torch.testing.assert_close(actions, reference_get_action(model, cond, noise))
+
+        uncond_features = {k: v for k, v in uncond.items() if k != "images"}
+        uncond_features["image_features"] = model.encode_images(uncond["images"], uncond["dropped_images"])
+        for data_cond, data_uncond in [(cond, uncond_features), (features_only, uncond)]:
+            actions, noise = sample_with_noise(model.get_action_with_cfg, data_cond, data_uncond, cfg_scale=1.5)
+            torch.testing.assert_close(actions, reference_get_action_with_cfg(model, cond, uncond, noise, 1.5))
+
+        no_frames = {k: v for k, v in cond.items() if k != "images"}
+        with pytest.raises(ValueError, match="image_features"):
+            model.get_action(no_frames)
+        with pytest.raises(ValueError, match="image_features"):
+            model.get_action_with_cfg(no_frames, {k: v for k, v in uncond.items() if k != "images"}, cfg_scale=1.5)
+    """)
+
+
+def test_cfg_encodes_shared_frames_once(run_with_torch):
+    """When cond and uncond share their frames, CFG runs the vision encoder on one stack only."""
+    run_with_torch("""
+        import torch
+        from tiny_model import *
+
+        model = make_model()
+        tokenizer = make_tokenizer()
+        cond, uncond = make_inputs(tokenizer, available_frames=4)
+        uncond["images"] = cond["images"]
+
+        encoded_batches = []
+        model.vision_encoder.register_forward_hook(
+            lambda module, args, output: encoded_batches.append(args[0].shape[0])
+        )
+        actions, noise = sample_with_noise(model.get_action_with_cfg, cond, uncond, cfg_scale=1.5)
+        assert encoded_batches == [4], encoded_batches
+
+        torch.testing.assert_close(actions, reference_get_action_with_cfg(model, cond, uncond, noise, 1.5))
+    """)
+
+
+def test_encode_images_skips_dropped_frames(run_with_torch):
+    """Only live frames go through the vision encoder, and the sampled actions do not change."""
+    run_with_torch("""
+        import torch
+        from tiny_model import *
+
+        model = make_model()
+        tokenizer = make_tokenizer()
+        cond, uncond = make_inputs(tokenizer, available_frames=2)
+
+        encoded_batches = []
+        model.vision_encoder.register_forward_hook(
+            lambda module, args, output: encoded_batches.append(args[0].shape[0])
+        )
+
+        features = model.encode_images(cond["images"], cond["dropped_images"])
+        assert encoded_batches == [2], encoded_batches
+        assert features.shape == (1, 4, TOKENS_PER_FRAME, VISION_HIDDEN_SIZE)
+        torch.testing.assert_close(features[:, 2:], model.encode_images(cond["images"])[:, 2:])
+        assert features[:, :2].abs().sum() == 0
+
+        encoded_batches.clear()
+        actions, noise = sample_with_noise(model.get_action, cond)
+        assert encoded_batches == [2], encoded_batches
+        torch.testing.assert_close(actions, reference_get_action(model, cond, noise))
+
+        # Separate frame tensors: each input encodes its own live frames (2 + 1)
+        encoded_batches.clear()
+        actions, noise = sample_with_noise(model.get_action_with_cfg, cond, uncond, cfg_scale=1.5)
+        assert encoded_batches == [3], encoded_batches
+        torch.testing.assert_close(actions, reference_get_action_with_cfg(model, cond, uncond, noise, 1.5))
+
+        # Shared frame tensor: the union of live frames is encoded once
+        uncond["images"] = cond["images"]
+        encoded_batches.clear()
+        actions, noise = sample_with_noise(model.get_action_with_cfg, cond, uncond, cfg_scale=1.5)
+        assert encoded_batches == [2], encoded_batches
+        torch.testing.assert_close(actions, reference_get_action_with_cfg(model, cond, uncond, noise, 1.5))
+    """)
+
+
+def test_higher_order_solvers_approach_the_reference_faster(run_with_torch):
+    """At a fixed step count, Heun and RK4 land closer to a high-step Euler solution than Euler does."""
+    run_with_torch("""
+        import pytest
+        import torch
+        from tiny_model import *
+        from nitrogen.flow_matching_transformer.solvers import make_time_grid
+
+        for name in ("uniform", "cosine", "quadratic"):
+            grid = make_time_grid(5, name)
+            assert grid[0] == 0.0 and grid[-1] == 1.0 and grid == sorted(grid)
+        with pytest.raises(ValueError):
+            make_time_grid(4, "linear")
+
+        model = make_model()
+        tokenizer = make_tokenizer()
+        cond, uncond = make_inputs(tokenizer)
+        reference, _ = sample_with_noise(model.get_action, cond, num_steps=256, ode_solver="euler")
+
+        for num_steps in (2, 4):
+            errors = {}
+            for solver in ("euler", "heun", "rk4"):
+                actions, _ = sample_with_noise(model.get_action, cond, num_steps=num_steps, ode_solver=solver)
+                errors[solver] = (actions - reference).abs().max().item()
+            assert errors["heun"] < errors["euler"], errors
+            assert errors["rk4"] < errors["euler"], errors
+
+        with pytest.raises(ValueError):
+            model.get_action(cond, ode_solver="midpoint")
+    """)
+
+
+def test_integrate_stops_early_on_convergence_and_deadline(run_with_torch):
+    """Tolerance and deadline cut the loop short; the remaining interval is one jump along the last velocity."""
+    run_with_torch("""
+        import time
+        import torch
+        from tiny_model import *
+
+        model = make_model()
+        x0 = torch.randn(2, 16, 25)
+        target = torch.randn(2, 16, 25)
+        straight = lambda x, t: target - x0
+
+        # A straight flow converges after two steps and the jump lands exactly on the target
+        actions, steps = model.integrate(straight, x0, num_steps=8, tolerance=1e-3)
+        assert steps == 2
+        torch.testing.assert_close(actions, target)
+
+        # Without early stopping every step runs
+        curved = lambda x, t: (1 + 3 * t) * (target - x)
+        full, steps = model.integrate(curved, x0, num_steps=8)
+        assert steps == 8
+        same, steps = model.integrate(curved, x0, num_steps=8, tolerance=0.0, deadline=time.perf_counter() + 60)
+        assert steps == 8
+        torch.testing.assert_close(same, full)
+
+        # A deadline that has already passed still runs one step to get a velocity
+        _, steps = model.integrate(curved, x0, num_steps=8, ode_solver="heun", deadline=time.perf_counter())
+        assert steps == 1
+
+        tokenizer = make_tokenizer()
+        cond, _ = make_inputs(tokenizer)
+        output = model.get_action(cond, num_steps=4, deadline=time.perf_counter())
+        assert output["num_steps"] == 1
+        assert model.get_action(cond, num_steps=4)["num_steps"] == 4
+    """)
+
+
+def test_timestep_tables_match_encoding_each_step(run_with_torch):
+    """Table rows give the same DiT output as encoding the timestep; tables grow without moving rows."""
+    run_with_torch("""
+        import torch
+        from tiny_model import *
+
+        model = make_model(num_steps=4)
+        assert model.schedule_buckets() == [0, 250, 500, 750]
+        assert model.schedule_buckets(2, ode_solver="rk4") == [0, 250, 500, 750, 999]
+
+        tables = model.build_timestep_tables()
+        assert model.build_timestep_tables(num_steps=2) is tables
+        rows = dict(tables["rows"])
+        tables = model.build_timestep_tables(num_steps=4, ode_solver="heun", time_grid="cosine")
+        assert all(tables["rows"][bucket] == row for bucket, row in rows.items())
+
+        dit = model.model
+        sa_embs = torch.randn(2, 16, model.hidden_size)
+        vl_embs = torch.randn(2, 65, model.vision_hidden_size)
+        actions = torch.randn(2, 16, model.action_dim)
+        embodiment_id = torch.zeros(2, dtype=torch.long)
+        for bucket in tables["rows"]:
+            cond = model.timestep_cond(tables, bucket)
+            expected = dit(hidden_states=sa_embs, encoder_hidden_states=vl_embs, timestep=torch.tensor([bucket]))
+            actual = dit(hidden_states=sa_embs, encoder_hidden_states=vl_embs, timestep_cond=cond)
+            torch.testing.assert_close(actual, expected)
+
+            expected = model.action_encoder(actions, torch.full((2,), bucket), embodiment_id)
+            actual = model.action_encoder(actions, None, embodiment_id, tau_emb=cond["tau"])
+            torch.testing.assert_close(actual, expected)
+    """)
+
+
+def test_stripped_vl_padding_matches_masking_the_full_sequence(run_with_torch):
+    """Dropping the shared padding columns gives the same result as masking them at full length."""
+    run_with_torch("""
+        import torch
+        from tiny_model import *
+
+        model = make_model()
+        tokenizer = make_tokenizer()
+        cond, uncond = make_inputs(tokenizer, available_frames=2)
+        vl_token_ids = torch.cat([cond["vl_token_ids"], uncond["vl_token_ids"]])
+        dropped_images = torch.cat([cond["dropped_images"], uncond["dropped_images"]])
+        vl_attn_mask = torch.cat([cond["vl_attn_mask"], uncond["vl_attn_mask"]]).bool()
+        features = model.encode_images(cond["images"]).repeat(2, 1, 1, 1)
+
+        vl_embs, mask = model.encode_vl_context(vl_token_ids, features, dropped_images, vl_attn_mask=vl_attn_mask)
+        offset = vl_token_ids.shape[1] - vl_embs.shape[1]
+        assert offset > 0 and mask is not None
+
+        full_embs = model.vl_self_attention_model(
+            model.prepare_vl_embs(vl_token_ids, features, dropped_images), attention_mask=vl_attn_mask
+        )
+        torch.testing.assert_close(vl_embs[mask], full_embs[vl_attn_mask])
+
+        sa_embs = torch.randn(2, 16, model.hidden_size)
+        timestep = torch.tensor([250])
+        actual = model.model(
+            sa_embs, None, timestep=timestep, encoder_attention_mask=mask,
+            encoder_kv_cache=model.model.precompute_encoder_kv(vl_embs),
+        )
+        expected = model.model(sa_embs, full_embs, timestep=timestep, encoder_attention_mask=vl_attn_mask)
+        torch.testing.assert_close(actual, expected)
+
+        # Stripping is opt-in: the default sampler still attends to the padding
+        default, _ = sample_with_noise(model.get_action_with_cfg, cond, uncond, cfg_scale=1.5)
+        stripped, _ = sample_with_noise(model.get_action_with_cfg, cond, uncond, cfg_scale=1.5, strip_vl_padding=True)
+        assert stripped.shape == default.shape and not torch.equal(stripped, default)
+    """)
+
+
+def test_token_assembly_plan_is_cached_by_layout(run_with_torch):
+    """Plans are reused for a known layout, and the opt-in validation still catches bad layouts."""
+    run_with_torch("""
+        import pytest
+        import torch
+        from tiny_model import *
+
+        model = make_model()
+        tokenizer = make_tokenizer()
+        cond, uncond = make_inputs(tokenizer, available_frames=2)
+        features = model.encode_images(cond["images"])
+        args = (cond["vl_token_ids"], cond["sa_token_ids"], cond["dropped_images"], TOKENS_PER_FRAME)
+
+        plan = model.token_assembly_plan(*args, layout_key="two frames")
+        assert model.token_assembly_plan(*args, layout_key="two frames") is plan
+        assert model.token_assembly_plan(*args) is not plan
+
+        # Only the most recently used plans are kept
+        model.max_token_assembly_plans = 2
+        model.token_assembly_plan(*args, layout_key="other")
+        model.token_assembly_plan(*args, layout_key="two frames")
+        model.token_assembly_plan(*args, layout_key="third")
+        assert len(model._token_assembly_plans) == 2
+        assert model.token_assembly_plan(*args, layout_key="two frames") is plan
+        model.max_token_assembly_plans = 64
+
+        action = torch.randn(1, 16, model.hidden_size)
+        expected = reference_prepare_input_embs(
+            model, cond["vl_token_ids"], cond["sa_token_ids"], features, action, cond["dropped_images"],
+            game_ids=cond["game_ids"],
+        )
+        actual = model.prepare_input_embs(
+            cond["vl_token_ids"], cond["sa_token_ids"], features, action, cond["dropped_images"],
+            game_ids=cond["game_ids"], plan=plan,
+        )
+        torch.testing.assert_close(actual, expected)
+
+        model.validate_token_layout = True
+        with pytest.raises(AssertionError):
+            model.token_assembly_plan(*args[:2], uncond["dropped_images"], TOKENS_PER_FRAME, layout_key="two frames")
+    """)
+
+
+def test_category_specific_linear_matches_gathered_bmm(run_with_torch):
+    """Uniform and mixed embodiment batches give the same result as the per-item weight gather."""
+    run_with_torch("""
+        import torch
+        from nitrogen.flow_matching_transformer.nitrogen import CategorySpecificLinear, group_categories
+
+        assert group_categories(torch.tensor([0, 0]), 1) == [(0, None)]
+        assert group_categories(torch.tensor([2, 2]), 3) == [(2, None)]
+
+        for num_categories, cat_ids in ((1, [0, 0, 0]), (3, [1, 1, 1]), (3, [2, 0, 2])):
+            layer = CategorySpecificLinear(num_categories, 8, 16)
+            torch.nn.init.normal_(layer.b)
+            x = torch.randn(3, 5, 8)
+            cat_ids = torch.tensor(cat_ids)
+            expected = torch.bmm(x, layer.W[cat_ids]) + layer.b[cat_ids].unsqueeze(1)
+            torch.testing.assert_close(layer(x, cat_ids), expected)
+    """)
+
+
+def test_batched_cfg_matches_each_request(run_with_torch):
+    """Requests stacked into one batch (as predict_batch does) sample the same actions as alone."""
+    run_with_torch("""
+        import torch
+        from tiny_model import *
+
+        model = make_model()
+        tokenizer = make_tokenizer()
+        inputs = [make_inputs(tokenizer, available_frames=n, seed=n) for n in (1, 3)]
+        cond, uncond = [
+            {key: torch.cat([x[i][key] for x in inputs]) for key in inputs[0][i] if torch.is_tensor(inputs[0][i][key])}
+            for i in (0, 1)
+        ]
+        uncond["images"] = cond["images"]
+
+        actions, noise = sample_with_noise(model.get_action_with_cfg, cond, uncond, cfg_scale=1.5)
+        for i, (item_cond, item_uncond) in enumerate(inputs):
+            item_uncond["images"] = item_cond["images"]
+            expected = reference_get_action_with_cfg(model, item_cond, item_uncond, noise[i:i + 1], 1.5)
+            torch.testing.assert_close(actions[i:i + 1], expected)
+    """)
+
+
+def test_warm_start_samples_from_the_initial_actions(run_with_torch):
+    """t_start=0 ignores the initial actions; a warm start integrates over [t_start, 1] only."""
+    run_with_torch("""
+        import torch
+        from tiny_model import *
+        from nitrogen.flow_matching_transformer.solvers import make_time_grid
+
+        torch.testing.assert_close(torch.tensor(make_time_grid(4, "uniform", 0.5)), torch.tensor([0.5, 0.625, 0.75, 0.875, 1.0]))
+
+        model = make_model()
+        tokenizer = make_tokenizer()
+        cond, uncond = make_inputs(tokenizer, available_frames=2)
+        init_actions = torch.randn(1, model.action_horizon, model.action_dim)
+
+        cold, noise = sample_with_noise(model.get_action_with_cfg, cond, uncond, cfg_scale=1.5)
+        warm, _ = sample_with_noise(
+            model.get_action_with_cfg, cond, uncond, cfg_scale=1.5, init_actions=init_actions, t_start=0.0
+        )
+        torch.testing.assert_close(warm, cold)
+
+        output = model.get_action(cond, init_actions=init_actions, t_start=0.75, num_steps=2)
+        assert output["num_steps"] == 2
+        assert output["action_tensor"].shape == init_actions.shape
+    """)
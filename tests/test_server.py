@@ -47,6 +47,20 @@ def test_handle_request_predict(mock_model):
     assert response["status"] == "ok"
     assert "pred" in response
 
+def test_handle_request_predict_adaptive_stopping(mock_model):
+    """Per-request stopping settings are forwarded and the steps that ran are reported."""
+    session = MagicMock()
+    session.predict.return_value = {"buttons": np.array([1]), "j_left": np.array([0]), "j_right": np.array([0])}
+    session.last_num_steps = 3
+
+    request = {"type": "predict", "latency_budget_ms": 20, "tolerance": None}
+    raw_image = np.zeros((256, 256, 3), dtype=np.uint8)
+
+    response = handle_request(session, request, raw_image=raw_image)
+
+    session.predict.assert_called_once_with(raw_image, latency_budget_ms=20)
+    assert response["num_steps"] == 3
+
 def test_handle_request_unknown():
     """Test handling of unknown request type."""
     session = MagicMock()
@@ -57,3 +71,215 @@ def test_handle_request_unknown():
     assert response["status"] == "error"
     assert "Unknown type" in response["message"]
 
+
+def test_batch_scheduler_groups_compatible_sessions():
+    """Distinct sessions with the same batch key share a batch; a session's second request waits for the next one."""
+    from serve import BatchScheduler
+
+    a, b, c = MagicMock(), MagicMock(), MagicMock()
+    a.batch_key.return_value = b.batch_key.return_value = "shared"
+    c.batch_key.return_value = "other"
+    pending = [(a, 1, {}, None), (b, 2, {}, None), (a, 3, {}, None), (c, 4, {}, None)]
+
+    batches = BatchScheduler.make_batches(pending)
+
+    assert [[request[1] for request in batch] for batch in batches] == [[1, 2], [4], [3]]
+
+def test_handle_request_predict_through_scheduler(mock_model):
+    """With a scheduler, predict requests run through predict_batch and report its step count."""
+    import serve
+
+    session = MagicMock()
+    session.batch_key.return_value = "shared"
+    session.last_num_steps = 2
+    pred = {"buttons": np.array([1]), "j_left": np.array([0]), "j_right": np.array([0])}
+    raw_image = np.zeros((256, 256, 3), dtype=np.uint8)
+
+    with patch.object(serve, "predict_batch", return_value=[pred]) as predict_batch:
+        scheduler = serve.BatchScheduler(max_batch_size=4, max_wait_ms=0)
+        response = handle_request(session, {"type": "predict", "tolerance": 0.1}, raw_image=raw_image, scheduler=scheduler)
+
+    predict_batch.assert_called_once_with([(session, raw_image, {"tolerance": 0.1})])
+    session.predict.assert_not_called()
+    assert response["pred"] is pred
+    assert response["num_steps"] == 2
+
+def test_session_manager_routes_and_evicts_sessions():
+    """Session IDs map to forked sessions; close drops them and idle ones are evicted."""
+    import serve
+
+    template = MagicMock()
+    template.fork.side_effect = lambda: MagicMock()
+    sessions = serve.SessionManager(template, idle_timeout_s=60)
+
+    a = sessions.get("a")
+    assert sessions.get("a") is a
+    assert sessions.get("b") is not a
+
+    response = serve.handle_client_request(sessions, {"type": "reset", "session_id": "a"}, "tcp-1")
+    a.reset.assert_called_once()
+    assert response["session_id"] == "a"
+
+    serve.handle_client_request(sessions, {"type": "info"}, "tcp-1")
+    assert set(sessions.sessions) == {"a", "b", "tcp-1"}
+
+    serve.handle_client_request(sessions, {"type": "close"}, "tcp-1")
+    assert set(sessions.sessions) == {"a", "b"}
+
+    sessions.sessions["b"].lock.locked.return_value = False
+    sessions.last_used["b"] -= 120
+    sessions.get("a")
+    assert set(sessions.sessions) == {"a"}
+
+def test_handle_request_configure():
+    """Configure changes the session settings it knows and reports errors."""
+    session = MagicMock()
+    session.CONFIGURABLE_SETTINGS = ["selected_game", "cfg_scale"]
+
+    response = handle_request(session, {"type": "configure", "cfg_scale": 2.0, "ignored": 1})
+
+    session.configure.assert_called_once_with(cfg_scale=2.0)
+    assert response["status"] == "ok"
+
+    session.configure.side_effect = ValueError("Game 'x' not found in the game mapping")
+    response = handle_request(session, {"type": "configure", "selected_game": "x"})
+    assert response["status"] == "error"
+
+def test_request_pipeline_preprocesses_before_the_model():
+    """The pipeline decodes and runs the image processor in its own stage, then predicts and sends the response."""
+    import serve
+
+    session = MagicMock()
+    session.predict.return_value = {"buttons": np.array([1]), "j_left": np.array([0]), "j_right": np.array([0])}
+    session.last_num_steps = 4
+    session.scene_cache_threshold = None
+    template = MagicMock()
+    template.fork.return_value = session
+    sessions = serve.SessionManager(template)
+    conn = MagicMock()
+    image, original = np.zeros((256, 256, 3), dtype=np.uint8), np.zeros((10, 20, 3), dtype=np.uint8)
+
+    pipeline = serve.RequestPipeline(preprocess_workers=1, model_workers=1, serialize_workers=1)
+    with patch.object(serve, "decode_image", return_value=(image, original)) as decode_image, \
+         patch.object(serve, "json") as mock_json:
+        mock_json.dumps.return_value = "{}"
+        assert pipeline.process(conn, sessions, {"type": "predict", "resize_mode": "crop"}, "tcp-1", raw_data=b"png")
+
+        decode_image.assert_called_once_with(b"png", "crop")
+        session.process_frame.assert_called_once_with(image)
+        session.predict.assert_called_once_with(image, pixel_values=session.process_frame.return_value)
+        conn.sendall.assert_called_once()
+
+        decode_image.return_value = (None, None)
+        assert not pipeline.process(conn, sessions, {"type": "predict"}, "tcp-1", raw_data=b"???")
+        assert session.predict.call_count == 1
+
+        # Frames the scene cache will answer skip the image processor
+        decode_image.return_value = (image, original)
+        session.scene_cache_threshold = 0.01
+        session.scene_cache_peek.return_value = "reuse"
+        with patch.object(serve, "scene_signature") as scene_signature:
+            assert pipeline.process(conn, sessions, {"type": "predict"}, "tcp-1", raw_data=b"png")
+        session.scene_cache_peek.assert_called_once_with(scene_signature.return_value)
+        assert session.process_frame.call_count == 1
+        session.predict.assert_called_with(image, signature=scene_signature.return_value)
+
+def test_reload_swaps_the_model_under_open_sessions():
+    """A reload request loads and warms up a new template in the background, then rebinds the open sessions to it."""
+    import serve
+
+    template, new_template = MagicMock(), MagicMock()
+    template.fork.side_effect = lambda: MagicMock()
+    template.device = "cpu"
+    new_template.game_mapping = None
+    loader = MagicMock(return_value=new_template)
+
+    sessions = serve.SessionManager(template)
+    response = serve.handle_client_request(sessions, {"type": "reload", "ckpt": "new.pt"})
+    assert response["status"] == "error"
+
+    sessions.loader = loader
+    a = sessions.get("a")
+    response = serve.handle_client_request(sessions, {"type": "reload", "ckpt": "new.pt"})
+    assert response["status"] == "ok"
+    sessions.reload_lock.acquire(timeout=5)
+    sessions.reload_lock.release()
+
+    loader.assert_called_once_with(ckpt="new.pt")
+    new_template.fork.return_value.predict.assert_called_once()
+    a.rebind.assert_called_once_with(new_template)
+    assert sessions.template is new_template
+    response = serve.handle_client_request(sessions, {"type": "reload_status"})
+    assert response["reload"]["status"] == "done"
+
+def test_reload_only_loads_files_inside_the_reload_dir(tmp_path):
+    """Reload requests pointing outside --reload-dir are refused before anything is loaded."""
+    import serve
+
+    template = MagicMock()
+    template.device = "cpu"
+    loader = MagicMock()
+    sessions = serve.SessionManager(template, loader=loader, reload_dir=tmp_path / "models")
+
+    for request in [
+        {"ckpt": "/etc/passwd"},
+        {"ckpt": str(tmp_path / "models" / ".." / "evil.pt")},
+        {"base_model": str(tmp_path / "evil.pt")},
+        {"lora_adapters": {"mario": str(tmp_path / "evil")}},
+        {"lora_adapters": ["mario"]},
+    ]:
+        response = serve.handle_client_request(sessions, {"type": "reload", **request})
+        assert response["status"] == "error", request
+    loader.assert_not_called()
+    assert not sessions.reload_lock.locked()
+
+    response = serve.handle_client_request(
+        sessions, {"type": "reload", "ckpt": str(tmp_path / "models" / "checkpoints" / "v2")}
+    )
+    assert response["status"] == "ok"
+    sessions.reload_lock.acquire(timeout=5)
+    sessions.reload_lock.release()
+    loader.assert_called_once_with(ckpt=str(tmp_path / "models" / "checkpoints" / "v2"))
+
+def test_request_pipeline_overlaps_the_requests_of_one_connection():
+    """A connection's next frame is decoded while the previous one is on the model; both are answered in order."""
+    import threading
+    import time
+    import serve
+
+    predicting, release = threading.Event(), threading.Event()
+
+    def predict(image, **kwargs):
+        predicting.set()
+        assert release.wait(5)
+        return {"frame": image}
+
+    session = MagicMock()
+    session.scene_cache_threshold = None
+    session.predict.side_effect = predict
+    template = MagicMock()
+    template.fork.return_value = session
+    sessions = serve.SessionManager(template)
+    decoded = []
+
+    def decode_image(raw_data, resize_mode):
+        decoded.append(raw_data)
+        return raw_data, raw_data
+
+    pipeline = serve.RequestPipeline(preprocess_workers=1, model_workers=2, serialize_workers=1)
+    with patch.object(serve, "decode_image", side_effect=decode_image), \
+         patch.object(serve, "send_json_response") as send_json_response:
+        first = pipeline.submit(MagicMock(), sessions, {"type": "predict"}, "tcp-1", raw_data=b"1")
+        assert predicting.wait(5)
+        second = pipeline.submit(MagicMock(), sessions, {"type": "predict"}, "tcp-1", raw_data=b"2", after=first)
+        for _ in range(500):
+            if len(decoded) == 2:
+                break
+            time.sleep(0.01)
+
+        assert decoded == [b"1", b"2"]
+        assert session.predict.call_count == 1
+        release.set()
+        assert first.result(5) and second.result(5)
+
+    assert [call.args[1]["pred"]["frame"] for call in send_json_response.call_args_list] == [b"1", b"2"]
@@ -0,0 +1,219 @@
+"""
+Helpers to build a tiny, randomly initialised NitroGen model with the real torch stack.
+
+conftest.py replaces torch and the model modules with mocks for the whole test process,
+so tests that need real numerics run their snippets in a subprocess (see the
+`run_with_torch` fixture) and import this module there.
+"""
+import numpy as np
+import torch
+from transformers import SiglipVisionConfig, SiglipVisionModel
+
+import nitrogen.flow_matching_transformer.nitrogen as nitrogen_module
+from nitrogen.flow_matching_transformer.nitrogen import (
+    NitroGen, NitroGen_Config, _ACT_TOKEN, _GAME_ID_TOKEN, _IMG_TOKEN,
+)
+from nitrogen.flow_matching_transformer.modules import DiTConfig, SelfAttentionTransformerConfig
+from nitrogen.mm_tokenizers import NitrogenTokenizer, NitrogenTokenizerConfig
+
+VISION_HIDDEN_SIZE = 64
+TOKENS_PER_FRAME = 16
+IMAGE_SIZE = 32
+GAME_MAPPING = {None: 0, "game1": 1, "game2": 2}
+
+
+def tiny_siglip_config():
+    return SiglipVisionConfig(
+        hidden_size=VISION_HIDDEN_SIZE,
+        intermediate_size=2 * VISION_HIDDEN_SIZE,
+        num_hidden_layers=12,
+        num_attention_heads=4,
+        image_size=IMAGE_SIZE,
+        patch_size=IMAGE_SIZE // 4,
+    )
+
+
+class _TinySiglip:
+    """Stands in for SiglipVisionModel so that building the model never touches the hub."""
+
+    def __new__(cls, config):
+        return SiglipVisionModel(config)
+
+    @staticmethod
+    def from_pretrained(name, *args, **kwargs):
+        torch.manual_seed(1234)
+        return SiglipVisionModel(tiny_siglip_config())
+
+
+nitrogen_module.SiglipVisionModel = _TinySiglip
+
+
+def make_model(with_game=True, num_steps=4, seed=0):
+    torch.manual_seed(seed)
+    config = NitroGen_Config(
+        diffusion_model_cfg=DiTConfig(
+            num_attention_heads=4,
+            attention_head_dim=16,
+            output_dim=64,
+            num_layers=4,
+            cross_attention_dim=VISION_HIDDEN_SIZE,
+            interleave_self_attention=True,
+            max_num_positional_embeddings=64,
+        ),
+        vl_self_attention_cfg=SelfAttentionTransformerConfig(
+            num_attention_heads=4,
+            attention_head_dim=16,
+            num_layers=2,
+            max_num_positional_embeddings=512,
+        ),
+        hidden_size=64,
+        vision_hidden_size=VISION_HIDDEN_SIZE,
+        action_dim=25,
+        action_horizon=16,
+        num_inference_timesteps=num_steps,
+        add_pos_embed=True,
+        max_seq_len=64,
+    )
+    model = NitroGen(config=config, game_mapping=GAME_MAPPING if with_game else None)
+    # Random init leaves the decoder output tiny; scale it so that velocities matter.
+    with torch.no_grad():
+        for param in model.action_decoder.parameters():
+            param.mul_(20)
+    return model.eval()
+
+
+def make_tokenizer(with_game=True, context_length=4):
+    tokenizer = NitrogenTokenizer(NitrogenTokenizerConfig(
+        training=False,
+        num_visual_tokens_per_frame=TOKENS_PER_FRAME,
+        max_sequence_length=TOKENS_PER_FRAME * context_length + 1,
+        action_horizon=16,
+    ))
+    tokenizer.game_mapping = GAME_MAPPING if with_game else None
+    return tokenizer
+
+
+def batchify(tokenized):
+    """Add the batch dimension the same way InferenceSession does."""
+    batch = {}
+    for k, v in tokenized.items():
+        if isinstance(v, torch.Tensor):
+            batch[k] = v.unsqueeze(0)
+        elif isinstance(v, np.ndarray):
+            batch[k] = torch.tensor(v).unsqueeze(0)
+        else:
+            batch[k] = [v]
+    return batch
+
+
+def make_inputs(tokenizer, context_length=4, available_frames=2, game="game1", seed=1):
+    """Return (cond, uncond) model inputs built like InferenceSession._predict_flowmatching."""
+    torch.manual_seed(seed)
+    frames = torch.zeros(context_length, 3, IMAGE_SIZE, IMAGE_SIZE)
+    frames[-available_frames:] = torch.randn(available_frames, 3, IMAGE_SIZE, IMAGE_SIZE)
+    dropped_frames = torch.zeros(context_length, dtype=torch.bool)
+    dropped_frames[:context_length - available_frames] = True
+    cond = tokenizer.encode({"frames": frames, "dropped_frames": dropped_frames, "game": game})
+
+    frame_mask = torch.ones(context_length, dtype=torch.bool)
+    frame_mask[-1] = False
+    uncond = tokenizer.encode({"frames": frames, "dropped_frames": frame_mask, "game": None})
+    return batchify(cond), batchify(uncond)
+
+
+def reference_prepare_input_embs(model, vl_token_ids, sa_token_ids, vision, action, dropped_images, game_ids=None):
+    """The original token assembly: boolean-mask indexing and masked_scatter."""
+    B, T = vl_token_ids.shape
+    vl_embs = torch.zeros(B, T, model.vision_hidden_size, dtype=vision.dtype)
+    live_tokens = (dropped_images == 0).repeat_interleave(vision.shape[2], dim=1)
+    vl_embs[vl_token_ids == _IMG_TOKEN] = vision.reshape(B, -1, model.vision_hidden_size)[live_tokens]
+    if model.game_mapping is not None and game_ids is not None:
+        batch_indices, token_indices = (vl_token_ids == _GAME_ID_TOKEN).nonzero(as_tuple=True)
+        vl_embs[batch_indices, token_indices] = model.game_embedding(game_ids)[batch_indices]
+
+    T = sa_token_ids.shape[1]
+    sa_embs = torch.zeros(B, T, model.hidden_size, dtype=action.dtype)
+    action_mask = (sa_token_ids == _ACT_TOKEN).unsqueeze(-1).expand_as(sa_embs)
+    sa_embs = sa_embs.masked_scatter(action_mask, action)
+    if model.config.add_pos_embed:
+        sa_embs = sa_embs + model.position_embedding(torch.arange(T))
+    return vl_embs, sa_embs
+
+
+def reference_get_action(model, data, noise):
+    """The original sampler: rebuild every embedding and rerun VL mixing on each Euler step."""
+    embodiment_id = data["embodiment_id"]
+    actions = noise
+    num_steps = model.num_inference_timesteps
+    dt = 1.0 / num_steps
+    visual_features = model.encode_images(data["images"])
+    for i in range(num_steps):
+        t_discretized = int(i / float(num_steps) * model.num_timestep_buckets)
+        action_features = model.action_encoder(
+            actions, torch.ones(actions.shape[0]) * t_discretized, embodiment_id
+        )
+        vl_embs, sa_embs = reference_prepare_input_embs(
+            model,
+            data["vl_token_ids"],
+            data["sa_token_ids"],
+            visual_features,
+            action_features,
+            data["dropped_images"],
+            game_ids=data["game_ids"],
+        )
+        vl_embs = model.vl_self_attention_model(vl_embs)
+        model_output = model.model(
+            hidden_states=sa_embs,
+            encoder_hidden_states=vl_embs,
+            timestep=torch.tensor([t_discretized]),
+        )
+        pred = model.action_decoder(model_output, embodiment_id)
+        actions = actions + dt * pred[:, -actions.shape[1]:]
+    return actions
+
+
+def reference_get_action_with_cfg(model, data_cond, data_uncond, noise, cfg_scale):
+    """The original CFG sampler: two full, sequential forward passes per Euler step."""
+    embodiment_id = data_cond["embodiment_id"]
+    actions = noise
+    num_steps = model.num_inference_timesteps
+    dt = 1.0 / num_steps
+    features = {
+        "cond": model.encode_images(data_cond["images"]),
+        "uncond": model.encode_images(data_uncond["images"]),
+    }
+    for i in range(num_steps):
+        t_discretized = int(i / float(num_steps) * model.num_timestep_buckets)
+        action_features = model.action_encoder(
+            actions, torch.ones(actions.shape[0]) * t_discretized, embodiment_id
+        )
+        velocities = {}
+        for name, data in (("cond", data_cond), ("uncond", data_uncond)):
+            vl_embs, sa_embs = reference_prepare_input_embs(
+                model,
+                data["vl_token_ids"],
+                data["sa_token_ids"],
+                features[name],
+                action_features,
+                data["dropped_images"],
+            )
+            vl_embs = model.vl_self_attention_model(vl_embs)
+            model_output = model.model(
+                hidden_states=sa_embs,
+                encoder_hidden_states=vl_embs,
+                timestep=torch.tensor([t_discretized]),
+            )
+            pred = model.action_decoder(model_output, embodiment_id)
+            velocities[name] = pred[:, -actions.shape[1]:]
+        velocity = velocities["cond"] + cfg_scale * (velocities["cond"] - velocities["uncond"])
+        actions = actions + dt * velocity
+    return actions
+
+
+def sample_with_noise(sampler, *args, seed=5, **kwargs):
+    """Call a model sampler and return (actions, initial noise) for a fixed seed."""
+    torch.manual_seed(seed)
+    actions = sampler(*args, **kwargs)["action_tensor"]
+    torch.manual_seed(seed)
+    noise = torch.randn_like(actions)
+    return actions, noise